@@ -16,14 +16,76 @@ IS_DEBUG = bool(strtobool(os.environ.get("IS_DEBUG", "False")))
 IS_ONLY_NOTIFICATOR = bool(strtobool(os.environ.get("IS_ONLY_NOTIFICATOR", "False")))
 
 RPC_URL = URI(os.environ.get("RPC_URL", "https://evmexplorer.velas.com/rpc"))
+RPC_URLS = list(map(lambda x: URI(x.strip()), filter(None, os.environ.get("RPC_URLS", RPC_URL).split(","))))
 EXTERNAL_BLOCK_EXPLORER_URL = os.environ.get("EXTERNAL_BLOCK_EXPLORER_URL", "https://evmexplorer.velas.com/api")
+WS_RPC_URL = os.environ.get("WS_RPC_URL")
+BLOCK_POLL_INTERVAL = float(os.environ.get("BLOCK_POLL_INTERVAL", "0.5"))
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "liquidator_state.sqlite3")
+
+VIEWER_SCAN_MODE = os.environ.get("VIEWER_SCAN_MODE", "threads")
+MULTICALL_BATCH_SIZE = int(os.environ.get("MULTICALL_BATCH_SIZE", "200"))
+LOG_BLOCK_RANGE = int(os.environ.get("LOG_BLOCK_RANGE", "5000"))
+BLOCK_CACHE_TTL = float(os.environ.get("BLOCK_CACHE_TTL", "1"))
+VIEWER_INTERVAL = float(os.environ.get("VIEWER_INTERVAL", "0" if VIEWER_SCAN_MODE in ("index", "tiered") else "30"))
+HOT_TIER_MARGIN = Decimal(os.environ.get("HOT_TIER_MARGIN", "5"))
+HOT_TIER_INTERVAL = int(os.environ.get("HOT_TIER_INTERVAL", "1"))
+WARM_TIER_MARGIN = Decimal(os.environ.get("WARM_TIER_MARGIN", "25"))
+WARM_TIER_INTERVAL = int(os.environ.get("WARM_TIER_INTERVAL", "20"))
+COLD_TIER_INTERVAL = int(os.environ.get("COLD_TIER_INTERVAL", "600"))
+SHARD_INDEX = int(os.environ.get("SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "1"))
+SHARD_BY = os.environ.get("SHARD_BY", "id")
+SHARD_RANGE_SIZE = int(os.environ.get("SHARD_RANGE_SIZE", "1000"))
+SHARD_PROCESSES = int(os.environ.get("SHARD_PROCESSES", "1"))
+LEADER_LEASE_PATH = os.environ.get("LEADER_LEASE_PATH", "")
+LEADER_LEASE_TTL = float(os.environ.get("LEADER_LEASE_TTL", "15"))
+SHARD_INBOX_PATH = os.environ.get("SHARD_INBOX_PATH", "liquidator_inbox.sqlite3")
+RPC_CONCURRENCY = int(os.environ.get("RPC_CONCURRENCY", "200"))
+RPC_BATCH_WINDOW = int(os.environ.get("RPC_BATCH_WINDOW", "0"))
+RPC_BATCH_MAX_SIZE = int(os.environ.get("RPC_BATCH_MAX_SIZE", "100"))
+RPC_HEDGE = bool(strtobool(os.environ.get("RPC_HEDGE", "True")))
+RPC_HEDGE_MIN_DELAY = float(os.environ.get("RPC_HEDGE_MIN_DELAY", "50"))
+RPC_BREAKER_THRESHOLD = int(os.environ.get("RPC_BREAKER_THRESHOLD", "5"))
+RPC_BREAKER_TIMEOUT = float(os.environ.get("RPC_BREAKER_TIMEOUT", "30"))
+RPC_MAX_BLOCK_LAG = int(os.environ.get("RPC_MAX_BLOCK_LAG", "3"))
+RPC_HEALTH_MAX_AGE = float(os.environ.get("RPC_HEALTH_MAX_AGE", "300"))
+RPC_PROBE_INTERVAL = float(os.environ.get("RPC_PROBE_INTERVAL", "10"))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", "60"))
 
 CHAIN_LOG_ADDRESS = os.environ.get("CHAIN_LOG_ADDRESS", "0x87986E3AC1F67aDc36027Df78fBfc06CbB36E768")
 PERCENT_PRICE_DELTA = Decimal(os.environ.get("PERCENT_PRICE_DELTA", "-7"))
 
+LOCAL_NONCES = bool(strtobool(os.environ.get("LOCAL_NONCES", "True")))
+STUCK_TX_TIMEOUT = float(os.environ.get("STUCK_TX_TIMEOUT", "60"))
+GAS_HISTORY_BLOCKS = int(os.environ.get("GAS_HISTORY_BLOCKS", "10"))
+URGENT_GAS_PERCENTILE = int(os.environ.get("URGENT_GAS_PERCENTILE", "90"))
+URGENT_TX_REPLACE_AFTER = float(os.environ.get("URGENT_TX_REPLACE_AFTER", "3"))
+URGENT_GAS_ESCALATION = float(os.environ.get("URGENT_GAS_ESCALATION", "1.25"))
+MAX_GAS_PRICE_GWEI = float(os.environ.get("MAX_GAS_PRICE_GWEI", "0"))
+SIMULATE_TXS = bool(strtobool(os.environ.get("SIMULATE_TXS", "True")))
+SIMULATION_BLOCK = os.environ.get("SIMULATION_BLOCK", "pending")
+RECEIPT_CONFIRMATIONS = int(os.environ.get("RECEIPT_CONFIRMATIONS", "1"))
+RECEIPT_TIMEOUT_BLOCKS = int(os.environ.get("RECEIPT_TIMEOUT_BLOCKS", "300"))
+EXIT_BATCH_WINDOW = float(os.environ.get("EXIT_BATCH_WINDOW", "5"))
+EXIT_BATCH_SIZE = int(os.environ.get("EXIT_BATCH_SIZE", "20"))
+RUNTIME_EXECUTOR_WORKERS = int(os.environ.get("RUNTIME_EXECUTOR_WORKERS", "32"))
+VIEWER_CONCURRENCY = int(os.environ.get("VIEWER_CONCURRENCY", "6"))
+SETUP_CONCURRENCY = int(os.environ.get("SETUP_CONCURRENCY", "5"))
+TAKE_CONCURRENCY = int(os.environ.get("TAKE_CONCURRENCY", "5"))
+EXIT_CONCURRENCY = int(os.environ.get("EXIT_CONCURRENCY", "1"))
+PAYBACK_CONCURRENCY = int(os.environ.get("PAYBACK_CONCURRENCY", "1"))
+JOIN_CONCURRENCY = int(os.environ.get("JOIN_CONCURRENCY", "1"))
+
 MAKE_PAYBACK = bool(strtobool(os.environ.get("MAKE_PAYBACK", "True")))
 WAGYU_SLIPPAGE = Decimal(os.environ.get("WAGYU_SLIPPAGE", "0.5"))
 WAGYU_ROUTER_ADDRESS = os.environ.get("WAGYU_ROUTER_ADDRESS", "0x3D1c58B6d4501E34DF37Cf0f664A58059a188F00")
+WAGYU_LOCAL_QUOTES = bool(strtobool(os.environ.get("WAGYU_LOCAL_QUOTES", "True")))
+WAGYU_FEE_NUMERATOR = int(os.environ.get("WAGYU_FEE_NUMERATOR", "997"))
+WAGYU_MAX_HOPS = int(os.environ.get("WAGYU_MAX_HOPS", "3"))
+WAGYU_MAX_SPLITS = int(os.environ.get("WAGYU_MAX_SPLITS", "1"))
+WAGYU_MAX_PATHS = int(os.environ.get("WAGYU_MAX_PATHS", "20"))
 
 TG_BOT_KEY = os.environ.get("TG_BOT_KEY")
 TG_CHAT_ID = os.environ.get("TG_CHAT_ID")
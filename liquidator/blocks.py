@@ -0,0 +1,102 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+import aiohttp
+from web3 import Web3
+
+
+# Follows the chain head and wakes every thread that waits for a new block. A websocket newHeads subscription is
+# used when a websocket url is set, eth_blockNumber polling otherwise and while the websocket is down.
+class BlockNotifier:
+    ws_url: Optional[str]
+    poll_interval: float
+    ws_retry_interval: float
+
+    alive: bool = False
+    block_number: int = -1
+
+    def __init__(self, web3: Web3, ws_url: str = None, poll_interval: float = 0.5, ws_retry_interval: float = 60,
+                 **kwargs):
+        self.web3 = web3
+        self.ws_url = ws_url
+        self.poll_interval = poll_interval
+        self.ws_retry_interval = ws_retry_interval
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._callbacks: List[Callable[[int], None]] = []
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def subscribe(self, callback: Callable[[int], None]):
+        self._callbacks.append(callback)
+
+    def start(self):
+        self.logger.info(f"Start block notifier")
+        self.alive = True
+        self._stopped.clear()
+        while self.alive:
+            if self.ws_url:
+                try:
+                    asyncio.run(self.follow_new_heads())
+                except Exception as e:
+                    self.logger.warning(f"newHeads subscription failed, poll eth_blockNumber for "
+                                        f"{self.ws_retry_interval} seconds", exc_info=e)
+                if self.alive:
+                    self.poll(self.ws_retry_interval)
+            else:
+                self.poll()
+        self.logger.info(f"Stop block notifier")
+
+    def stop(self):
+        self.alive = False
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def poll(self, duration: float = None):
+        deadline = time.monotonic() + duration if duration is not None else None
+        while self.alive and (deadline is None or time.monotonic() < deadline):
+            try:
+                self.set_block_number(self.web3.eth.block_number)
+            except Exception as e:
+                self.logger.warning(f"failed to read the block number", exc_info=e)
+            self._stopped.wait(self.poll_interval)
+
+    async def follow_new_heads(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.ws_url, heartbeat=30) as ws:
+                await ws.send_json({"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]})
+                async for message in ws:
+                    if not self.alive:
+                        return
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    data = json.loads(message.data)
+                    if "error" in data:
+                        raise ConnectionError(f"eth_subscribe failed: {data['error']}")
+                    head = data.get("params", {}).get("result")
+                    if head is not None:
+                        self.set_block_number(int(head["number"], 16))
+        raise ConnectionError("newHeads subscription closed")
+
+    def set_block_number(self, block_number: int):
+        with self._condition:
+            if block_number <= self.block_number:
+                return
+            self.block_number = block_number
+            self._condition.notify_all()
+
+        for callback in self._callbacks:
+            try:
+                callback(block_number)
+            except Exception as e:
+                self.logger.error(f"block callback failed at block {block_number}", exc_info=e)
+
+    def wait_for_block(self, after: int, timeout: float = None) -> int:
+        with self._condition:
+            self._condition.wait_for(lambda: self.block_number > after or not self.alive, timeout=timeout)
+            return self.block_number
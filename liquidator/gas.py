@@ -0,0 +1,143 @@
+import logging
+import math
+import threading
+from typing import Callable, Dict, List, Optional
+
+from web3 import Web3
+
+URGENCY_BARK = "bark"
+URGENCY_TAKE = "take"
+URGENCY_DEFAULT = "default"
+
+# nodes reject a replacement at the same nonce that does not pay at least 10% more
+MIN_REPLACEMENT_BUMP = 1.1
+
+
+def is_method_not_found(error: Exception) -> bool:
+    # web3 raises the JSON-RPC error object as a ValueError, RpcError keeps its code
+    details = error.args[0] if error.args else None
+    code = details.get("code") if isinstance(details, dict) else getattr(error, "code", None)
+    return code == -32601
+
+
+class UrgencyProfile:
+    name: str
+    # percentile of the priority fees paid in the recent blocks
+    reward_percentile: int
+    # headroom over the next base fee, a transaction stays valid when the base fee rises for a few blocks
+    base_fee_multiplier: float
+    # seconds a transaction may stay pending before it is re-sent at the same nonce
+    replace_after: float
+    # factor of every re-send, nodes reject a replacement below +10%
+    escalation: float
+    # highest gas price (or max fee) in wei the profile pays, None for no cap
+    max_gas_price: Optional[int]
+
+    def __init__(self, name: str, reward_percentile: int = 50, base_fee_multiplier: float = 2,
+                 replace_after: float = 60, escalation: float = 1.125, max_gas_price: int = None):
+        self.name = name
+        self.reward_percentile = reward_percentile
+        self.base_fee_multiplier = base_fee_multiplier
+        self.replace_after = replace_after
+        self.escalation = max(escalation, MIN_REPLACEMENT_BUMP)
+        self.max_gas_price = max_gas_price
+
+    def __repr__(self):
+        return f"UrgencyProfile({self.name}, p{self.reward_percentile}, replace after {self.replace_after}s)"
+
+
+# Gas prices from the fee history of the recent blocks. On a chain with a base fee the transactions are priced as
+# EIP-1559 transactions: the priority fee is the chosen percentile of the tips paid in the last blocks and the max fee
+# leaves room for a rising base fee. Without a base fee (or without eth_feeHistory) the node gas price is used as the
+# legacy gas price. The history is read once per block and shared by all transactions.
+class GasStrategy:
+    history_blocks: int
+
+    _block_number: int = -1
+    _base_fee: Optional[int] = None
+    _rewards: Dict[int, int]
+    _gas_price: int = 0
+    _fee_history: bool = True
+
+    def __init__(self, web3: Web3, profiles: List[UrgencyProfile], block_number: Callable[[], int],
+                 history_blocks: int = 10, **kwargs):
+        self.web3 = web3
+        self.profiles = {x.name: x for x in profiles}
+        self.profiles.setdefault(URGENCY_DEFAULT, UrgencyProfile(URGENCY_DEFAULT))
+        self.block_number = block_number
+        self.history_blocks = history_blocks
+        self._rewards = {}
+        self._lock = threading.Lock()
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def profile(self, urgency: str) -> UrgencyProfile:
+        return self.profiles.get(urgency, self.profiles[URGENCY_DEFAULT])
+
+    def refresh(self):
+        with self._lock:
+            block_number = self.block_number()
+            if block_number <= self._block_number:
+                return
+            self._gas_price = self.web3.eth.gas_price
+            self._base_fee, self._rewards = None, {}
+            if self._fee_history:
+                percentiles = sorted(set(x.reward_percentile for x in self.profiles.values()))
+                try:
+                    history = self.web3.eth.fee_history(self.history_blocks, "latest", percentiles)
+                except Exception as e:
+                    if is_method_not_found(e):
+                        self.logger.info(f"eth_feeHistory is not available, legacy gas price is used: {e}")
+                        self._fee_history = False
+                    else:
+                        # a timeout or a failing node, the history is read again on the next block
+                        self.logger.warning(f"failed to read eth_feeHistory, legacy gas price is used in block "
+                                            f"{block_number}: {e}")
+                else:
+                    # the last entry is the base fee of the next block
+                    base_fees = history.get("baseFeePerGas") or []
+                    if base_fees and base_fees[-1]:
+                        self._base_fee = base_fees[-1]
+                        rewards = [x for x in history.get("reward") or [] if x]
+                        for i, percentile in enumerate(percentiles):
+                            tips = sorted(x[i] for x in rewards)
+                            self._rewards[percentile] = tips[len(tips) // 2] if tips else 0
+            self._block_number = block_number
+
+    def price(self, urgency: str) -> dict:
+        # gas price fields of a new transaction
+        self.refresh()
+        profile = self.profile(urgency)
+        if self._base_fee is None:
+            return {"gasPrice": self._cap(profile, self._gas_price)}
+        tip = self._rewards.get(profile.reward_percentile, 0)
+        max_fee = self._cap(profile, int(self._base_fee * profile.base_fee_multiplier) + tip)
+        return {"maxFeePerGas": max_fee, "maxPriorityFeePerGas": min(tip, max_fee)}
+
+    def escalate(self, tx: dict, urgency: str) -> Optional[dict]:
+        # gas price fields of a re-send at the same nonce, None when the cap of the profile leaves no room for a
+        # replacement the node accepts
+        profile = self.profile(urgency)
+        current = self.price(urgency)
+        if "gasPrice" in tx:
+            gas_price = self._cap(profile, max(math.ceil(tx["gasPrice"] * profile.escalation),
+                                               current.get("gasPrice", current.get("maxFeePerGas", 0))))
+            if gas_price < tx["gasPrice"] * MIN_REPLACEMENT_BUMP:
+                return None
+            return {"gasPrice": gas_price}
+
+        # without the fee history of this block the current price has only the legacy gas price
+        max_fee = self._cap(profile, max(math.ceil(tx["maxFeePerGas"] * profile.escalation),
+                                         current.get("maxFeePerGas", current.get("gasPrice", 0))))
+        tip = min(max(math.ceil(tx["maxPriorityFeePerGas"] * profile.escalation),
+                      current.get("maxPriorityFeePerGas", 0)), max_fee)
+        if max_fee < tx["maxFeePerGas"] * MIN_REPLACEMENT_BUMP \
+                or tip < tx["maxPriorityFeePerGas"] * MIN_REPLACEMENT_BUMP:
+            return None
+        return {"maxFeePerGas": max_fee, "maxPriorityFeePerGas": tip}
+
+    @staticmethod
+    def _cap(profile: UrgencyProfile, gas_price: int) -> int:
+        if profile.max_gas_price is None:
+            return gas_price
+        return min(gas_price, profile.max_gas_price)
@@ -0,0 +1,103 @@
+import threading
+import time
+from decimal import Decimal
+from typing import Any, Callable, Dict, Tuple
+
+from velero_bot_sdk import DssContractsConnector, Converter
+
+
+class IlkParams:
+    ilk: str
+    art: int
+    rate: int
+    spot: int
+    line: int
+    dust: int
+
+    def __init__(self, ilk: str, art: int, rate: int, spot: int, line: int, dust: int):
+        self.ilk = ilk
+        self.art = art
+        self.rate = rate
+        self.spot = spot
+        self.line = line
+        self.dust = dust
+
+
+# Values that are the same for every vault of an ilk within a block. They are shared by all threads and are
+# dropped as soon as a new block is seen.
+class IlkCache:
+    block_ttl: float
+
+    _block_number: int = -1
+    _block_checked_at: float = 0
+
+    def __init__(self, dss: DssContractsConnector, block_ttl: float = 1.0):
+        self.dss = dss
+        self.block_ttl = block_ttl
+        self._values: Dict[Tuple[str, str], Tuple[int, Any]] = {}
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        # values that never change, they are not dropped with the block
+        self._constants: Dict[Tuple[str, str], Any] = {}
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def block_number(self) -> int:
+        # one thread asks the node, the others go on with the last number (only the first read is waited for), and
+        # set_block_number from the block notifier never waits for the node
+        if self._is_stale() and self._refresh_lock.acquire(blocking=self._block_number < 0):
+            try:
+                if self._is_stale():
+                    self.set_block_number(self.dss.web3.eth.block_number)
+            finally:
+                self._refresh_lock.release()
+        return self._block_number
+
+    def _is_stale(self) -> bool:
+        return time.monotonic() - self._block_checked_at >= self.block_ttl
+
+    def set_block_number(self, block_number: int):
+        with self._lock:
+            self._block_checked_at = time.monotonic()
+            if block_number > self._block_number:
+                self._block_number = block_number
+
+    def get_ilk(self, ilk: str) -> IlkParams:
+        def read():
+            art, rate, spot, line, dust = self.dss.vat.caller.ilks(Converter.str_to_bytes32(ilk))
+            return IlkParams(ilk=ilk, art=art, rate=rate, spot=spot, line=line, dust=dust)
+        return self._get("ilk", ilk, read)
+
+    def get_price(self, ilk: str) -> Decimal:
+        return self._get("price", ilk, lambda: self.dss.get_current_price(ilk))
+
+    def get_chost(self, ilk: str) -> int:
+        return self._get("chost", ilk, lambda: self.dss.get_ilk_clip(ilk).caller.chost())
+
+    def get_gem(self, ilk: str) -> str:
+        # collateral token of the join adapter of the ilk
+        return self._get_once("gem", ilk, lambda: self.dss.get_ilk_join(ilk).caller.gem())
+
+    def _get_once(self, kind: str, ilk: str, read: Callable[[], Any]) -> Any:
+        key = (kind, ilk)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._constants:
+                self._constants[key] = read()
+            return self._constants[key]
+
+    def _get(self, kind: str, ilk: str, read: Callable[[], Any]) -> Any:
+        key = (kind, ilk)
+        block_number = self.block_number
+
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            cached = self._values.get(key)
+            if cached is not None and cached[0] >= block_number:
+                return cached[1]
+
+            value = read()
+            self._values[key] = (block_number, value)
+            return value
@@ -1,13 +1,31 @@
 import logging
+import time
 from decimal import Decimal
-from typing import List
+from typing import List, Optional, Tuple
 
+from hexbytes import HexBytes
 from velero_bot_sdk import WagyuContractConnector, DssContractsConnector, calc_perc
 from web3.contract import Contract
 from web3.exceptions import TimeExhausted
 
+from liquidator.gas import URGENCY_TAKE
+from liquidator.ilk_cache import IlkCache
+from liquidator.liquidations.clipper_model import AuctionModel, take_slice
+from liquidator.liquidations.ledger import UsdvLedger
+from liquidator.receipts import ReceiptWatcher, TransactionReverted, wait_for_receipt
+from liquidator.simulation import simulate_many
+from liquidator.state_store import tx_from_state, tx_to_state
+from liquidator.transactions import TransactionSender, send_tx
+from liquidator.wagyu_quotes import WagyuQuotes
+from liquidator.wagyu_routes import RouteFinder
+
+
+# the market price is quoted again at least this often while a take is scheduled
+MAX_SCHEDULE_AHEAD = 30
+
 
 class AuctionItem:
+    state_kind = "take"
     clipper: Contract
     liquidation_id: int
     ilk: str
@@ -18,15 +36,42 @@ class AuctionItem:
     price: int
     percent_price_delta: Decimal
 
+    # the state seen by the last check, used to order the auctions
+    auction_price: Optional[Decimal] = None
+    market_price: Optional[Decimal] = None
+    max_price: Optional[Decimal] = None
+    auction_lot: int = 0
+    auction_tab: Decimal = Decimal("0")
+
+    model: Optional[AuctionModel] = None
+    take_at: Optional[float] = None
+
+    # collateral the simulated take returns
+    expected_lot: Optional[int] = None
+    take_tx: Optional[HexBytes] = None
+    redo_tx: Optional[HexBytes] = None
+    # the take that completed the last process(), it names the items of the next stages
+    taken_tx: Optional[HexBytes] = None
+
     def __init__(self, liquidation_id: int, ilk: str, clipper: Contract, dss: DssContractsConnector,
-                 wagyu: WagyuContractConnector, percent_price_delta: Decimal, **kwargs):
+                 wagyu: WagyuContractConnector, percent_price_delta: Decimal, ilk_cache: IlkCache, **kwargs):
         self.liquidation_id = liquidation_id
         self.ilk = ilk
+        self.ilk_cache = ilk_cache
         self.coin = self.ilk.split("-")[0]
         self.clipper = clipper
         self.percent_price_delta = percent_price_delta
 
-        if self.coin == "VLX":
+        self.routes: Optional[RouteFinder] = kwargs.get("routes")
+        self.sender: Optional[TransactionSender] = kwargs.get("sender")
+        self.receipts: Optional[ReceiptWatcher] = kwargs.get("receipts")
+        self.ledger: Optional[UsdvLedger] = kwargs.get("ledger")
+        # block of the pre-flight eth_call of take, None to send without it
+        self.simulation_block = kwargs.get("simulation_block")
+        if self.routes is not None:
+            # the route is chosen on every quote, any collateral with a Wagyu route to USDV is supported
+            self.swap_path = [ilk_cache.get_gem(ilk), dss.usdv.address]
+        elif self.coin == "VLX":
             self.swap_path = [wagyu._wrapped_coin_addr, "0xc111c29A988AE0C0087D97b33C6E6766808A3BD3", dss.usdv.address]
         elif self.coin == "WAG":
             self.swap_path = [dss.get_contact_address("WAG"), dss.usdv.address]
@@ -35,86 +80,232 @@ class AuctionItem:
         else:
             raise ValueError("Not supported coin")
 
+        self.quotes: Optional[WagyuQuotes] = kwargs.get("quotes")
         self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
 
+    @property
+    def key(self) -> Tuple[str, int]:
+        return self.ilk, self.liquidation_id
+
+    @property
+    def state_key(self) -> str:
+        return f"{self.state_kind}:{self.ilk}:{self.liquidation_id}"
+
+    def to_state(self) -> Optional[dict]:
+        # only a sent take has to survive a restart, the rest is read again from the clipper
+        if self.take_tx is None:
+            return None
+        return {"liquidation_id": self.liquidation_id, "ilk": self.ilk, "take_tx": tx_to_state(self.take_tx),
+                "expected_lot": self.expected_lot}
+
+    def restore(self, state: dict):
+        self.take_tx = tx_from_state(state["take_tx"])
+        self.expected_lot = state.get("expected_lot")
+
+    @property
+    def current_price(self) -> Optional[Decimal]:
+        # between the checks the price follows the curve of the auction
+        if self.model is not None:
+            return self.model.price_at(time.time())
+        return self.auction_price
+
+    @property
+    def expected_profit(self) -> Decimal:
+        price = self.current_price
+        if self.market_price is None or not price:
+            return Decimal("0")
+        amount = min(Decimal(self.auction_lot) / Decimal(10 ** 18), self.auction_tab / price)
+        return (self.market_price - price) * amount
+
+    @property
+    def priority(self) -> tuple:
+        if self.market_price is None:
+            return 0, Decimal("0")
+        if self.current_price <= self.max_price:
+            return 1, -self.expected_profit
+        # the auction price goes down over time, the sooner it reaches our price the sooner it is worth taking
+        return 2, self.take_at or 0
+
+    @property
+    def holds_funds(self) -> bool:
+        # a sent take is retried until its receipt is seen
+        return self.take_tx is not None
+
+    def seconds_to_take(self) -> float:
+        return self.take_at - time.time() if self.take_at is not None else 0
+
     def process(self, dss: DssContractsConnector, wagyu: WagyuContractConnector):
-        needs_redo, price, lot, tab = self.clipper.caller.getStatus(self.liquidation_id)
+        if self.take_tx is not None:
+            return self.finish_take(dss=dss)
+        if self.redo_tx is not None:
+            return self.redo(dss=dss)
+        if self.seconds_to_take() > 0:
+            return
 
-        tab = Decimal(tab) / Decimal(10 ** 27)
-        price = Decimal(price) / Decimal(10 ** 27)
+        needs_redo, raw_price, lot, raw_tab = self.clipper.caller.getStatus(self.liquidation_id)
+
+        tab = Decimal(raw_tab) / Decimal(10 ** 27)
+        price = Decimal(raw_price) / Decimal(10 ** 27)
 
         if needs_redo:
+            self.model, self.take_at = None, None
             return self.redo(dss=dss)
 
         if tab <= 0 or lot <= 0:
             self.logger.info(f"[{self.liquidation_id} {self.ilk}] liquidation already not active (lot={lot} tab={tab})")
             return
 
-        amount_in = Decimal(wagyu.get_amount_in(amount_out=tab, path=self.swap_path))
+        if self.routes is not None:
+            route = self.routes.best_route_in(self.swap_path[0], self.swap_path[-1], int(tab))
+            if route is None:
+                raise ValueError(f"no Wagyu route from {self.swap_path[0]} to USDV")
+            self.swap_path = route.path
+            amount_in = Decimal(route.amount_in)
+        elif self.quotes is not None:
+            amount_in = Decimal(self.quotes.get_amounts_in(amount_out=int(tab), path=self.swap_path)[0])
+        else:
+            amount_in = Decimal(wagyu.get_amount_in(amount_out=tab, path=self.swap_path))
         market_price = tab / amount_in
 
         max_price = calc_perc(market_price, self.percent_price_delta)
+        self.auction_price, self.market_price, self.max_price = price, market_price, max_price
+        self.auction_lot, self.auction_tab = lot, tab
         if price > max_price:
-            self.logger.info(f"[{self.liquidation_id} {self.ilk}] {price} (max_price={max_price}) price for liquidation is great.")
+            self.schedule(max_price)
+            self.logger.info(f"[{self.liquidation_id} {self.ilk}] {price} (max_price={max_price}) price for "
+                             f"liquidation is great, next check in {int(self.seconds_to_take())} seconds.")
             return
+        self.take_at = None
 
-        amount = Decimal(min(lot, Decimal(dss.vat.caller.usdv(dss.account.address)) / Decimal(10 ** 27)))
+        try:
+            if self.ledger is not None:
+                # Clipper takes no more than the tab, the rest of the lot goes back to the vault
+                needed = min(lot * raw_price, raw_tab)
+                reserved = self.ledger.reserve(self.key, needed)
+                amount = Decimal(lot if reserved >= needed else reserved // raw_price)
+            else:
+                amount = Decimal(min(lot, Decimal(dss.vat.caller.usdv(dss.account.address)) / Decimal(10 ** 27)))
 
-        if Decimal(lot) - amount != Decimal('0') and Decimal(lot) - amount < (
-                Decimal(self.clipper.caller.chost()) / Decimal(10 ** 27)):
-            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] there is not enough balance on VAT for a take")
-            return
+            if amount <= 0 or Decimal(lot) - amount != Decimal('0') and Decimal(lot) - amount < (
+                    Decimal(self.ilk_cache.get_chost(self.ilk)) / Decimal(10 ** 27)):
+                self.logger.warning(f"[{self.liquidation_id} {self.ilk}] there is not enough balance on VAT "
+                                    f"for a take")
+                return
+
+            func = self.clipper.functions.take(
+                amt=int(amount),
+                id=self.liquidation_id,
+                max=int(calc_perc(price, Decimal("0.1")) * Decimal(10 ** 27)),
+                who=dss.account.address,
+                data="0x"
+            )
+            if self.simulation_block is not None and not self.simulate_take(dss, func, int(amount)):
+                return
+            self.take_tx = send_tx(dss, func, sender=self.sender, urgency=URGENCY_TAKE)
+        finally:
+            # a sent take keeps its reservation until the receipt settles it
+            if self.take_tx is None:
+                self.release_usdv()
+        self.logger.notification(f"[{self.liquidation_id} {self.ilk}] take lot by liquidation with max price "
+                                 f"{max_price}{self.describe_expected_lot()} ( {str(self.take_tx.hex())} )")
+        return self.finish_take(dss=dss)
+
+    def simulate_take(self, dss: DssContractsConnector, func, amount: int) -> bool:
+        # the status is read in the same state as the take, so the collateral of the take is known exactly
+        take, status = simulate_many([func, self.clipper.functions.getStatus(self.liquidation_id)],
+                                     sender=dss.account.address, block_identifier=self.simulation_block)
+        if not take:
+            self.logger.info(f"[{self.liquidation_id} {self.ilk}] take is not sent, it would fail: {take.error}")
+            self.model, self.take_at = None, None
+            return False
+        self.expected_lot = None
+        if status:
+            _, price, lot, tab = status.result
+            if price > 0:
+                self.expected_lot, _ = take_slice(amount, lot, tab, price, self.ilk_cache.get_chost(self.ilk))
+        return True
 
-        func = self.clipper.functions.take(
-            amt=int(amount),
-            id=self.liquidation_id,
-            max=int(calc_perc(price, Decimal("0.1")) * Decimal(10 ** 27)),
-            who=dss.account.address,
-            data="0x"
-        )
-        tx = dss.call_tx(func)
-        self.logger.notification(
-            f"[{self.liquidation_id} {self.ilk}] take lot by liquidation with max price {max_price} ( {str(tx.hex())} )")
+    def describe_expected_lot(self) -> str:
+        if self.expected_lot is None:
+            return ""
+        return f", expected lot {Decimal(self.expected_lot) / Decimal(10 ** 18)} {self.coin}"
 
+    def finish_take(self, dss: DssContractsConnector):
+        tx = self.take_tx
         try:
-            receipt_tx = dss.web3.eth.wait_for_transaction_receipt(transaction_hash=tx, timeout=30)
+            receipt_tx = wait_for_receipt(dss.web3, tx, watcher=self.receipts)
         except TimeExhausted as e:
             self.logger.warning(
-                f"[{self.liquidation_id} {self.ilk}] the transaction {str(tx.hex())} was not confirmed within 30 seconds. "
+                f"[{self.liquidation_id} {self.ilk}] the transaction {str(tx.hex())} was not confirmed in time. "
                 "Please make sure that the transaction was failed, "
                 "otherwise it is necessary to withdraw and exchange "
                 "the received collateral asset yourself", exc_info=e)
             raise e
+        except TransactionReverted as e:
+            # outbid or the auction ended, it is checked again on the next pass
+            self.take_tx = None
+            self.release_usdv()
+            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] {e}")
+            return
+        self.take_tx = None
 
         logs = self.clipper.events.Take().processReceipt(receipt_tx)
 
         if len(logs) != 1:
+            self.release_usdv()
             self.logger.warning(
                 f"[{self.liquidation_id} {self.ilk}] transaction {str(tx.hex())} has more than one Take() event")
             return
         take_log = logs[0]['args']
+        if self.ledger is not None:
+            self.ledger.settle(self.key, take_log['owe'], receipt_tx['blockNumber'])
 
         self.price = take_log['price']
         self.lot = int(Decimal(str(take_log['owe'])) / Decimal(str(self.price)))  # owe / price
+        self.taken_tx = tx
         self.is_completed = True
 
+    def release_usdv(self):
+        if self.ledger is not None:
+            self.ledger.release(self.key)
+
+    def schedule(self, max_price: Decimal):
+        # top, tic and the abacus do not change until a redo, the price curve is computed locally from them
+        if self.model is None:
+            self.model = AuctionModel.read(self.clipper, self.liquidation_id)
+
+        now = time.time()
+        take_at = self.model.time_to_price(max_price) if self.model is not None else None
+        self.take_at = min(take_at or now + MAX_SCHEDULE_AHEAD, now + MAX_SCHEDULE_AHEAD)
+
     def redo(self, dss: DssContractsConnector):
-        try:
-            tx = dss.call_tx(self.clipper.functions.redo(id=self.liquidation_id, kpr=dss.account.address))
-            self.logger.notification(f"[{self.liquidation_id} {self.ilk}] restart auction ({str(tx.hex())})")
-        except Exception as e:
-            self.logger.error(f"[{self.liquidation_id} {self.ilk}] failed restart auction", exc_info=e)
-            raise e
+        if self.redo_tx is None:
+            try:
+                self.redo_tx = send_tx(dss, self.clipper.functions.redo(id=self.liquidation_id,
+                                                                        kpr=dss.account.address),
+                                       sender=self.sender, urgency=URGENCY_TAKE)
+                self.logger.notification(f"[{self.liquidation_id} {self.ilk}] restart auction "
+                                         f"({str(self.redo_tx.hex())})")
+            except Exception as e:
+                self.logger.error(f"[{self.liquidation_id} {self.ilk}] failed restart auction", exc_info=e)
+                raise e
 
+        tx = self.redo_tx
         try:
-            receipt_tx = dss.web3.eth.wait_for_transaction_receipt(transaction_hash=tx, timeout=30)
+            receipt_tx = wait_for_receipt(dss.web3, tx, watcher=self.receipts)
         except TimeExhausted as e:
             self.logger.warning(
                 f"[{self.liquidation_id} {self.ilk}] the transaction {str(tx.hex())} "
-                f"was not confirmed within 30 seconds. "
+                f"was not confirmed in time. "
                 "Please make sure that the transaction was failed, "
                 "otherwise it is necessary to withdraw and exchange "
                 "the received collateral asset yourself", exc_info=e)
             raise e
+        except TransactionReverted as e:
+            # restarted by another keeper, the auction is checked again on the next pass
+            self.redo_tx = None
+            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] {e}")
+            return
+        self.redo_tx = None
 
         return receipt_tx
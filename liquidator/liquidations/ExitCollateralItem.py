@@ -1,18 +1,39 @@
+import hashlib
 import logging
+import uuid
 from decimal import Decimal
-from typing import List
+from typing import List, Optional, Union
 
+from hexbytes import HexBytes
 from velero_bot_sdk import DssContractsConnector
 from web3.exceptions import TimeExhausted
 
+from liquidator.receipts import TransactionReverted, wait_for_receipt
+from liquidator.state_store import tx_from_state, tx_to_state
+from liquidator.transactions import send_tx
+
+
+# WVLX withdraw is sent before the exit is mined, so its gas can not be estimated
+UNWRAP_GAS = 100000
+
 
 class ExitCollateralItem:
-    liquidation_id: int
+    state_kind = "exit"
+    # comma separated ids for a batch of takes
+    liquidation_id: Union[int, str]
     ilk: str
     amount: int
     price: int
+    # hash of the take, or a digest of the state keys of the merged takes: partial takes of one auction are
+    # separate items
+    take_id: str
 
-    is_completed: bool
+    # the collateral of the take is in the Vat until it is exited, the item is never given up
+    holds_funds = True
+    is_completed: bool = False
+    is_exited: bool = False
+    exit_tx: Optional[HexBytes] = None
+    unwrap_tx: Optional[HexBytes] = None
     swap_path: List[str]
 
     def __init__(self, liquidation_id: int, ilk: str, amount: int, price: int, swap_path: List[str], **kwargs):
@@ -21,44 +42,127 @@ class ExitCollateralItem:
         self.amount = amount
         self.price = price
         self.swap_path = swap_path
+        self.take_id = kwargs.get("take_id") or uuid.uuid4().hex
+        # state keys of the items merged into this one
+        self.replaces: List[str] = kwargs.get("replaces", [])
+        self.sender = kwargs.get("sender")
+        self.receipts = kwargs.get("receipts")
 
         self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
 
+    @classmethod
+    def merge(cls, items: List["ExitCollateralItem"]) -> "ExitCollateralItem":
+        # the takes of one ilk, exited, swapped and joined as one amount
+        if len(items) == 1:
+            return items[0]
+        first = items[0]
+        amount = sum(map(lambda x: x.amount, items))
+        # weighted by amount, so the minimal swap output stays the sum of the takes
+        price = sum(map(lambda x: x.amount * x.price, items)) // amount if amount else first.price
+        replaces = [key for x in items for key in [x.state_key] + x.replaces]
+        take_id = hashlib.sha1(",".join(sorted(replaces)).encode()).hexdigest()
+        return cls(liquidation_id=",".join(map(lambda x: str(x.liquidation_id), items)), ilk=first.ilk,
+                   amount=amount, price=price, swap_path=first.swap_path, take_id=take_id, sender=first.sender,
+                   receipts=first.receipts, logger=first.logger, replaces=replaces)
+
+    @property
+    def state_key(self) -> str:
+        return f"{self.state_kind}:{self.ilk}:{self.liquidation_id}:{self.take_id}"
+
+    def to_state(self) -> dict:
+        return {"liquidation_id": self.liquidation_id, "ilk": self.ilk, "amount": self.amount, "price": self.price,
+                "swap_path": self.swap_path, "take_id": self.take_id, "is_exited": self.is_exited,
+                "exit_tx": tx_to_state(self.exit_tx), "unwrap_tx": tx_to_state(self.unwrap_tx)}
+
+    @classmethod
+    def from_state(cls, state: dict, **kwargs) -> "ExitCollateralItem":
+        item = cls(liquidation_id=state["liquidation_id"], ilk=state["ilk"], amount=state["amount"],
+                   price=state["price"], swap_path=state["swap_path"], take_id=state["take_id"], **kwargs)
+        item.is_exited = state["is_exited"]
+        item.exit_tx, item.unwrap_tx = tx_from_state(state["exit_tx"]), tx_from_state(state["unwrap_tx"])
+        return item
+
     def process(self, dss: DssContractsConnector):
-        try:
-            func = dss.get_ilk_join(self.ilk).functions.exit(dss.account.address, self.amount)
-            tx = dss.call_tx(func)
+        is_native = self.ilk.split("-")[0] == "VLX"
+        if self.is_exited:
+            # a retry after the exit was confirmed
+            if is_native:
+                self.unwrap(dss=dss)
+            self.is_completed = True
+            return
 
-            self.logger.notification(f"[{self.liquidation_id} {self.ilk}] "
-                                     f"exit {Decimal(self.amount) / Decimal(10**18)} from VAT ( {str(tx.hex())} ).")
-        except Exception as e:
-            self.logger.error(f"[{self.liquidation_id} {self.ilk}] Failed exit from VAT."
-                              f" It is necessary to withdraw and exchange the currency manually",
-                              exc_info=e)
-            raise e
+        if self.exit_tx is None:
+            try:
+                func = dss.get_ilk_join(self.ilk).functions.exit(dss.account.address, self.amount)
+                if self.sender is not None and is_native:
+                    self.send_exit_and_unwrap(dss, func)
+                else:
+                    self.exit_tx = send_tx(dss, func, sender=self.sender)
+
+                self.logger.notification(f"[{self.liquidation_id} {self.ilk}] "
+                                         f"exit {Decimal(self.amount) / Decimal(10**18)} from VAT "
+                                         f"( {str(self.exit_tx.hex())} ).")
+                if self.unwrap_tx is not None:
+                    self.logger.notification(f"[{self.liquidation_id} {self.ilk}] unwrapped "
+                                             f"{Decimal(self.amount) / Decimal(10 ** 18)} "
+                                             f"( {str(self.unwrap_tx.hex())} )")
+            except Exception as e:
+                self.logger.error(f"[{self.liquidation_id} {self.ilk}] Failed exit from VAT."
+                                  f" It is necessary to withdraw and exchange the currency manually",
+                                  exc_info=e)
+                raise e
 
+        tx = self.exit_tx
         try:
-            receipt_tx = dss.web3.eth.wait_for_transaction_receipt(transaction_hash=tx, timeout=30)
+            receipt_tx = wait_for_receipt(dss.web3, tx, watcher=self.receipts)
         except TimeExhausted as e:
             self.logger.warning(f"[{self.liquidation_id} {self.ilk}] the transaction {str(tx.hex())} "
-                                f"was not confirmed within 30 seconds. "
+                                f"was not confirmed in time. "
                                 "Please make sure that the transaction was failed, "
                                 "otherwise it is necessary to withdraw and exchange "
                                 "the received collateral asset yourself", exc_info=e)
             raise e
+        except TransactionReverted as e:
+            # nothing was exited, a retry sends the exit (and the unwrap behind it) again
+            self.exit_tx, self.unwrap_tx = None, None
+            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] {e}")
+            raise e
+        self.is_exited = True
 
-        if self.ilk.split("-")[0] == "VLX":
+        if is_native:
             self.unwrap(dss=dss)
 
         self.is_completed = True
         return receipt_tx
 
+    def send_exit_and_unwrap(self, dss: DssContractsConnector, func):
+        def sent(index: int, tx_hash: HexBytes):
+            if index == 0:
+                self.exit_tx = tx_hash
+            else:
+                self.unwrap_tx = tx_hash
+
+        try:
+            self.sender.send_sequence([
+                (func, None),
+                (dss.vlx.functions.withdraw(self.amount), UNWRAP_GAS),
+            ], on_sent=sent)
+        except Exception as e:
+            if self.exit_tx is None:
+                raise e
+            # the exit is out, unwrap() sends the withdraw once the exit is mined
+            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] failed to send the unwrap with the exit, "
+                                f"it is sent after the exit", exc_info=e)
+
     def unwrap(self, dss: DssContractsConnector):
         try:
-            func = dss.vlx.functions.withdraw(self.amount)
-            tx = dss.call_tx(func)
-            self.logger.notification(
-                f"[{self.liquidation_id} {self.ilk}] unwrapped {Decimal(self.amount) / Decimal(10 ** 18)} ( {str(tx.hex())} )")
+            # sent right behind the exit, or by a previous attempt that was not confirmed in time
+            tx = self.unwrap_tx
+            if tx is None:
+                tx = send_tx(dss, dss.vlx.functions.withdraw(self.amount), sender=self.sender)
+                self.unwrap_tx = tx
+                self.logger.notification(f"[{self.liquidation_id} {self.ilk}] unwrapped "
+                                         f"{Decimal(self.amount) / Decimal(10 ** 18)} ( {str(tx.hex())} )")
         except Exception as e:
             self.logger.error(f"[{self.liquidation_id} {self.ilk}] Failed unwrapped."
                               f" It is necessary unwrapped and exchange the currency manually",
@@ -66,12 +170,16 @@ class ExitCollateralItem:
             raise e
 
         try:
-            receipt_tx = dss.web3.eth.wait_for_transaction_receipt(transaction_hash=tx, timeout=30)
+            receipt_tx = wait_for_receipt(dss.web3, tx, watcher=self.receipts)
         except TimeExhausted as e:
             self.logger.warning(
                 f"[{self.liquidation_id} {self.ilk}] the transaction {str(tx.hex())} was not "
-                f"confirmed within 30 seconds. Please make sure that the transaction was failed, "
+                f"confirmed in time. Please make sure that the transaction was failed, "
                 "otherwise it is necessary to unwrapped and exchange "
                 "the received collateral asset yourself", exc_info=e)
             raise e
+        except TransactionReverted as e:
+            self.unwrap_tx = None
+            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] {e}")
+            raise e
         return receipt_tx
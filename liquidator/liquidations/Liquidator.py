@@ -1,288 +1,311 @@
+import asyncio
 import logging
 import threading
-import time
 from decimal import Decimal
-from queue import Queue, Empty
+from queue import Queue
+from typing import Optional
 
-import requests
+from hexbytes import HexBytes
 from velero_bot_sdk import DssContractsConnector, WagyuContractConnector, Converter
 from web3.exceptions import ContractLogicError
 
+from liquidator.blocks import BlockNotifier
+from liquidator.gas import URGENCY_BARK
+from liquidator.ilk_cache import IlkCache
+from liquidator.receipts import ReceiptWatcher
+from liquidator.retry import DeadLetters, RetryPolicy
+from liquidator.runtime import Runtime
+from liquidator.simulation import simulate
+from liquidator.state_store import StateStore
+from liquidator.transactions import TransactionSender, send_tx
+from liquidator.wagyu_quotes import WagyuQuotes
+from liquidator.wagyu_routes import RouteFinder
 from liquidator.vault import Vault
 from liquidator.liquidations.AuctionItem import AuctionItem
+from liquidator.liquidations.auctions import AuctionRegistry
+from liquidator.liquidations.batches import CollateralBatcher
+from liquidator.liquidations.ledger import UsdvLedger
 from liquidator.liquidations.ExitCollateralItem import ExitCollateralItem
 from liquidator.liquidations.PaybackItem import PaybackItem
 from liquidator.liquidations.joinItem import JoinItem
+from liquidator.liquidations.pipeline import Pipeline, Stage
+from liquidator.liquidations.unsafe_vaults import UnsafeVaultQueue
 
 
 class Liquidator:
     alive: bool = False
 
-    def __init__(self, queue: Queue, dss: DssContractsConnector,
-                 wagyu: WagyuContractConnector, percent_price_delta: Decimal, make_payback: bool):
+    def __init__(self, queue: UnsafeVaultQueue, dss: DssContractsConnector,
+                 wagyu: WagyuContractConnector, percent_price_delta: Decimal, make_payback: bool,
+                 ilk_cache: IlkCache = None, blocks: BlockNotifier = None, quotes: WagyuQuotes = None,
+                 routes: RouteFinder = None, sender: TransactionSender = None,
+                 receipts: ReceiptWatcher = None, simulation_block=None, batch_window: float = 0,
+                 batch_size: int = 1, store: StateStore = None, retry_policy: RetryPolicy = None,
+                 dead_letters: DeadLetters = None, runtime: Runtime = None, setup_concurrency: int = 5,
+                 liquidation_concurrency: int = 5, exit_concurrency: int = 1, payback_concurrency: int = 1,
+                 join_concurrency: int = 1):
         self.dss = dss
+        # without a shared runtime the liquidator runs its own while it is started
+        self.runtime = runtime or Runtime()
+        self._own_runtime = runtime is None
+        self.store = store
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letters = dead_letters
+        self.blocks = blocks
+        self._stopped = threading.Event()
+        self.ilk_cache = ilk_cache or IlkCache(dss)
         self.setup_liquidations_queue = queue
         self.tasks = []
         self.wagyu = wagyu
+        self.quotes = quotes
+        self.routes = routes
+        self.sender = sender
+        self.receipts = receipts
+        self.simulation_block = simulation_block
         self.percent_price_delta = percent_price_delta
+        # the takes of all workers are sized from one USDV balance, joins of the own nonce sequence count in advance
+        self.ledger = UsdvLedger(read_balance=lambda: dss.vat.caller.usdv(dss.account.address),
+                                 block_number=lambda: self.ilk_cache.block_number,
+                                 credit_pending=sender is not None)
 
-        self.liquidations_queue = Queue()
+        self.liquidations_queue = AuctionRegistry(ledger=self.ledger)
         self.payback_queue = Queue()
-        self.exit_queue = Queue()
+        # takes of one ilk are exited and swapped together when batching is on
+        self.exit_queue = CollateralBatcher(window=batch_window, max_size=batch_size) \
+            if batch_window > 0 and batch_size > 1 else Queue()
         self.join_queue = Queue()
 
         self.make_payback = make_payback
 
-        self.liquidations_threads_count = 5
+        self.liquidation_concurrency = liquidation_concurrency
+        # barks only run in parallel when the nonces are handed out locally
+        self.setup_concurrency = setup_concurrency if sender is not None else 1
+        self.exit_concurrency = exit_concurrency
+        self.payback_concurrency = payback_concurrency
+        self.join_concurrency = join_concurrency
 
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.pipeline = self.setup_pipeline()
 
     def stop(self):
         self.alive = False
+        self._stopped.set()
+
+    def wait_for_block(self, last_block: int, timeout: float = 30) -> int:
+        if self.blocks is None:
+            self._stopped.wait(timeout)
+            return last_block
+        return self.blocks.wait_for_block(after=last_block, timeout=timeout)
 
     def start(self):
         self.logger.notification(f"Start Liquidator")
         self.alive = True
+        self._stopped.clear()
 
-        while self.alive:
-            threads = []
-            try:
-                threads.append(threading.Thread(target=self.setup_new_liquidation, name="thread_setup_new_auctions"))
-                threads.append(threading.Thread(target=self.check_active_auctions, name="thread_check_active_auctions"))
-                threads.append(threading.Thread(target=self.processed_exit, name="thread_process_exits"))
-
-                if self.make_payback is True:
-                    threads.append(threading.Thread(target=self.processed_payback, name="thread_process_payback"))
-                    threads.append(threading.Thread(target=self.processed_joined, name="thread_processed_joined"))
-
-                for i in range(self.liquidations_threads_count):
-                    threads.append(threading.Thread(
-                        target=self.processed_liquidation,
-                        name=f"thread#{i}_processed_liquidation#0"
-                    ))
-
-                list(map(lambda x: x.start(), threads))
-                list(map(lambda x: x.join(), threads))
-            finally:
-                time.sleep(300)
+        runtime_thread = self.runtime.start_thread() if self._own_runtime else None
+        self.restore()
+        self.pipeline.start()
+        checker = self.runtime.spawn(self.check_active_auctions())
+
+        self._stopped.wait()
+        self.pipeline.cancel()
+        checker.result()
+        self.pipeline.join()
+        if runtime_thread is not None:
+            self.runtime.stop()
+            runtime_thread.join()
         self.logger.notification(f"Stop Liquidator")
 
-    def processed_joined(self):
-        self.logger.info(f"Start processed joined")
-        while self.alive:
-            try:
-                join_item: JoinItem = self.join_queue.get_nowait()
-            except Empty:
-                time.sleep(10)
-                continue
+    def setup_pipeline(self) -> Pipeline:
+        pipeline = Pipeline(self.runtime, retry_policy=self.retry_policy, dead_letters=self.dead_letters,
+                            store=self.store, logger=self.logger)
+        pipeline.add_stage(Stage("setup new auctions", self.setup_new_liquidation, workers=self.setup_concurrency,
+                                 queue=self.setup_liquidations_queue, describe=lambda x: f"vault #{x.id} {x.ilk}"))
 
-            self.logger.debug(f"start join process for auction #{join_item.liquidation_id} {join_item.ilk}")
-            try:
-                join_item.process(dss=self.dss)
-            except requests.exceptions.ReadTimeout:
-                self.join_queue.put_nowait(join_item)
-                time.sleep(5)
-                continue
-            except ContractLogicError as e:
-                self.logger.error(
-                    f"failed join process for auction #{join_item.liquidation_id} {join_item.ilk}",
-                    exc_info=e
-                )
-                continue
-            except Exception as e:
-                self.logger.error(
-                    f"failed join process for auction #{join_item.liquidation_id} {join_item.ilk}",
-                    exc_info=e
-                )
-                self.join_queue.put_nowait(join_item)
-                continue
-            self.logger.debug(f"finish join process for auction #{join_item.liquidation_id} {join_item.ilk}")
-            time.sleep(10)
+        stage = pipeline.add_stage(Stage("liquidation", self.processed_liquidation,
+                                         workers=self.liquidation_concurrency, queue=self.liquidations_queue))
+        stage = pipeline.add_stage(stage.then(Stage("exit", self.processed_exit, workers=self.exit_concurrency,
+                                                    queue=self.exit_queue)))
+        if self.make_payback is True:
+            stage = pipeline.add_stage(stage.then(Stage("payback", self.processed_payback,
+                                                        workers=self.payback_concurrency, queue=self.payback_queue)))
+            pipeline.add_stage(stage.then(Stage("join", self.processed_joined, workers=self.join_concurrency,
+                                                queue=self.join_queue)))
+        return pipeline
 
-    def processed_payback(self):
-        self.logger.info(f"Start processed payback")
-        while self.alive:
-            try:
-                payback_item: PaybackItem = self.payback_queue.get_nowait()
-            except Empty:
-                time.sleep(10)
-                continue
+    def processed_joined(self, join_item: JoinItem):
+        join_item.process(dss=self.dss)
 
-            self.logger.debug(f"start payback process for auction #{payback_item.liquidation_id} {payback_item.ilk}")
-            try:
-                payback_item.process(wagyu=self.wagyu, dss=self.dss)
-            except requests.exceptions.ReadTimeout:
-                self.payback_queue.put_nowait(payback_item)
-                time.sleep(5)
-                continue
-            except ContractLogicError as e:
-                self.logger.error(
-                    f"failed payback process for auction #{payback_item.liquidation_id} {payback_item.ilk}",
-                    exc_info=e
-                )
-                continue
-            except Exception as e:
-                self.logger.error(
-                    f"failed payback process for auction #{payback_item.liquidation_id} {payback_item.ilk}",
-                    exc_info=e
-                )
-                self.payback_queue.put_nowait(payback_item)
-                continue
+    def processed_payback(self, payback_item: PaybackItem) -> Optional[JoinItem]:
+        payback_item.process(wagyu=self.wagyu, dss=self.dss)
+        if payback_item.is_completed is not True:
+            return None
+        return JoinItem(
+            liquidation_id=payback_item.liquidation_id,
+            ilk=payback_item.ilk,
+            amount=payback_item.payback_amount,
+            take_id=payback_item.take_id,
+            sender=self.sender,
+            receipts=self.receipts,
+            ledger=self.ledger,
+            logger=self.logger
+        )
 
-            self.logger.debug(f"finish payback process for auction #{payback_item.liquidation_id} {payback_item.ilk}")
-            if payback_item.is_completed is True:
-                self.logger.debug(
-                    f"add received amount to join queue for auction #{payback_item.liquidation_id} {payback_item.ilk}")
-                self.join_queue.put_nowait(
-                    JoinItem(
-                        liquidation_id=payback_item.liquidation_id,
-                        ilk=payback_item.ilk,
-                        amount=payback_item.payback_amount,
-                        logger=self.logger
-                    )
-                )
-            time.sleep(10)
-
-    def processed_exit(self):
-        self.logger.info(f"Start processed exit")
-        while self.alive:
-            try:
-                exit_item: ExitCollateralItem = self.exit_queue.get_nowait()
-            except Empty:
-                time.sleep(10)
-                continue
-            self.logger.debug(f"start exit process for auction #{exit_item.liquidation_id} {exit_item.ilk}")
-            try:
-                exit_item.process(dss=self.dss)
-            except requests.exceptions.ReadTimeout:
-                self.exit_queue.put_nowait(exit_item)
-                time.sleep(5)
-                continue
-            except ContractLogicError as e:
-                self.logger.error(
-                    f"failed exit process for auction #{exit_item.liquidation_id} {exit_item.ilk}",
-                    exc_info=e
-                )
-                continue
-            except Exception as e:
-                self.logger.error(
-                    f"failed exit process for auction #{exit_item.liquidation_id} {exit_item.ilk}",
-                    exc_info=e
-                )
-                self.exit_queue.put_nowait(exit_item)
-                continue
-            self.logger.debug(f"finish exit process for auction #{exit_item.liquidation_id} {exit_item.ilk}")
-            if exit_item.is_completed is True:
-                self.logger.debug(
-                    f"add received amount to payback queue for auction #{exit_item.liquidation_id} {exit_item.ilk}")
-                self.payback_queue.put_nowait(
-                    PaybackItem(
-                        liquidation_id=exit_item.liquidation_id,
-                        ilk=exit_item.ilk,
-                        amount=exit_item.amount,
-                        price=exit_item.price,
-                        swap_path=exit_item.swap_path,
-                        logger=self.logger
-                    )
-                )
-            time.sleep(10)
-
-    def processed_liquidation(self):
-        self.logger.info(f"Start processed liquidation")
-        while self.alive:
-            try:
-                auction: AuctionItem = self.liquidations_queue.get_nowait()
-            except Empty:
-                time.sleep(10)
-                continue
-            self.logger.debug(f"start liquidation process for auction #{auction.liquidation_id} {auction.ilk}")
-            try:
-                auction.process(dss=self.dss, wagyu=self.wagyu)
-                self.logger.debug(f"start liquidation process for auction #{auction.liquidation_id} {auction.ilk}")
+    def processed_exit(self, exit_item: ExitCollateralItem) -> Optional[PaybackItem]:
+        exit_item.process(dss=self.dss)
+        if exit_item.is_completed is not True:
+            return None
+        return PaybackItem(
+            liquidation_id=exit_item.liquidation_id,
+            ilk=exit_item.ilk,
+            amount=exit_item.amount,
+            price=exit_item.price,
+            swap_path=exit_item.swap_path,
+            take_id=exit_item.take_id,
+            routes=self.routes,
+            sender=self.sender,
+            receipts=self.receipts,
+            logger=self.logger
+        )
 
-            except requests.exceptions.ReadTimeout:
-                self.liquidations_queue.put_nowait(auction)
-                time.sleep(5)
-                self.logger.info(f"restart liquidation process for auction #{auction.liquidation_id} {auction.ilk}")
-                continue
-            except ContractLogicError as e:
-                self.logger.error(
-                    f"failed liquidation process for auction #{auction.liquidation_id} {auction.ilk}",
-                    exc_info=e
-                )
-                continue
-            except Exception as e:
-                self.logger.error(
-                    f"failed liquidation process for auction #{auction.liquidation_id} {auction.ilk}",
-                    exc_info=e
-                )
-                self.liquidations_queue.put_nowait(auction)
-                continue
-            self.logger.debug(f"finish liquidation process for auction #{auction.liquidation_id} {auction.ilk}")
-            if auction.is_completed is True:
-                self.logger.debug(f"add received amount to exit queue for auction #{auction.liquidation_id} {auction.ilk}")
-                self.exit_queue.put_nowait(
-                    ExitCollateralItem(
-                        liquidation_id=auction.liquidation_id,
-                        ilk=auction.ilk,
-                        amount=auction.lot,
-                        price=auction.price,
-                        swap_path=auction.swap_path,
-                        logger=self.logger
-                    )
-                )
-            time.sleep(5)
-
-    def check_active_auctions(self):
+    def processed_liquidation(self, auction: AuctionItem) -> Optional[ExitCollateralItem]:
+        try:
+            auction.process(dss=self.dss, wagyu=self.wagyu)
+        finally:
+            self.liquidations_queue.release(auction)
+        if auction.is_completed is not True:
+            return None
+        return ExitCollateralItem(
+            liquidation_id=auction.liquidation_id,
+            ilk=auction.ilk,
+            amount=auction.lot,
+            price=auction.price,
+            swap_path=auction.swap_path,
+            take_id=auction.taken_tx.hex(),
+            sender=self.sender,
+            receipts=self.receipts,
+            logger=self.logger
+        )
+
+    async def check_active_auctions(self):
         self.logger.info(f"Start processed check active auctions")
+        last_block = -1
+
+        def on_error(attempt: int, e: Exception):
+            self.logger.warning(f"failed to read the active auctions (attempt {attempt} of "
+                                f"{self.retry_policy.max_attempts})", exc_info=e)
+
         while self.alive:
             try:
-                for ilk in self.dss.ilk_list:
-                    clipper = self.dss.get_ilk_clip(ilk)
-                    for liquidation_id in clipper.caller.list():
-                        self.logger.debug(f"add {liquidation_id} auction to queue for liquidation")
-                        self.liquidations_queue.put_nowait(
-                            AuctionItem(
-                                liquidation_id=liquidation_id,
-                                ilk=ilk,
-                                clipper=clipper,
-                                dss=self.dss,
-                                wagyu=self.wagyu,
-                                percent_price_delta=self.percent_price_delta,
-                                logger=self.logger
-                            )
-                        )
-                        time.sleep(5)
+                clippers, auctions = await self.retry_policy.call_async(self.read_active_auctions, on_error=on_error)
+                await self.runtime.run_blocking(self.sync_auctions, clippers, auctions)
             except Exception as e:
-                continue
-            time.sleep(30)
+                self.logger.error(f"failed to check the active auctions, they are checked again on the next block",
+                                  exc_info=e)
+            last_block = await self.runtime.wait(self.wait_for_block, last_block)
+        self.logger.info(f"Stop processed check active auctions")
 
-    def setup_new_liquidation(self):
-        self.logger.info(f"Start processed setup new auctions")
-        while self.alive:
+    async def read_active_auctions(self) -> tuple:
+        clippers = await self.runtime.run_blocking(
+            lambda: list(map(lambda x: (x, self.dss.get_ilk_clip(x)), self.dss.ilk_list)))
+        # the list() reads are sent together so that a batching provider can pack them into one request
+        auctions = await asyncio.gather(*map(lambda x: self.runtime.run_blocking(x[1].caller.list), clippers))
+        return clippers, auctions
+
+    def sync_auctions(self, clippers: list, auctions: list):
+        for (ilk, clipper), liquidation_ids in zip(clippers, auctions):
+            if liquidation_ids and self.routes is not None:
+                # read here and not by the items that sync() builds while it holds the registry lock
+                self.ilk_cache.get_gem(ilk)
             try:
-                vault: Vault = self.setup_liquidations_queue.get_nowait()
-            except Empty:
-                time.sleep(10)
+                new = self.liquidations_queue.sync(ilk, liquidation_ids, lambda x: self.new_auction(ilk, clipper, x))
+            except ValueError:
+                # not supported collateral
                 continue
+            if new:
+                self.logger.debug(f"add {new} {ilk} auctions to queue for liquidation")
 
-            try:
-                call_func = self.dss.dog.functions.bark(
-                    ilk=Converter.str_to_bytes32(vault.ilk),
-                    urn=vault.address,
-                    kpr=self.dss.account.address
-                )
-
-                tx = self.dss.call_tx(call_func)
-                self.logger.notification(f"Init auction for liquidate {vault.ilk} vault #{vault.id}"
-                                         f" ({vault.address}) tx={str(tx.hex())}")
-            except ContractLogicError as e:
-                a = e
+    def new_auction(self, ilk: str, clipper, liquidation_id: int) -> AuctionItem:
+        return AuctionItem(
+            liquidation_id=liquidation_id,
+            ilk=ilk,
+            clipper=clipper,
+            dss=self.dss,
+            wagyu=self.wagyu,
+            percent_price_delta=self.percent_price_delta,
+            ilk_cache=self.ilk_cache,
+            quotes=self.quotes,
+            routes=self.routes,
+            sender=self.sender,
+            receipts=self.receipts,
+            simulation_block=self.simulation_block,
+            ledger=self.ledger,
+            logger=self.logger
+        )
+
+    def restore(self):
+        # puts the items that were not finished before the last stop back into their stages
+        if self.store is None:
+            return
+        items = self.store.load_items()
+        for stage_name, kind, state in items:
+            stage = self.pipeline.get_stage(stage_name)
+            if stage is None:
+                self.logger.warning(f"stored {kind} item of auction #{state.get('liquidation_id')} "
+                                    f"{state.get('ilk')} has no {stage_name} stage, it is not restored")
                 continue
-            except requests.exceptions.ReadTimeout:
-                self.setup_liquidations_queue.put_nowait(vault)
+            try:
+                stage.put(self.restore_item(kind, state))
             except Exception as e:
-                self.setup_liquidations_queue.put_nowait(vault)
-                self.logger.error(f"Failed bark vault {vault.id}", exc_info=e, extra=vault.to_dict())
+                self.logger.error(f"failed to restore {kind} item of auction #{state.get('liquidation_id')} "
+                                  f"{state.get('ilk')}", exc_info=e)
+        if items:
+            self.logger.notification(f"restored {len(items)} unfinished liquidation items")
+
+    def restore_item(self, kind: str, state: dict):
+        if kind == AuctionItem.state_kind:
+            item = self.new_auction(state["ilk"], self.dss.get_ilk_clip(state["ilk"]), state["liquidation_id"])
+            item.restore(state)
+            return item
+        if kind == ExitCollateralItem.state_kind:
+            return ExitCollateralItem.from_state(state, sender=self.sender, receipts=self.receipts, logger=self.logger)
+        if kind == PaybackItem.state_kind:
+            return PaybackItem.from_state(state, routes=self.routes, sender=self.sender, receipts=self.receipts,
+                                          logger=self.logger)
+        if kind == JoinItem.state_kind:
+            return JoinItem.from_state(state, sender=self.sender, receipts=self.receipts, ledger=self.ledger,
+                                       logger=self.logger)
+        raise ValueError(f"unknown item kind {kind}")
+
+    def setup_new_liquidation(self, vault: Vault):
+        tx = None
+        try:
+            tx = self.bark(vault)
+        finally:
+            if tx is not None and self.receipts is not None:
+                # the viewers report the vault until the bark is mined, it is not barked again in the meantime
+                self.receipts.watch(tx).add_done_callback(lambda _: self.setup_liquidations_queue.release(vault))
+            else:
+                self.setup_liquidations_queue.release(vault)
+
+    def bark(self, vault: Vault) -> Optional[HexBytes]:
+        call_func = self.dss.dog.functions.bark(
+            ilk=Converter.str_to_bytes32(vault.ilk),
+            urn=vault.address,
+            kpr=self.dss.account.address
+        )
+
+        if self.simulation_block is not None:
+            simulation = simulate(call_func, sender=self.dss.account.address, block_identifier=self.simulation_block)
+            if not simulation:
+                self.logger.debug(f"vault #{vault.id} {vault.ilk} is not barked, it would fail: {simulation.error}")
+                return None
 
-            time.sleep(3)
+        try:
+            tx = send_tx(self.dss, call_func, sender=self.sender, urgency=URGENCY_BARK)
+        except ContractLogicError:
+            # the vault is already barked or safe again
+            return None
+        self.logger.notification(f"Init auction for liquidate {vault.ilk} vault #{vault.id}"
+                                 f" ({vault.address}) tx={str(tx.hex())}")
+        return tx
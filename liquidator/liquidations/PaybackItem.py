@@ -1,20 +1,35 @@
 import logging
+import uuid
 from decimal import Decimal
-from typing import List
+from typing import List, Optional, Tuple
 
+from hexbytes import HexBytes
 from velero_bot_sdk import WagyuContractConnector, DssContractsConnector
 from web3.exceptions import TimeExhausted
 
+from liquidator.receipts import ReceiptWatcher, TransactionReverted, wait_for_receipt
+from liquidator.state_store import tx_from_state, tx_to_state
+from liquidator.transactions import TransactionSender
+from liquidator.wagyu_routes import RouteFinder
+
 
 class PaybackItem:
+    state_kind = "payback"
     liquidation_id: int
     ilk: str
     amount: int
     price: int
     swap_path: List[str]
-    payback_amount: int
+    # names the take (or the batch of takes) the collateral came from
+    take_id: str
+    payback_amount: int = 0
+    pending_routes: Optional[List[Tuple[List[str], int]]] = None
+
+    swap_tx: Optional[HexBytes] = None
 
-    is_completed: bool
+    # the exited collateral is in the wallet until it is swapped, the item is never given up
+    holds_funds = True
+    is_completed: bool = False
 
     def __init__(self, liquidation_id: int, ilk: str, amount: int, price: int, swap_path: List[str], **kwargs):
         self.liquidation_id = liquidation_id
@@ -22,56 +37,98 @@ class PaybackItem:
         self.amount = amount
         self.price = price
         self.swap_path = swap_path
+        self.take_id = kwargs.get("take_id") or uuid.uuid4().hex
+        self.routes: Optional[RouteFinder] = kwargs.get("routes")
+        self.sender: Optional[TransactionSender] = kwargs.get("sender")
+        self.receipts: Optional[ReceiptWatcher] = kwargs.get("receipts")
 
         self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
 
+    @property
+    def state_key(self) -> str:
+        return f"{self.state_kind}:{self.ilk}:{self.liquidation_id}:{self.take_id}"
+
+    def to_state(self) -> dict:
+        return {"liquidation_id": self.liquidation_id, "ilk": self.ilk, "amount": self.amount, "price": self.price,
+                "swap_path": self.swap_path, "take_id": self.take_id, "payback_amount": self.payback_amount,
+                "pending_routes": self.pending_routes, "swap_tx": tx_to_state(self.swap_tx)}
+
+    @classmethod
+    def from_state(cls, state: dict, **kwargs) -> "PaybackItem":
+        item = cls(liquidation_id=state["liquidation_id"], ilk=state["ilk"], amount=state["amount"],
+                   price=state["price"], swap_path=state["swap_path"], take_id=state["take_id"], **kwargs)
+        item.payback_amount = state["payback_amount"]
+        if state["pending_routes"] is not None:
+            item.pending_routes = list(map(tuple, state["pending_routes"]))
+        item.swap_tx = tx_from_state(state["swap_tx"])
+        return item
+
     def process(self, wagyu: WagyuContractConnector, dss: DssContractsConnector):
-        try:
-            receive_amount = Decimal(self.amount) * Decimal(self.price)
+        if self.pending_routes is None:
+            self.pending_routes = [(self.swap_path, self.amount)]
+            if self.routes is not None:
+                split = self.routes.split_routes(self.swap_path[0], self.swap_path[-1], self.amount)
+                self.pending_routes = list(map(lambda x: (x.path, x.amount_in), split)) or self.pending_routes
 
-            ilk_currency = self.ilk.split('-')[0].upper()
-            if ilk_currency == "VLX":
-                tx = wagyu.swap_exact_coins_for_tokens(
-                    amount_in=Decimal(self.amount),
-                    path=self.swap_path,
-                    min_amount_out=receive_amount / Decimal(10 ** 27)
-                )
-            elif ilk_currency == "WAG":
-                tx = wagyu.swap_exact_tokens_for_tokens(
-                    amount_in=Decimal(self.amount),
-                    path=self.swap_path,
-                    min_amount_out=receive_amount / Decimal(10 ** 27)
-                )
-            else:
-                raise ValueError(f"Unsupported currency {ilk_currency}")
+        # a retry continues with the routes that are not swapped yet
+        while self.pending_routes:
+            path, amount = self.pending_routes[0]
+            self.payback_amount += self.swap(wagyu=wagyu, dss=dss, path=path, amount=amount)
+            self.pending_routes.pop(0)
 
-            self.logger.notification(
-                f"[{self.liquidation_id} {self.ilk}] swap {Decimal(self.amount) / Decimal(10 ** 18)} "
-                f"to {receive_amount / Decimal(10 ** 45)} USDV ( {str(tx.hex())} ).")
-        except Exception as e:
-            self.logger.error(f"[{self.liquidation_id} {self.ilk}] Failed swap."
-                              f" It is necessary exchange the currency manually",
-                              exc_info=e)
-            raise e
+        self.is_completed = True
 
+    def swap(self, wagyu: WagyuContractConnector, dss: DssContractsConnector, path: List[str], amount: int) -> int:
+        if self.swap_tx is None:
+            self.swap_tx = self.send_swap(wagyu=wagyu, path=path, amount=amount)
+
+        tx = self.swap_tx
         try:
-            receipt_tx = wagyu.web3.eth.wait_for_transaction_receipt(transaction_hash=tx, timeout=30)
+            receipt_tx = wait_for_receipt(wagyu.web3, tx, watcher=self.receipts)
         except TimeExhausted as e:
             self.logger.warning(f"[{self.liquidation_id} {self.ilk}] the transaction {str(tx.hex())} "
-                                f"was not confirmed within 30 seconds."
+                                f"was not confirmed in time."
                                 " Please make sure that the transaction was failed, "
                                 "otherwise it is necessary exchange "
                                 "the received collateral asset yourself", exc_info=e)
             raise e
+        except TransactionReverted as e:
+            # the price moved past the minimal output, a retry swaps the route again at the new price
+            self.swap_tx = None
+            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] {e}")
+            raise e
 
         logs = dss.usdv.events.Transfer().processReceipt(receipt_tx)
+        received = [x['wad'] for x in map(lambda x: x['args'], logs) if x['dst'] == wagyu.account.address]
+        if len(received) < 1:
+            # the swap is mined, it is not sent again: the item keeps the hash and its retries read the receipt
+            raise ValueError(f"[{self.liquidation_id} {self.ilk}] transaction {str(tx.hex())} has no Transfer() "
+                             f"event of USDV to {wagyu.account.address}")
+        self.swap_tx = None
+        return received[0]
 
-        if len(logs) < 1:
-            self.logger.warning(
-                f"[{self.liquidation_id} {self.ilk}] transaction {str(tx.hex())} has more than one Transfer() event")
-            return
-        log = next(filter(lambda x: x['dst'] == wagyu.account.address, map(lambda x: x['args'], logs)))
-        self.payback_amount = log['wad']
+    def send_swap(self, wagyu: WagyuContractConnector, path: List[str], amount: int) -> HexBytes:
+        try:
+            receive_amount = Decimal(amount) * Decimal(self.price)
 
-        self.is_completed = True
-        return receipt_tx
+            ilk_currency = self.ilk.split('-')[0].upper()
+            if ilk_currency == "VLX":
+                swap = wagyu.swap_exact_coins_for_tokens
+            else:
+                swap = wagyu.swap_exact_tokens_for_tokens
+
+            def send():
+                return swap(amount_in=Decimal(amount), path=path, min_amount_out=receive_amount / Decimal(10 ** 27))
+
+            # the SDK signs the swap itself, the sender records it at its nonce so a stuck swap is re-sent
+            tx = self.sender.send_external(send) if self.sender is not None else send()
+
+            self.logger.notification(
+                f"[{self.liquidation_id} {self.ilk}] swap {Decimal(amount) / Decimal(10 ** 18)} "
+                f"to {receive_amount / Decimal(10 ** 45)} USDV ( {str(tx.hex())} ).")
+        except Exception as e:
+            self.logger.error(f"[{self.liquidation_id} {self.ilk}] Failed swap."
+                              f" It is necessary exchange the currency manually",
+                              exc_info=e)
+            raise e
+        return tx
@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from liquidator.liquidations.AuctionItem import AuctionItem
+from liquidator.liquidations.ledger import UsdvLedger
+from liquidator.liquidations.pipeline import STOP
+
+
+# One entry per (ilk, liquidation id). An auction is either queued once or taken by a worker, putting it again in
+# the meantime is a no-op. Queued auctions are served by AuctionItem.priority: unchecked auctions first, then the
+# ones worth taking by expected profit, then the rest by the time their price reaches ours. The registry is used as
+# the queue of the liquidation stage, an auction with a scheduled take is only handed out once the take is due. A
+# queued auction is moved when sync() or put() finds its priority changed, as its price decays.
+# With a ledger, the USDV reserved for an auction is released when the auction is dropped.
+class AuctionRegistry:
+    items: Dict[Tuple[str, int], AuctionItem]
+
+    def __init__(self, ledger: UsdvLedger = None):
+        self.items = {}
+        self.ledger: Optional[UsdvLedger] = ledger
+        self._heap: List[Tuple[tuple, int, Tuple[str, int]]] = []
+        # key -> (entry id, priority) of the heap entry that is current, older entries of the key are skipped
+        self._queued: Dict[Tuple[str, int], Tuple[int, tuple]] = {}
+        self._in_flight: Set[Tuple[str, int]] = set()
+        self._control = deque()
+        self._ids = itertools.count()
+        self._condition = threading.Condition()
+
+    def __contains__(self, key: Tuple[str, int]) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def sync(self, ilk: str, liquidation_ids: Iterable[int], factory: Callable[[int], AuctionItem]) -> int:
+        # keeps the auctions of an ilk in line with clipper.list(), returns the number of new auctions
+        active = set(map(lambda x: (ilk, int(x)), liquidation_ids))
+        with self._condition:
+            for key in list(self.items):
+                # a sent take stays until its receipt is seen, it may be the take that ended the auction
+                if key[0] == ilk and key not in active and key not in self._in_flight \
+                        and self.items[key].take_tx is None:
+                    del self.items[key]
+                    self._queued.pop(key, None)
+                    if self.ledger is not None:
+                        self.ledger.release(key)
+
+            new = 0
+            for key in sorted(active):
+                if key not in self.items:
+                    self.items[key] = factory(key[1])
+                    new += 1
+                self._push(self.items[key])
+            return new
+
+    def put_nowait(self, item):
+        with self._condition:
+            if item is STOP:
+                self._control.append(item)
+                self._condition.notify()
+                return
+            self.items.setdefault(item.key, item)
+            self._push(self.items[item.key])
+
+    def put(self, item):
+        self.put_nowait(item)
+
+    def get(self):
+        with self._condition:
+            while True:
+                if self._control:
+                    return self._control.popleft()
+                timeout = None
+                while self._heap:
+                    _, entry_id, key = self._heap[0]
+                    if self._queued.get(key, (None,))[0] != entry_id:
+                        # re-prioritized or removed after it was queued
+                        heapq.heappop(self._heap)
+                        continue
+                    # a scheduled take is handed out when its price is reached
+                    timeout = self.items[key].seconds_to_take()
+                    if timeout > 0:
+                        break
+                    heapq.heappop(self._heap)
+                    del self._queued[key]
+                    self._in_flight.add(key)
+                    item = self.items[key]
+                    # the same item is handed out on every pass while the auction is active, a take completed
+                    # by the previous pass must not be exited again
+                    item.is_completed = False
+                    return item
+                self._condition.wait(timeout)
+
+    def release(self, item: AuctionItem):
+        with self._condition:
+            self._in_flight.discard(item.key)
+
+    def empty(self) -> bool:
+        with self._condition:
+            return not self._queued and not self._control
+
+    def qsize(self) -> int:
+        with self._condition:
+            return len(self._queued) + len(self._control)
+
+    def _push(self, item: AuctionItem):
+        if item.key in self._in_flight:
+            return
+        priority = item.priority
+        if item.key in self._queued and self._queued[item.key][1] == priority:
+            return
+        # a queued auction whose priority changed (its price decayed) gets a new entry in its new place
+        entry_id = next(self._ids)
+        self._queued[item.key] = (entry_id, priority)
+        heapq.heappush(self._heap, (priority, entry_id, item.key))
+        if len(self._heap) > 2 * len(self._queued) + 64:
+            # the entries that were re-prioritized are dropped before they pile up
+            self._heap = [x for x in self._heap if self._queued.get(x[2], (None,))[0] == x[1]]
+            heapq.heapify(self._heap)
+        self._condition.notify()
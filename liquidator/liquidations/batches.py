@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List
+
+from liquidator.liquidations.ExitCollateralItem import ExitCollateralItem
+from liquidator.liquidations.pipeline import STOP
+
+
+# Queue of the exit stage that groups completed takes by ilk. A group is handed out as one merged item when it has
+# max_size takes or when its first take waited `window` seconds, so a cascade of takes on one ilk costs one exit,
+# one swap and one join. Items that already sent a transaction (a retry or a wait for a receipt) are handed out
+# on their own right away.
+class CollateralBatcher:
+    window: float
+    max_size: int
+
+    def __init__(self, window: float = 5, max_size: int = 20,
+                 merge: Callable[[List[ExitCollateralItem]], ExitCollateralItem] = ExitCollateralItem.merge):
+        self.window = window
+        self.max_size = max_size
+        self.merge = merge
+        self._buckets: Dict[str, List[ExitCollateralItem]] = {}
+        self._opened_at: Dict[str, float] = {}
+        self._ready = deque()
+        self._condition = threading.Condition()
+
+    def put_nowait(self, item):
+        with self._condition:
+            if item is STOP or item.exit_tx is not None or item.is_exited:
+                self._ready.append(item)
+            else:
+                self._opened_at.setdefault(item.ilk, time.monotonic())
+                self._buckets.setdefault(item.ilk, []).append(item)
+            self._condition.notify()
+
+    def put(self, item):
+        self.put_nowait(item)
+
+    def get(self):
+        with self._condition:
+            while True:
+                if self._ready:
+                    return self._ready.popleft()
+                now = time.monotonic()
+                timeout = None
+                for ilk, bucket in self._buckets.items():
+                    wait = self._opened_at[ilk] + self.window - now
+                    if len(bucket) >= self.max_size or wait <= 0:
+                        del self._buckets[ilk], self._opened_at[ilk]
+                        return self.merge(bucket)
+                    timeout = wait if timeout is None else min(timeout, wait)
+                self._condition.wait(timeout)
+
+    def empty(self) -> bool:
+        with self._condition:
+            return not self._ready and not self._buckets
+
+    def qsize(self) -> int:
+        with self._condition:
+            return len(self._ready) + sum(map(len, self._buckets.values()))
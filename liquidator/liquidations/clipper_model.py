@@ -0,0 +1,142 @@
+import math
+from abc import ABC, abstractmethod
+from decimal import Decimal
+from typing import Optional, Tuple
+
+from web3 import Web3
+from web3.contract import Contract
+from web3.exceptions import BadFunctionCallOutput, ContractLogicError
+
+RAY = Decimal(10 ** 27)
+
+ABACUS_ABI = [
+    {"inputs": [], "name": "tau", "outputs": [{"type": "uint256"}], "stateMutability": "view", "type": "function"},
+    {"inputs": [], "name": "step", "outputs": [{"type": "uint256"}], "stateMutability": "view", "type": "function"},
+    {"inputs": [], "name": "cut", "outputs": [{"type": "uint256"}], "stateMutability": "view", "type": "function"},
+]
+
+
+# Price curves of the dss abaci, prices are in USDV (ray / 10**27) and durations in seconds since tic.
+class Abacus(ABC):
+    @abstractmethod
+    def price(self, top: Decimal, duration: int) -> Decimal:
+        pass
+
+    @abstractmethod
+    def duration_to(self, top: Decimal, price: Decimal) -> Optional[int]:
+        # the first duration at which the price is not above `price`, None if it is never reached
+        pass
+
+
+class LinearDecrease(Abacus):
+    def __init__(self, tau: int):
+        self.tau = tau
+
+    def price(self, top: Decimal, duration: int) -> Decimal:
+        if duration >= self.tau:
+            return Decimal("0")
+        return top * (self.tau - duration) / self.tau
+
+    def duration_to(self, top: Decimal, price: Decimal) -> Optional[int]:
+        if price >= top:
+            return 0
+        return math.ceil((top - max(price, Decimal("0"))) * self.tau / top)
+
+
+class StairstepExponentialDecrease(Abacus):
+    def __init__(self, step: int, cut: int):
+        self.step = step
+        self.cut = Decimal(cut) / RAY
+
+    def price(self, top: Decimal, duration: int) -> Decimal:
+        return top * self.cut ** (duration // self.step)
+
+    def duration_to(self, top: Decimal, price: Decimal) -> Optional[int]:
+        if price >= top:
+            return 0
+        if price <= 0 or self.cut >= 1 or self.step == 0:
+            return None
+        return math.ceil((price / top).ln() / self.cut.ln()) * self.step
+
+
+class ExponentialDecrease(Abacus):
+    def __init__(self, cut: int):
+        self.cut = Decimal(cut) / RAY
+
+    def price(self, top: Decimal, duration: int) -> Decimal:
+        return top * self.cut ** duration
+
+    def duration_to(self, top: Decimal, price: Decimal) -> Optional[int]:
+        if price >= top:
+            return 0
+        if price <= 0 or self.cut >= 1:
+            return None
+        return math.ceil((price / top).ln() / self.cut.ln())
+
+
+def read_abacus(web3: Web3, address: str) -> Abacus:
+    # the abaci have no type getter, the parameter set tells them apart
+    abacus = web3.eth.contract(address=address, abi=ABACUS_ABI)
+    try:
+        return LinearDecrease(tau=abacus.caller.tau())
+    except (ContractLogicError, BadFunctionCallOutput, ValueError):
+        pass
+
+    cut = abacus.caller.cut()
+    try:
+        return StairstepExponentialDecrease(step=abacus.caller.step(), cut=cut)
+    except (ContractLogicError, BadFunctionCallOutput, ValueError):
+        return ExponentialDecrease(cut=cut)
+
+
+# Local model of one Clipper auction. Clipper.getStatus computes the price from top, tic and the abacus, so after
+# one read of the sale and of the clipper parameters the price at any timestamp is known without polling.
+class AuctionModel:
+    top: Decimal
+    tic: int
+    tail: int
+    cusp: Decimal
+    abacus: Abacus
+
+    def __init__(self, top: int, tic: int, tail: int, cusp: int, abacus: Abacus):
+        self.top = Decimal(top) / RAY
+        self.tic = tic
+        self.tail = tail
+        self.cusp = Decimal(cusp) / RAY
+        self.abacus = abacus
+
+    @classmethod
+    def read(cls, clipper: Contract, liquidation_id: int) -> Optional["AuctionModel"]:
+        _, _, _, _, tic, top = clipper.caller.sales(liquidation_id)
+        if tic == 0:
+            return None
+        return cls(top=top, tic=tic, tail=clipper.caller.tail(), cusp=clipper.caller.cusp(),
+                   abacus=read_abacus(clipper.web3, clipper.caller.calc()))
+
+    def price_at(self, timestamp: float) -> Decimal:
+        return self.abacus.price(self.top, max(int(timestamp) - self.tic, 0))
+
+    def needs_redo(self, timestamp: float) -> bool:
+        # same rule as Clipper.status
+        return int(timestamp) - self.tic > self.tail or self.price_at(timestamp) < self.top * self.cusp
+
+    def time_to_price(self, price: Decimal) -> Optional[int]:
+        # timestamp from which the auction price is at most `price`, None if it restarts before that
+        duration = self.abacus.duration_to(self.top, Decimal(price))
+        if duration is None or duration > self.tail or Decimal(price) < self.top * self.cusp:
+            return None
+        return self.tic + duration
+
+
+def take_slice(amt: int, lot: int, tab: int, price: int, chost: int) -> Tuple[int, int]:
+    # collateral (wad) and USDV (rad) of Clipper.take(amt) for a sale with lot (wad), tab (rad) at price (ray)
+    slice_ = min(lot, amt)
+    owe = slice_ * price
+    if owe > tab:
+        owe = tab
+        slice_ = owe // price
+    elif owe < tab and slice_ < lot and tab - owe < chost:
+        # the rest of the tab may not be dusty, Clipper takes less instead
+        owe = tab - chost
+        slice_ = owe // price
+    return slice_, owe
@@ -1,50 +1,103 @@
 import logging
+import uuid
 from decimal import Decimal
+from typing import Optional
 
+from hexbytes import HexBytes
 from velero_bot_sdk import DssContractsConnector
 from web3.exceptions import TimeExhausted
 
+from liquidator.receipts import TransactionReverted, wait_for_receipt
+from liquidator.state_store import tx_from_state, tx_to_state
+from liquidator.transactions import send_tx
+
 
 class JoinItem:
+    state_kind = "join"
     liquidation_id: int
     ilk: str
     amount: int
     price: int
+    # names the take (or the batch of takes) the USDV came from
+    take_id: str
 
-    is_completed: bool
+    # the USDV of the swap is in the wallet until it is joined, the item is never given up
+    holds_funds = True
+    is_completed: bool = False
+    join_tx: Optional[HexBytes] = None
 
     def __init__(self, liquidation_id: int, ilk: str, amount: int, **kwargs):
         self.liquidation_id = liquidation_id
         self.ilk = ilk
         self.amount = amount
+        self.take_id = kwargs.get("take_id") or uuid.uuid4().hex
+        self.sender = kwargs.get("sender")
+        self.receipts = kwargs.get("receipts")
+        self.ledger = kwargs.get("ledger")
 
         self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
 
+    @property
+    def state_key(self) -> str:
+        return f"{self.state_kind}:{self.ilk}:{self.liquidation_id}:{self.take_id}"
+
+    def to_state(self) -> dict:
+        return {"liquidation_id": self.liquidation_id, "ilk": self.ilk, "amount": self.amount, "take_id": self.take_id,
+                "join_tx": tx_to_state(self.join_tx)}
+
+    @classmethod
+    def from_state(cls, state: dict, **kwargs) -> "JoinItem":
+        item = cls(liquidation_id=state["liquidation_id"], ilk=state["ilk"], amount=state["amount"],
+                   take_id=state["take_id"], **kwargs)
+        item.join_tx = tx_from_state(state["join_tx"])
+        return item
+
+    @property
+    def ledger_key(self):
+        return "join", self.ilk, self.liquidation_id, self.take_id
+
     def process(self, dss: DssContractsConnector):
-        try:
-            func = dss.join_main_stablecoin.functions.join(dss.account.address, self.amount)
-            tx = dss.call_tx(func)
-
-            self.logger.notification(f"[{self.liquidation_id} {self.ilk}] "
-                                     f"start join {Decimal(self.amount) / Decimal(10**18)} USDV to VAT ( {str(tx.hex())} ).")
-        except Exception as e:
-            self.logger.error(f"[{self.liquidation_id} {self.ilk}] Failed join usdv to VAT."
-                              f" It is necessary to withdraw and exchange the currency manually",
-                              exc_info=e)
-            raise e
+        if self.join_tx is None:
+            try:
+                func = dss.join_main_stablecoin.functions.join(dss.account.address, self.amount)
+                self.join_tx = send_tx(dss, func, sender=self.sender)
+                if self.ledger is not None:
+                    self.ledger.credit(self.ledger_key, self.amount * 10 ** 27)
 
+                self.logger.notification(f"[{self.liquidation_id} {self.ilk}] "
+                                         f"start join {Decimal(self.amount) / Decimal(10**18)} USDV to VAT "
+                                         f"( {str(self.join_tx.hex())} ).")
+            except Exception as e:
+                self.logger.error(f"[{self.liquidation_id} {self.ilk}] Failed join usdv to VAT."
+                                  f" It is necessary to withdraw and exchange the currency manually",
+                                  exc_info=e)
+                raise e
+
+        tx = self.join_tx
         try:
-            receipt_tx = dss.web3.eth.wait_for_transaction_receipt(transaction_hash=tx, timeout=30)
+            receipt_tx = wait_for_receipt(dss.web3, tx, watcher=self.receipts)
         except TimeExhausted as e:
             self.logger.warning(f"[{self.liquidation_id} {self.ilk}] the transaction {str(tx.hex())} "
-                                f"was not confirmed within 30 seconds. "
+                                f"was not confirmed in time. "
                                 "Please make sure that the transaction was failed, "
                                 "otherwise it is necessary to withdraw and exchange "
                                 "the received collateral asset yourself", exc_info=e)
+            if self.ledger is not None:
+                # it is in the balance once it is mined after all
+                self.ledger.drop_credit(self.ledger_key)
+            raise e
+        except TransactionReverted as e:
+            self.join_tx = None
+            if self.ledger is not None:
+                self.ledger.drop_credit(self.ledger_key)
+            self.logger.warning(f"[{self.liquidation_id} {self.ilk}] {e}")
             raise e
+        if self.ledger is not None:
+            self.ledger.confirm_credit(self.ledger_key, receipt_tx["blockNumber"])
 
         self.logger.notification(f"[{self.liquidation_id} {self.ilk}] "
-                                 f"finish join {Decimal(self.amount) / Decimal(10 ** 18)} USDV to VAT ( {str(tx.hex())} ).")
+                                 f"finish join {Decimal(self.amount) / Decimal(10 ** 18)} USDV to VAT "
+                                 f"( {str(tx.hex())} ).")
 
         self.is_completed = True
         return receipt_tx
@@ -0,0 +1,79 @@
+import threading
+from typing import Callable, Dict, Hashable, List, Tuple
+
+
+# USDV (rad) of the keeper in the Vat, shared by all take workers. The balance is read once per block, a take
+# reserves what it may spend before it is sent and settles the reservation with the owe of its receipt. Until the
+# balance is read in the block of a receipt, the settled amount is applied on top of it, so the next take neither
+# spends the same USDV twice nor waits for the next read. With credit_pending, the USDV of joins that were sent but
+# are not mined yet is available as well: with local nonces a later take is mined after the join.
+class UsdvLedger:
+    credit_pending: bool
+
+    _balance: int = 0
+    _block_number: int = -1
+
+    def __init__(self, read_balance: Callable[[], int], block_number: Callable[[], int], credit_pending: bool = False):
+        self.read_balance = read_balance
+        self.block_number = block_number
+        self.credit_pending = credit_pending
+        self.reserved: Dict[Hashable, int] = {}
+        self.pending_credits: Dict[Hashable, int] = {}
+        # (block of the receipt, amount) that the last read balance does not include yet
+        self.settled: List[Tuple[int, int]] = []
+        self._lock = threading.RLock()
+
+    def refresh(self):
+        with self._lock:
+            block_number = self.block_number()
+            if block_number <= self._block_number:
+                return
+            self._balance = self.read_balance()
+            self._block_number = block_number
+            self.settled = [x for x in self.settled if x[0] > block_number]
+
+    def available(self) -> int:
+        with self._lock:
+            self.refresh()
+            available = self._balance + sum(map(lambda x: x[1], self.settled)) - sum(self.reserved.values())
+            if self.credit_pending:
+                available += sum(self.pending_credits.values())
+            return max(available, 0)
+
+    def reserve(self, key: Hashable, amount: int) -> int:
+        # reserves up to `amount`, returns the reserved amount (0 if nothing is left)
+        with self._lock:
+            self.reserved.pop(key, None)
+            amount = min(int(amount), self.available())
+            if amount > 0:
+                self.reserved[key] = amount
+            return max(amount, 0)
+
+    def release(self, key: Hashable):
+        with self._lock:
+            self.reserved.pop(key, None)
+
+    def settle(self, key: Hashable, spent: int, block_number: int):
+        with self._lock:
+            self.reserved.pop(key, None)
+            self.add_settled(block_number, -int(spent))
+
+    def credit(self, key: Hashable, amount: int):
+        # a join was sent
+        with self._lock:
+            self.pending_credits[key] = int(amount)
+
+    def confirm_credit(self, key: Hashable, block_number: int):
+        with self._lock:
+            amount = self.pending_credits.pop(key, None)
+            if amount is not None:
+                self.add_settled(block_number, amount)
+
+    def drop_credit(self, key: Hashable):
+        with self._lock:
+            self.pending_credits.pop(key, None)
+
+    def add_settled(self, block_number: int, amount: int):
+        # a balance read in the block of the receipt or later already has it
+        if block_number > self._block_number:
+            self.settled.append((block_number, amount))
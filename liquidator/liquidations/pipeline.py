@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, wait
+from queue import Queue
+from typing import Any, Callable, Iterable, List, Optional
+
+import requests
+from web3.exceptions import ContractLogicError
+
+from liquidator.receipts import AwaitingReceipt
+from liquidator.retry import DeadLetters, RetryPolicy
+from liquidator.runtime import Runtime
+from liquidator.state_store import StateStore
+
+
+# wakes a stage that waits for an item on cancel
+STOP = object()
+
+
+def describe_auction(item) -> str:
+    return f"auction #{item.liquidation_id} {item.ilk}"
+
+
+class Stage:
+    name: str
+    queue: Queue
+    handler: Callable[[Any], Any]
+    workers: int
+    next: Optional["Stage"] = None
+
+    def __init__(self, name: str, handler: Callable[[Any], Any], workers: int = 1, queue: Queue = None,
+                 describe: Callable[[Any], str] = describe_auction):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue if queue is not None else Queue()
+        self.describe = describe
+
+    def put(self, item):
+        self.queue.put_nowait(item)
+
+    def then(self, stage: "Stage") -> "Stage":
+        self.next = stage
+        return stage
+
+
+# Runs every stage as a task of the runtime. A stage handles up to `workers` items at once on the executor of the
+# runtime, it waits for the next item only when a slot is free, so an item is picked up as soon as it is put and
+# the queue keeps its order for the items that wait. The item returned by the handler is handed to the next stage
+# right away. cancel() wakes all waiting stages, the items being processed are finished first. With a store, every
+# item that has a state_key is written with its stage whenever it moves to the next stage or waits, and deleted when
+# it is done, so the unfinished items can be put back into their stages after a restart. A failed item is put back
+# after a backoff delay of the retry policy, after max_attempts failures in a row it goes to the dead letters. An
+# item that holds funds or sent a transaction is never given up: it stays stored and is retried after max_delay.
+class Pipeline:
+    stages: List[Stage]
+
+    def __init__(self, runtime: Runtime, retry_policy: RetryPolicy = None, dead_letters: DeadLetters = None,
+                 store: StateStore = None, **kwargs):
+        self.stages = []
+        self.runtime = runtime
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.store = store
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+        self.dead_letters = dead_letters or DeadLetters(store=store, logger=self.logger)
+        self._cancelled = threading.Event()
+        self._tasks: List[Future] = []
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def add_stage(self, stage: Stage) -> Stage:
+        self.stages.append(stage)
+        return stage
+
+    def get_stage(self, name: str) -> Optional[Stage]:
+        return next(filter(lambda x: x.name == name, self.stages), None)
+
+    def start(self):
+        self._cancelled.clear()
+        self._tasks = list(map(lambda x: self.runtime.spawn(self.run_stage(x)), self.stages))
+
+    def cancel(self):
+        self._cancelled.set()
+        for stage in self.stages:
+            stage.queue.put_nowait(STOP)
+
+    def join(self):
+        wait(self._tasks)
+        self._tasks = []
+
+    async def run_stage(self, stage: Stage):
+        self.logger.info(f"Start processed {stage.name} ({stage.workers} at once)")
+        slots = asyncio.Semaphore(stage.workers)
+        running, held = set(), []
+        while True:
+            await slots.acquire()
+            item = await self.runtime.wait(stage.queue.get)
+            if item is STOP:
+                break
+            if self._cancelled.is_set():
+                # items before the STOP stay in the queue for the next start
+                held.append(item)
+                slots.release()
+                continue
+            task = asyncio.ensure_future(self.run_item(stage, item, slots))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        list(map(stage.queue.put_nowait, held))
+        if running:
+            await asyncio.wait(running)
+        self.logger.info(f"Stop processed {stage.name}")
+
+    async def run_item(self, stage: Stage, item, slots: asyncio.Semaphore):
+        try:
+            await self.runtime.run_blocking(self.process, stage, item)
+        except Exception as e:
+            self.logger.error(f"failed {stage.name} process for {stage.describe(item)}", exc_info=e)
+        finally:
+            slots.release()
+
+    def process(self, stage: Stage, item):
+        self.logger.debug(f"start {stage.name} process for {stage.describe(item)}")
+        try:
+            next_item = stage.handler(item)
+        except AwaitingReceipt as e:
+            # the worker is free until the receipt is there, then the item continues in the same stage
+            self.logger.debug(f"{stage.describe(item)} is waiting for {e.tx_hash.hex()} in {stage.name} stage")
+            self.persist(stage, item)
+            e.future.add_done_callback(lambda _: self.is_cancelled or stage.put(item))
+            return
+        except requests.exceptions.ReadTimeout as e:
+            self.logger.info(f"restart {stage.name} process for {stage.describe(item)}")
+            self.failed(stage, item, e)
+            return
+        except ContractLogicError as e:
+            self.logger.error(f"failed {stage.name} process for {stage.describe(item)}", exc_info=e)
+            if self.holds_funds(item):
+                self.failed(stage, item, e)
+            else:
+                self.forget(item)
+            return
+        except Exception as e:
+            self.logger.error(f"failed {stage.name} process for {stage.describe(item)}", exc_info=e)
+            self.failed(stage, item, e)
+            return
+        self.logger.debug(f"finish {stage.name} process for {stage.describe(item)}")
+        item.attempts = 0
+
+        if next_item is not None and stage.next is not None:
+            self.logger.debug(f"add {stage.describe(item)} to {stage.next.name} queue")
+            self.persist(stage.next, next_item, replaces=self.state_keys(item))
+            stage.next.put(next_item)
+        else:
+            self.forget(item)
+
+    @staticmethod
+    def holds_funds(item) -> bool:
+        return getattr(item, "holds_funds", False)
+
+    @staticmethod
+    def state_keys(item) -> List[str]:
+        # the key of the item and of the items merged into it
+        key = getattr(item, "state_key", None)
+        return ([key] if key is not None else []) + list(getattr(item, "replaces", []))
+
+    def persist(self, stage: Stage, item, replaces: Iterable[str] = ()):
+        key = getattr(item, "state_key", None)
+        if self.store is None or key is None:
+            return
+        try:
+            state = item.to_state()
+            replaces = list(replaces) + list(getattr(item, "replaces", []))
+            if state is None:
+                list(map(self.store.delete_item, [key] + replaces))
+            else:
+                self.store.save_item(key, stage.name, item.state_kind, state, replaces=replaces)
+        except Exception as e:
+            self.logger.error(f"failed to store {stage.describe(item)} in {stage.name} stage", exc_info=e)
+
+    def forget(self, item):
+        if self.store is None:
+            return
+        try:
+            list(map(self.store.delete_item, self.state_keys(item)))
+        except Exception as e:
+            self.logger.error(f"failed to delete the stored state of {item}", exc_info=e)
+
+    def failed(self, stage: Stage, item, error: Exception):
+        attempt = getattr(item, "attempts", 0) + 1
+        item.attempts = attempt
+        if self.retry_policy.can_retry(attempt) or self.holds_funds(item):
+            if attempt == self.retry_policy.max_attempts:
+                self.logger.notification(f"{stage.name} process for {stage.describe(item)} failed {attempt} times, "
+                                         f"it holds funds and is retried until it is done: {error!r}")
+            self.persist(stage, item)
+            self.retry(stage, item, delay=self.retry_policy.delay(attempt))
+            return
+
+        key = getattr(item, "state_key", None) or stage.describe(item)
+        state = item.to_state() if hasattr(item, "to_state") else None
+        self.dead_letters.add(kind=stage.name, key=key, description=f"{stage.name} process for {stage.describe(item)}",
+                              error=error, attempts=attempt, state=state)
+        self.forget(item)
+
+    def retry(self, stage: Stage, item, delay: float = 0):
+        if delay <= 0:
+            stage.put(item)
+            return
+        # the stage does not wait for the delay and takes the next item
+        self.runtime.call_later(delay, lambda: self.is_cancelled or stage.put(item))
@@ -0,0 +1,66 @@
+import threading
+from collections import deque
+from typing import Dict
+
+from liquidator.liquidations.pipeline import STOP
+from liquidator.vault import Vault
+
+
+# Queue of the setup stage with one entry per vault id. The viewers report an unsafe vault on every check until it is
+# barked, a vault that is queued is replaced by the newer report in its place and a vault that is being barked is
+# not queued again until release(). The item handed out by get() may be put back as it is (a retry, or an item
+# held on cancel), that puts it back in the queue.
+class UnsafeVaultQueue:
+    def __init__(self):
+        self._queue = deque()
+        self._queued: Dict[int, Vault] = {}
+        self._in_flight: Dict[int, Vault] = {}
+        self._condition = threading.Condition()
+
+    def __contains__(self, cdp_id: int) -> bool:
+        with self._condition:
+            return cdp_id in self._queued or cdp_id in self._in_flight
+
+    def put_nowait(self, item):
+        with self._condition:
+            if item is STOP:
+                self._queue.append(item)
+            elif item.id in self._queued:
+                self._queued[item.id] = item
+                return
+            elif item.id in self._in_flight:
+                if self._in_flight[item.id] is not item:
+                    return
+                del self._in_flight[item.id]
+                self._queued[item.id] = item
+                self._queue.append(item.id)
+            else:
+                self._queued[item.id] = item
+                self._queue.append(item.id)
+            self._condition.notify()
+
+    def put(self, item):
+        self.put_nowait(item)
+
+    def get(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            entry = self._queue.popleft()
+            if entry is STOP:
+                return entry
+            vault = self._in_flight[entry] = self._queued.pop(entry)
+            return vault
+
+    def release(self, vault: Vault):
+        with self._condition:
+            if self._in_flight.get(vault.id) is vault:
+                del self._in_flight[vault.id]
+
+    def empty(self) -> bool:
+        with self._condition:
+            return not self._queue
+
+    def qsize(self) -> int:
+        with self._condition:
+            return len(self._queue)
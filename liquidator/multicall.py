@@ -0,0 +1,45 @@
+from typing import Any, List, Sequence, Tuple
+
+from eth_abi import decode_abi
+from hexbytes import HexBytes
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from web3.contract import Contract, ContractFunction
+
+
+def batches(lst, size: int):
+    lst = list(lst)
+    for i in range(0, len(lst), max(size, 1)):
+        yield lst[i:i + size]
+
+
+class Call:
+    target: str
+    data: HexBytes
+    output_types: List[str]
+
+    def __init__(self, func: ContractFunction):
+        self.target = func.address
+        self.data = HexBytes(func._encode_transaction_data())
+        self.output_types = get_abi_output_types(func.abi)
+
+    def decode(self, data: bytes) -> Any:
+        if not data:
+            # the target has no code (e.g. an EOA instead of a DSProxy)
+            return None
+
+        result = map_abi_data(BASE_RETURN_NORMALIZERS, self.output_types, decode_abi(self.output_types, data))
+        return result[0] if len(result) == 1 else tuple(result)
+
+
+class Multicall:
+    multicall: Contract
+
+    def __init__(self, multicall: Contract):
+        self.multicall = multicall
+
+    def aggregate(self, calls: Sequence[Call], block_identifier="latest") -> Tuple[int, List[Any]]:
+        block_number, return_data = self.multicall.caller(block_identifier=block_identifier).aggregate(
+            [(call.target, call.data) for call in calls]
+        )
+        return block_number, [call.decode(data) for call, data in zip(calls, return_data)]
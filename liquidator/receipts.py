@@ -0,0 +1,140 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.exceptions import TimeExhausted, TransactionNotFound
+
+from liquidator.blocks import BlockNotifier
+
+
+class AwaitingReceipt(Exception):
+    # raised by an item that sent a transaction, the pipeline puts the item back when the future is done
+    def __init__(self, future: Future, tx_hash: HexBytes):
+        self.future = future
+        self.tx_hash = tx_hash
+        super().__init__(f"awaiting receipt of {tx_hash.hex()}")
+
+
+class TransactionReverted(Exception):
+    # the transaction is mined, but failed
+    def __init__(self, receipt: dict):
+        self.receipt = receipt
+        super().__init__(f"transaction {HexBytes(receipt['transactionHash']).hex()} reverted "
+                         f"in block {receipt['blockNumber']}")
+
+
+class WatchedTransaction:
+    tx_hash: HexBytes
+    future: Future
+    block_number: int
+
+    def __init__(self, tx_hash: HexBytes, block_number: int):
+        self.tx_hash = tx_hash
+        self.future = Future()
+        self.block_number = block_number
+
+
+# Looks up the receipts of all pending transactions once per block, instead of one thread blocked in
+# wait_for_transaction_receipt per transaction. The lookups of a block are sent together, so a batching provider
+# packs them into one request. A transaction that was replaced at its nonce is looked up under every hash of the
+# replacements, whichever of them is mined resolves it. A future is resolved when the receipt has `confirmations`
+# blocks, with TransactionReverted when the mined transaction failed; a transaction that is not mined within
+# `timeout_blocks` resolves with TimeExhausted, a later wait for the same hash starts over.
+class ReceiptWatcher:
+    confirmations: int
+    timeout_blocks: int
+    alive: bool = False
+
+    def __init__(self, web3: Web3, blocks: BlockNotifier, confirmations: int = 1, timeout_blocks: int = 300,
+                 replacement_chain: Callable[[HexBytes], List[HexBytes]] = None, **kwargs):
+        self.web3 = web3
+        self.blocks = blocks
+        self.confirmations = confirmations
+        self.timeout_blocks = timeout_blocks
+        # the hash and the hashes of the transactions that replaced it at the same nonce
+        self.replacement_chain = replacement_chain or (lambda x: [x])
+        self.watched: Dict[HexBytes, WatchedTransaction] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="receipts")
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def start(self):
+        self.logger.info(f"Start receipt watcher")
+        self.alive = True
+        last_block = -1
+        while self.alive:
+            last_block = self.blocks.wait_for_block(after=last_block, timeout=30)
+            if not self.alive:
+                break
+            try:
+                self.poll(last_block)
+            except Exception as e:
+                self.logger.error(f"failed to check receipts at block {last_block}", exc_info=e)
+        self._executor.shutdown(wait=False)
+        self.logger.info(f"Stop receipt watcher")
+
+    def stop(self):
+        self.alive = False
+
+    def watch(self, tx_hash: HexBytes) -> Future:
+        tx_hash = HexBytes(tx_hash)
+        with self._lock:
+            watched = self.watched.get(tx_hash)
+            if watched is None or watched.future.done():
+                watched = WatchedTransaction(tx_hash, self.blocks.block_number)
+                self.watched[tx_hash] = watched
+            return watched.future
+
+    def wait(self, tx_hash: HexBytes):
+        # the receipt if it is already confirmed, otherwise AwaitingReceipt. A resolved wait is taken out of the
+        # watched transactions before watch() would start it over
+        tx_hash = HexBytes(tx_hash)
+        with self._lock:
+            watched = self.watched.get(tx_hash)
+            if watched is not None and watched.future.done():
+                del self.watched[tx_hash]
+                return watched.future.result()
+        raise AwaitingReceipt(self.watch(tx_hash), tx_hash)
+
+    def poll(self, block_number: int):
+        with self._lock:
+            watched = [x for x in self.watched.values() if not x.future.done()]
+        if not watched:
+            return
+
+        chains = list(map(lambda x: self.replacement_chain(x.tx_hash), watched))
+        hashes = list({tx_hash for chain in chains for tx_hash in chain})
+        receipts = dict(zip(hashes, self._executor.map(self.get_receipt, hashes)))
+        for item, chain in zip(watched, chains):
+            # only one transaction of a nonce can be mined
+            receipt = next(filter(lambda x: x is not None, map(receipts.get, chain)), None)
+            if receipt is not None and block_number - receipt["blockNumber"] + 1 >= self.confirmations:
+                if receipt["status"] == 0:
+                    item.future.set_exception(TransactionReverted(receipt))
+                else:
+                    item.future.set_result(receipt)
+            elif receipt is None and block_number - item.block_number > self.timeout_blocks:
+                item.future.set_exception(TimeExhausted(
+                    f"transaction {item.tx_hash.hex()} is not in the chain after {self.timeout_blocks} blocks"))
+
+    def get_receipt(self, tx_hash: HexBytes) -> Optional[dict]:
+        try:
+            return self.web3.eth.get_transaction_receipt(tx_hash)
+        except TransactionNotFound:
+            return None
+        except Exception as e:
+            self.logger.warning(f"failed to get receipt of {tx_hash.hex()}", exc_info=e)
+            return None
+
+
+def wait_for_receipt(web3: Web3, tx_hash: HexBytes, watcher: ReceiptWatcher = None, timeout: int = 30):
+    if watcher is not None:
+        return watcher.wait(tx_hash)
+    receipt = web3.eth.wait_for_transaction_receipt(transaction_hash=tx_hash, timeout=timeout)
+    if receipt["status"] == 0:
+        raise TransactionReverted(receipt)
+    return receipt
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, Type
+
+from liquidator.state_store import StateStore
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryPolicy:
+    max_attempts: int
+    base_delay: float
+    max_delay: float
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1, max_delay: float = 60):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter, attempt counts from 1; the exponent is capped, work that is never
+        # given up is retried after max_delay at most
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** min(attempt - 1, 32)))
+
+    def can_retry(self, attempt: int) -> bool:
+        return attempt < self.max_attempts
+
+    def call(self, func: Callable[[], Any], retry_on: Tuple[Type[Exception], ...] = (Exception,),
+             on_error: Callable[[int, Exception], None] = None) -> Any:
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func()
+            except retry_on as e:
+                if on_error is not None:
+                    on_error(attempt, e)
+                if not self.can_retry(attempt):
+                    raise
+                time.sleep(self.delay(attempt))
+
+    async def call_async(self, func: Callable[[], Awaitable[Any]],
+                         retry_on: Tuple[Type[Exception], ...] = (Exception,),
+                         on_error: Callable[[int, Exception], None] = None) -> Any:
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await func()
+            except retry_on as e:
+                if on_error is not None:
+                    on_error(attempt, e)
+                if not self.can_retry(attempt):
+                    raise
+                await asyncio.sleep(self.delay(attempt))
+
+
+# Opens after failure_threshold failures in a row. While open, calls fail at once instead of waiting for a node that
+# is down; after reset_timeout one trial call is let through, its result closes or opens the breaker again.
+class CircuitBreaker:
+    failure_threshold: int
+    reset_timeout: float
+
+    _failures: int = 0
+    _opened_at: Optional[float] = None
+    _trial: bool = False
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None and (
+                self._trial or time.monotonic() - self._opened_at < self.reset_timeout)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures, self._opened_at, self._trial = 0, None, False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at, self._trial = time.monotonic(), False
+
+
+class DeadLetter:
+    kind: str
+    key: str
+    description: str
+    error: str
+    attempts: int
+    created_at: float
+
+    def __init__(self, kind: str, key: str, description: str, error: str, attempts: int, state: dict = None):
+        self.kind = kind
+        self.key = key
+        self.description = description
+        self.error = error
+        self.attempts = attempts
+        self.state = state
+        self.created_at = time.time()
+
+    def to_dict(self) -> dict:
+        return {"kind": self.kind, "key": self.key, "description": self.description, "error": self.error,
+                "attempts": self.attempts, "created_at": self.created_at, "state": self.state}
+
+    @classmethod
+    def from_dict(cls, letter: dict) -> "DeadLetter":
+        item = cls(kind=letter["kind"], key=letter["key"], description=letter["description"], error=letter["error"],
+                   attempts=letter["attempts"], state=letter["state"])
+        item.created_at = letter["created_at"]
+        return item
+
+
+# Work that failed max_attempts times. The entries are logged as notifications and, with a store, written to its
+# dead_letters table, so an operator can look them up after the bot stopped. load() logs the last of them at the
+# start.
+class DeadLetters:
+    def __init__(self, store: StateStore = None, maxlen: int = 1000, **kwargs):
+        self.store = store
+        self.letters = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def add(self, kind: str, key: str, description: str, error: Exception, attempts: int, state: dict = None):
+        letter = DeadLetter(kind=kind, key=key, description=description, error=repr(error), attempts=attempts,
+                            state=state)
+        with self._lock:
+            # work that is tried again on every pass (a vault check) is reported once
+            if any(map(lambda x: x.kind == kind and x.key == key, self.letters)):
+                self.logger.debug(f"{description} failed {attempts} times again: {letter.error}")
+                return
+            self.letters.append(letter)
+        self.logger.notification(f"{description} failed {attempts} times and is given up, "
+                                 f"it is necessary to check it manually: {letter.error}", extra=letter.to_dict())
+        if self.store is not None:
+            try:
+                self.store.save_dead_letter(letter.to_dict())
+            except Exception as e:
+                self.logger.error(f"failed to store the dead letter of {description}", exc_info=e)
+
+    def load(self, limit: int = 20) -> List[DeadLetter]:
+        # the letters of the previous runs are logged at the start, they are not reported again
+        if self.store is None:
+            return []
+        letters = list(map(DeadLetter.from_dict, reversed(self.store.load_dead_letters(limit))))
+        with self._lock:
+            self.letters.extend(letters)
+        if letters:
+            self.logger.warning(f"the last {len(letters)} given up steps of the dead_letters table of "
+                                f"{self.store.path}:")
+        for letter in letters:
+            self.logger.warning(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(letter.created_at))} "
+                                f"{letter.description} failed {letter.attempts} times: {letter.error}")
+        return letters
+
+    def items(self) -> List[DeadLetter]:
+        with self._lock:
+            return list(self.letters)
+
+    def __len__(self) -> int:
+        return len(self.letters)
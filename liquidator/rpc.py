@@ -0,0 +1,340 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from typing import Any, List, Optional, Tuple
+
+import aiohttp
+from hexbytes import HexBytes
+from web3 import HTTPProvider
+from web3._utils.encoding import FriendlyJsonSerde, Web3JsonEncoder
+from web3._utils.request import make_post_request
+from web3.types import RPCEndpoint, RPCResponse
+
+from liquidator.multicall import Call
+from liquidator.retry import CircuitBreaker, CircuitOpenError
+
+
+class RpcError(Exception):
+    def __init__(self, error: dict):
+        self.code = error.get("code")
+        self.data = error.get("data")
+        super().__init__(f"{error.get('message')} (code={self.code})")
+
+
+class AsyncRpcClient:
+    rpc_url: str
+    concurrency: int
+    timeout: int
+
+    _session: Optional[aiohttp.ClientSession] = None
+    _semaphore: Optional[asyncio.Semaphore] = None
+
+    def __init__(self, rpc_url: str, concurrency: int = 200, timeout: int = 10):
+        self.rpc_url = rpc_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+
+    async def open(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request(self, method: str, params: List[Any]) -> Any:
+        await self.open()
+        payload = {"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params}
+        async with self._semaphore:
+            async with self._session.post(self.rpc_url, json=payload) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+
+        if "error" in data:
+            raise RpcError(data["error"])
+        return data["result"]
+
+    async def eth_call(self, call: Call, block_identifier="latest") -> Any:
+        if isinstance(block_identifier, int):
+            block_identifier = hex(block_identifier)
+        result = await self.request("eth_call", [{"to": call.target, "data": call.data.hex()}, block_identifier])
+        return call.decode(HexBytes(result))
+
+    async def block_number(self) -> int:
+        return int(await self.request("eth_blockNumber", []), 16)
+
+
+class BatchingHTTPProvider(HTTPProvider):
+    batched_methods = {
+        "eth_call",
+        "eth_getBalance",
+        "eth_getCode",
+        "eth_getStorageAt",
+        "eth_blockNumber",
+        "eth_getTransactionReceipt",
+    }
+
+    batch_window: float
+    max_batch_size: int
+
+    def __init__(self, endpoint_uri: str, request_kwargs: dict = None, batch_window: float = 0.01,
+                 max_batch_size: int = 100):
+        super().__init__(endpoint_uri=endpoint_uri, request_kwargs=request_kwargs)
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[dict, Future]] = []
+        self._timer: Optional[threading.Timer] = None
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        if method not in self.batched_methods:
+            return super().make_request(method, params)
+
+        future = Future()
+        request = {"jsonrpc": "2.0", "method": method, "params": params or [], "id": next(self._ids)}
+        with self._lock:
+            self._pending.append((request, future))
+            if len(self._pending) >= self.max_batch_size:
+                batch = self._take_pending()
+            else:
+                batch = []
+                if self._timer is None:
+                    self._timer = threading.Timer(self.batch_window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if batch:
+            self._send_batch(batch)
+        return future.result()
+
+    def flush(self):
+        with self._lock:
+            batch = self._take_pending()
+        if batch:
+            self._send_batch(batch)
+
+    def _take_pending(self) -> List[Tuple[dict, Future]]:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _send_batch(self, batch: List[Tuple[dict, Future]]):
+        self.logger.debug(f"Making batch request HTTP. URI: {self.endpoint_uri}, Size: {len(batch)}")
+        try:
+            request_data = FriendlyJsonSerde().json_encode([x[0] for x in batch], cls=Web3JsonEncoder)
+            raw_response = make_post_request(self.endpoint_uri, request_data.encode(), **self.get_request_kwargs())
+            responses = json.loads(raw_response)
+            if isinstance(responses, dict):
+                # the node rejected the whole batch
+                responses = [dict(responses, id=request["id"]) for request, _ in batch]
+            responses = {response.get("id"): response for response in responses}
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for request, future in batch:
+            response = responses.get(request["id"])
+            if response is None:
+                future.set_result({"id": request["id"], "jsonrpc": "2.0",
+                                   "error": {"code": -32603, "message": "missing response in batch"}})
+            else:
+                future.set_result(response)
+
+
+class Endpoint:
+    provider: HTTPProvider
+    max_age: float
+    # block number of the last eth_blockNumber answer of the node
+    head: Optional[int] = None
+
+    def __init__(self, provider: HTTPProvider, window: int = 200, breaker: CircuitBreaker = None,
+                 max_age: float = 300):
+        self.provider = provider
+        self.breaker = breaker or CircuitBreaker()
+        self.max_age = max_age
+        # (recorded_at, latency, failed) of the last requests
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def uri(self) -> str:
+        return self.provider.endpoint_uri
+
+    def record(self, latency: float, failed: bool):
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        with self._lock:
+            self.samples.append((time.monotonic(), latency, failed))
+
+    def recent(self) -> List[Tuple[float, float, bool]]:
+        # samples older than max_age are dropped, so the failures of a node that is no longer used expire
+        with self._lock:
+            expired_at = time.monotonic() - self.max_age
+            while self.samples and self.samples[0][0] < expired_at:
+                self.samples.popleft()
+            return list(self.samples)
+
+    @property
+    def error_rate(self) -> float:
+        samples = self.recent()
+        return sum(map(lambda x: x[2], samples)) / len(samples) if samples else 0
+
+    def latency(self, percentile: float = 0.5) -> float:
+        latencies = sorted(map(lambda x: x[1], filter(lambda x: not x[2], self.recent())))
+        if not latencies:
+            return 0
+        return latencies[min(int(len(latencies) * percentile), len(latencies) - 1)]
+
+    def score(self) -> float:
+        # lower is better, an endpoint without samples is tried first so that it gets some
+        return self.latency() * (1 + 10 * self.error_rate)
+
+
+# Provider over several RPC nodes. Every request records the latency and the failures (timeouts, connection and HTTP
+# errors, not JSON-RPC errors) of its node, reads go to the node with the best score and fail over to the next one.
+# Reads of hedged_methods are hedged: when the first node has not answered within its p95 latency, the same request
+# is sent to the second node and the first answer is used. Raw transactions are broadcast to all nodes. Every node has
+# a circuit breaker: a node that keeps failing gets no requests until its reset timeout, when all nodes are open the
+# requests fail at once with CircuitOpenError instead of piling up on a node that is down. The samples of a node
+# expire after health_max_age seconds and every probe_interval seconds all nodes are asked for their block number, so
+# a node that was ranked last gets new samples and can recover. A node more than max_block_lag blocks behind the
+# highest known head gets no reads.
+class PooledHTTPProvider(HTTPProvider):
+    hedged_methods = {
+        "eth_call",
+        "eth_blockNumber",
+        "eth_getTransactionReceipt",
+        "eth_getBlockByNumber",
+    }
+    broadcast_methods = {
+        "eth_sendRawTransaction",
+    }
+
+    hedge: bool
+    min_hedge_delay: float
+    max_error_rate: float
+    max_block_lag: int
+    probe_interval: float
+
+    _probed_at: float = 0
+
+    def __init__(self, providers: List[HTTPProvider], hedge: bool = True, min_hedge_delay: float = 0.05,
+                 max_error_rate: float = 0.5, breaker_threshold: int = 5, breaker_timeout: float = 30,
+                 max_block_lag: int = 3, health_max_age: float = 300, probe_interval: float = 10):
+        super().__init__(endpoint_uri=providers[0].endpoint_uri)
+        self.endpoints = list(map(lambda x: Endpoint(x, breaker=CircuitBreaker(breaker_threshold, breaker_timeout),
+                                                     max_age=health_max_age),
+                                  providers))
+        self.hedge = hedge
+        self.min_hedge_delay = min_hedge_delay
+        self.max_error_rate = max_error_rate
+        self.max_block_lag = max_block_lag
+        self.probe_interval = probe_interval
+        self._probe_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="rpc_pool")
+
+    def ranked(self) -> List[Endpoint]:
+        self.probe_if_due()
+        # nodes behind the best head are left out, the node with the best head is always kept
+        heads = [x.head for x in self.endpoints if x.head is not None]
+        best = max(heads, default=None)
+        endpoints = [x for x in self.endpoints if best is None or x.head is None or best - x.head <= self.max_block_lag]
+        # unhealthy nodes are only used when no other node is left
+        return sorted(endpoints, key=lambda x: (x.breaker.is_open, x.error_rate > self.max_error_rate, x.score()))
+
+    def probe_if_due(self):
+        if self.probe_interval <= 0:
+            return
+        with self._probe_lock:
+            if time.monotonic() - self._probed_at < self.probe_interval:
+                return
+            self._probed_at = time.monotonic()
+        list(map(lambda x: self._executor.submit(self.probe, x), self.endpoints))
+
+    def probe(self, endpoint: Endpoint):
+        try:
+            self.request(endpoint, RPCEndpoint("eth_blockNumber"), [])
+        except Exception as e:
+            # recorded by request(), an open breaker lets the probe through once its reset timeout is over
+            self.logger.debug(f"probe of {endpoint.uri} failed: {e}")
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        if method in self.broadcast_methods and len(self.endpoints) > 1:
+            return self.broadcast(method, params)
+
+        endpoints = self.ranked()
+        if self.hedge and method in self.hedged_methods and len(endpoints) > 1:
+            return self.hedged_request(endpoints, method, params)
+
+        error = None
+        for endpoint in endpoints:
+            try:
+                return self.request(endpoint, method, params)
+            except Exception as e:
+                error = e
+        raise error
+
+    def request(self, endpoint: Endpoint, method: RPCEndpoint, params: Any) -> RPCResponse:
+        if not endpoint.breaker.allow():
+            raise CircuitOpenError(f"{endpoint.uri} is failing, no requests until its circuit breaker resets")
+        started_at = time.monotonic()
+        try:
+            response = endpoint.provider.make_request(method, params)
+        except Exception:
+            endpoint.record(time.monotonic() - started_at, failed=True)
+            raise
+        endpoint.record(time.monotonic() - started_at, failed=False)
+        if method == "eth_blockNumber" and response.get("result") is not None:
+            endpoint.head = int(response["result"], 16)
+        return response
+
+    def hedged_request(self, endpoints: List[Endpoint], method: RPCEndpoint, params: Any) -> RPCResponse:
+        pending = {self._executor.submit(self.request, endpoints[0], method, params)}
+        waiting = list(endpoints[1:])
+        delay = max(endpoints[0].latency(0.95), self.min_hedge_delay)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=delay if waiting else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if waiting and (not done or not pending):
+                # the first node is slow or failed, the next one gets the same request
+                pending.add(self._executor.submit(self.request, waiting.pop(0), method, params))
+        raise error
+
+    def broadcast(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        futures = list(map(lambda x: self._executor.submit(self.request, x, method, params), self.endpoints))
+        responses, error = [], None
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            response = future.result()
+            if "error" not in response:
+                # other nodes may answer "already known", the first accepted broadcast is enough
+                return response
+            responses.append(response)
+        if responses:
+            return responses[0]
+        raise error
+
+    def isConnected(self) -> bool:
+        return any(map(lambda x: x.provider.isConnected(), self.endpoints))
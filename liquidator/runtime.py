@@ -0,0 +1,65 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+
+# One event loop for the long-lived tasks of the bot: the pipeline stages, the auction checker and the vault scans.
+# The SDK and web3 calls block, they run on a bounded executor, so the number of threads does not grow with the
+# number of auctions or vaults. Waits that only block (a stage queue, the next block) run on a separate executor and
+# never take an executor slot from the calls. Other threads hand coroutines to the loop with spawn() and run().
+class Runtime:
+    executor_workers: int
+    alive: bool = False
+
+    def __init__(self, executor_workers: int = 32, **kwargs):
+        self.executor_workers = executor_workers
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix="runtime")
+        self.waiters = ThreadPoolExecutor(max_workers=32, thread_name_prefix="runtime_wait")
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def start(self):
+        self.logger.info(f"Start runtime with {self.executor_workers} executor threads")
+        self.alive = True
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            list(map(lambda x: x.cancel(), tasks))
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+            self.executor.shutdown(wait=False)
+            self.waiters.shutdown(wait=False)
+        self.logger.info(f"Stop runtime")
+
+    def start_thread(self, name: str = "runtime_thread") -> threading.Thread:
+        thread = threading.Thread(target=self.start, name=name)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.alive = False
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def spawn(self, coroutine: Awaitable) -> Future:
+        # from any thread, the task starts as soon as the loop runs
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine: Awaitable) -> Any:
+        # from a thread that is not the loop thread, blocks until the coroutine is done
+        return self.spawn(coroutine).result()
+
+    def call_later(self, delay: float, func: Callable[[], Any]):
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, func)
+
+    async def run_blocking(self, func: Callable, *args) -> Any:
+        return await self.loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def wait(self, func: Callable, *args) -> Any:
+        return await self.loop.run_in_executor(self.waiters, functools.partial(func, *args))
@@ -0,0 +1,108 @@
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Set
+
+from liquidator.vault import MIN_LIQUIDITY
+from liquidator.vault_store import VaultRow
+
+
+class ScanTier:
+    name: str
+    margin: Optional[Decimal]
+    interval: int
+
+    def __init__(self, name: str, margin: Optional[Decimal], interval: int):
+        # margin is the distance to MIN_LIQUIDITY in percent, None for the last tier
+        self.name = name
+        self.margin = margin
+        self.interval = interval
+
+    @property
+    def max_liquidity(self) -> Optional[Decimal]:
+        if self.margin is None:
+            return None
+        return MIN_LIQUIDITY * (1 + Decimal(self.margin) / 100)
+
+
+class ScheduledVault:
+    row: VaultRow
+    liquidity: Decimal = Decimal("0")
+    price: Decimal = Decimal("0")
+    rate: int = 0
+    checked_block: int = -1
+
+    def __init__(self, row: VaultRow):
+        self.row = row
+
+    def estimate_liquidity(self, price: Decimal, rate: int) -> Optional[Decimal]:
+        # liquidity is linear in the price and in the inverse of the debt, so a price or rate change since the last
+        # check can be applied without reading the vault again
+        if self.liquidity <= 0 or self.price <= 0 or rate <= 0:
+            return None
+        return self.liquidity * Decimal(price) / self.price * Decimal(self.rate) / Decimal(rate)
+
+
+# Sorts vaults into tiers by their distance to liquidation. Every tier has its own re-check interval in blocks, so
+# vaults close to MIN_LIQUIDITY are re-read on every block and comfortable vaults only rarely or when an event
+# touches them. The distance is re-estimated from the current ilk price and rate before every pass, so a price
+# drop moves a vault into a hotter tier without any vault reads.
+class TieredScheduler:
+    tiers: List[ScanTier]
+    vaults: Dict[int, ScheduledVault]
+
+    def __init__(self, tiers: List[ScanTier]):
+        self.tiers = sorted(tiers, key=lambda x: (x.margin is None, x.margin or 0))
+        self.vaults = {}
+        self._urns: Dict[tuple, int] = {}
+        self._changed: Set[int] = set()
+
+    def __contains__(self, cdp_id: int) -> bool:
+        return cdp_id in self.vaults
+
+    def __len__(self) -> int:
+        return len(self.vaults)
+
+    @property
+    def last_id(self) -> int:
+        return max(self.vaults, default=0)
+
+    def add(self, row: VaultRow):
+        self.vaults[row.id] = ScheduledVault(row)
+        self._urns[(row.ilk, row.address)] = row.id
+
+    def get_id(self, ilk: str, urn_address: str) -> Optional[int]:
+        return self._urns.get((ilk, urn_address))
+
+    def mark_changed(self, ids: Iterable[int]):
+        self._changed |= set(filter(lambda x: x in self.vaults, ids))
+
+    def update(self, cdp_id: int, liquidity: Decimal, price: Decimal, rate: int, block_number: int):
+        vault = self.vaults[cdp_id]
+        vault.liquidity = liquidity
+        vault.price = Decimal(price)
+        vault.rate = rate
+        vault.checked_block = block_number
+        self._changed.discard(cdp_id)
+
+    def tier(self, vault: ScheduledVault, price: Decimal, rate: int) -> ScanTier:
+        if vault.checked_block < 0:
+            return self.tiers[0]
+
+        liquidity = vault.estimate_liquidity(price=price, rate=rate)
+        for tier in self.tiers:
+            if tier.max_liquidity is None or (liquidity is not None and liquidity < tier.max_liquidity):
+                return tier
+        return self.tiers[-1]
+
+    def due(self, block_number: int, prices: Dict[str, Decimal], rates: Dict[str, int]) -> List[int]:
+        result = []
+        for cdp_id, vault in self.vaults.items():
+            tier = self.tier(vault, price=prices[vault.row.ilk], rate=rates[vault.row.ilk])
+            if cdp_id in self._changed or block_number - vault.checked_block >= tier.interval:
+                result.append(cdp_id)
+        return result
+
+    def tier_sizes(self, prices: Dict[str, Decimal], rates: Dict[str, int]) -> Dict[str, int]:
+        sizes = dict.fromkeys(map(lambda x: x.name, self.tiers), 0)
+        for vault in self.vaults.values():
+            sizes[self.tier(vault, price=prices[vault.row.ilk], rate=rates[vault.row.ilk]).name] += 1
+        return sizes
@@ -0,0 +1,264 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from queue import Empty, Queue
+from typing import List, Optional
+
+from liquidator.vault import Vault
+
+SHARD_BY_ID = "id"
+SHARD_BY_ILK = "ilk"
+
+
+class NotLeaderError(Exception):
+    pass
+
+
+# One part of the vault scan. By id the vaults are split into ranges of range_size ids that are dealt to the shards
+# in turn, so every shard gets its part of the new vaults and a Multicall batch still reads neighbouring ids. By ilk
+# every ilk belongs to one shard (crc32 of its name), the vaults of an ilk are read together with its price and rate.
+class Shard:
+    index: int
+    count: int
+    by: str
+    range_size: int
+
+    def __init__(self, index: int = 0, count: int = 1, by: str = SHARD_BY_ID, range_size: int = 1000):
+        if not 0 <= index < count:
+            raise ValueError(f"shard index {index} is not in [0, {count})")
+        if by not in (SHARD_BY_ID, SHARD_BY_ILK):
+            raise ValueError(f"unknown shard key {by}")
+        self.index = index
+        self.count = count
+        self.by = by
+        self.range_size = max(range_size, 1)
+
+    def __repr__(self):
+        return f"Shard({self.index + 1} of {self.count} by {self.by})"
+
+    @property
+    def is_whole(self) -> bool:
+        return self.count == 1
+
+    def owns(self, cdp_id: int, ilk: str = None) -> bool:
+        if self.count == 1:
+            return True
+        if self.by == SHARD_BY_ILK:
+            return zlib.crc32(ilk.encode()) % self.count == self.index
+        return (cdp_id - 1) // self.range_size % self.count == self.index
+
+    def split(self, n: int) -> List["Shard"]:
+        # the shards of n processes of this instance, instances with the same n together cover all vaults
+        return list(map(lambda x: Shard(self.index * n + x, self.count * n, by=self.by, range_size=self.range_size),
+                        range(n)))
+
+    def store_path(self, path: str) -> str:
+        # every shard keeps its part of the vaults in its own file, they are synced to different blocks
+        if not path or self.count == 1:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.shard-{self.index}-of-{self.count}{ext}"
+
+
+# Lease in a file that is shared by all instances (a volume of the containers or a local path). The holder renews it
+# every ttl / 3 seconds under an exclusive flock, another instance takes it over once it has not been renewed for ttl
+# seconds. The holder counts itself the leader only while more than ttl / 3 seconds of the lease are left, so it
+# stops sending before the lease can pass to another instance. The instances must share a clock (one host).
+class LeaderLease:
+    path: str
+    ttl: float
+    instance_id: str
+    alive: bool = False
+
+    _expires_at: float = 0
+
+    def __init__(self, path: str, ttl: float = 15, instance_id: str = None, **kwargs):
+        self.path = path
+        self.ttl = ttl
+        self.instance_id = instance_id or f"{socket.gethostname()}-{os.getpid()}"
+        self._changed = threading.Condition()
+        self._stopped = threading.Event()
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    @property
+    def is_leader(self) -> bool:
+        return time.time() < self._expires_at - self.ttl / 3
+
+    def start(self):
+        self.logger.info(f"Start leader election as {self.instance_id}")
+        self.alive = True
+        self._stopped.clear()
+        while self.alive:
+            was_leader = self.is_leader
+            try:
+                self.try_acquire()
+            except Exception as e:
+                self.logger.error(f"failed to renew the leader lease {self.path}", exc_info=e)
+            if self.is_leader != was_leader:
+                self.logger.notification(f"{self.instance_id} is {'elected' if self.is_leader else 'no longer'} "
+                                         f"the leader")
+                with self._changed:
+                    self._changed.notify_all()
+            self._stopped.wait(self.ttl / 3)
+        self.release()
+        self.logger.info(f"Stop leader election")
+
+    def stop(self):
+        self.alive = False
+        self._stopped.set()
+        with self._changed:
+            self._changed.notify_all()
+
+    def wait(self, leader: bool, timeout: float = None) -> bool:
+        # waits until this instance is (or is no longer) the leader, False when it is stopped or the timeout is over
+        with self._changed:
+            self._changed.wait_for(lambda: self.is_leader == leader or self._stopped.is_set(), timeout)
+        return not self._stopped.is_set() and self.is_leader == leader
+
+    def try_acquire(self) -> bool:
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                lease = self._parse(f.read())
+                now = time.time()
+                if lease is not None and lease["owner"] != self.instance_id and lease["expires_at"] > now:
+                    self._expires_at = 0
+                    return False
+                expires_at = now + self.ttl
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps({"owner": self.instance_id, "expires_at": expires_at}))
+                f.flush()
+                os.fsync(f.fileno())
+                self._expires_at = expires_at
+                return True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def release(self):
+        if self._expires_at == 0:
+            return
+        self._expires_at = 0
+        try:
+            with open(self.path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    lease = self._parse(f.read())
+                    if lease is not None and lease["owner"] == self.instance_id:
+                        f.seek(0)
+                        f.truncate()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except Exception as e:
+            self.logger.error(f"failed to release the leader lease {self.path}", exc_info=e)
+
+    @staticmethod
+    def _parse(content: str) -> Optional[dict]:
+        try:
+            return json.loads(content) if content else None
+        except ValueError:
+            return None
+
+
+# Unsafe vaults found by instances that are not the leader, in a SQLite file next to the lease. A vault reported
+# again before the leader took it replaces the previous report. The vaults are stored as JSON, a row that is not a
+# vault is dropped.
+class VaultInbox:
+    def __init__(self, path: str, **kwargs):
+        self.path = path
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS inbox "
+                                 "(cdp_id INTEGER PRIMARY KEY, vault BLOB NOT NULL, reported_at REAL NOT NULL)")
+        self._lock = threading.Lock()
+
+    def put(self, vault: Vault):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO inbox (cdp_id, vault, reported_at) VALUES (?, ?, ?)",
+                                     (vault.id, json.dumps(vault.to_serializable_dict()), time.time()))
+
+    def take(self, limit: int = 1000) -> List[Vault]:
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute("SELECT cdp_id, vault FROM inbox ORDER BY reported_at LIMIT ?",
+                                                (limit,)).fetchall()
+                self._connection.executemany("DELETE FROM inbox WHERE cdp_id = ?", map(lambda x: (x[0],), rows))
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+        return list(filter(None, map(self._parse, rows)))
+
+    def _parse(self, row: tuple) -> Optional[Vault]:
+        try:
+            return Vault.from_serializable_dict(json.loads(row[1]))
+        except (ValueError, TypeError, UnicodeDecodeError, ArithmeticError) as e:
+            self.logger.warning(f"dropped inbox entry of vault #{row[0]} that is not a vault: {e}")
+            return None
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# Queue of the viewers of a sharded instance. Unsafe vaults go to the liquidation queue while this instance is the
+# leader (or when there is no election) and to the inbox of the leader otherwise. start() moves the vaults of the
+# viewer processes of this instance and, on the leader, the vaults of the other instances to their queue.
+class ShardRouter:
+    poll_interval: float
+    alive: bool = False
+
+    _inbox_read_at: float = 0
+
+    def __init__(self, queue: Queue, lease: LeaderLease = None, inbox: VaultInbox = None,
+                 processes_queue=None, poll_interval: float = 1, **kwargs):
+        self.queue = queue
+        self.lease = lease
+        self.inbox = inbox
+        self.processes_queue = processes_queue
+        self.poll_interval = poll_interval
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def put(self, vault: Vault):
+        if self.lease is None or self.lease.is_leader or self.inbox is None:
+            self.queue.put(vault)
+        else:
+            self.inbox.put(vault)
+
+    def start(self):
+        self.alive = True
+        while self.alive:
+            try:
+                self.forward()
+            except Exception as e:
+                self.logger.error(f"failed to forward unsafe vaults", exc_info=e)
+                time.sleep(self.poll_interval)
+
+    def stop(self):
+        self.alive = False
+
+    def forward(self):
+        if self.processes_queue is not None:
+            try:
+                self.put(self.processes_queue.get(timeout=self.poll_interval))
+            except Empty:
+                pass
+        else:
+            time.sleep(self.poll_interval)
+        if self.inbox is None or self.lease is None or not self.lease.is_leader:
+            return
+        if time.monotonic() - self._inbox_read_at >= self.poll_interval:
+            self._inbox_read_at = time.monotonic()
+            list(map(self.queue.put, self.inbox.take()))
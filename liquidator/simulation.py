@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Sequence
+
+from web3.contract import ContractFunction
+from web3.exceptions import ContractLogicError
+
+# shared by all simulations, the calls of a take are sent at once without new threads per take
+_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="simulation")
+
+
+class Simulation:
+    success: bool
+    result: Any
+    error: Optional[str]
+
+    def __init__(self, success: bool, result: Any = None, error: str = None):
+        self.success = success
+        self.result = result
+        self.error = error
+
+    def __bool__(self):
+        return self.success
+
+
+# eth_call of a transaction before it is signed. The call is made from the account that would send the transaction
+# against the pending state by default, so a bark or take that somebody else already made reverts here instead of
+# on chain. Several calls are sent at once so that a batching provider packs them into one request.
+def simulate(func: ContractFunction, sender: str, block_identifier="pending") -> Simulation:
+    try:
+        return Simulation(True, func.call({"from": sender}, block_identifier=block_identifier))
+    except ContractLogicError as e:
+        return Simulation(False, error=str(e))
+    except ValueError as e:
+        # some nodes report a revert as a JSON-RPC error
+        if "revert" not in str(e).lower():
+            raise
+        return Simulation(False, error=str(e))
+
+
+def simulate_many(funcs: Sequence[ContractFunction], sender: str, block_identifier="pending") -> List[Simulation]:
+    if not funcs:
+        return []
+    return list(_executor.map(lambda x: simulate(x, sender, block_identifier), funcs))
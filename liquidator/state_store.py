@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from hexbytes import HexBytes
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vaults (
+    id INTEGER PRIMARY KEY,
+    address TEXT NOT NULL,
+    ilk TEXT NOT NULL,
+    owner_proxy TEXT NOT NULL,
+    owner TEXT,
+    ink TEXT NOT NULL,
+    art TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS items (
+    key TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    description TEXT NOT NULL,
+    error TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    state TEXT,
+    created_at REAL NOT NULL
+);
+"""
+
+# (id, address, ilk, owner_proxy, owner, ink, art)
+VaultTuple = Tuple[int, str, str, str, Optional[str], int, int]
+
+
+def tx_to_state(tx_hash: Optional[HexBytes]) -> Optional[str]:
+    return HexBytes(tx_hash).hex() if tx_hash is not None else None
+
+
+def tx_from_state(value: Optional[str]) -> Optional[HexBytes]:
+    return HexBytes(value) if value is not None else None
+
+
+# On-disk state for warm restarts: the vault index with the last synced block, and every pipeline item that is
+# between two stages or waits for a transaction. SQLite in WAL mode, so the writes of the worker threads do not block
+# each other's reads and a crash loses at most the last transaction. ink and art are uint256 and kept as text.
+# Work that was given up after all retries is kept in dead_letters for the operator.
+class StateStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_block(self, key: str) -> Optional[int]:
+        value = self.get_meta(key)
+        return int(value) if value is not None else None
+
+    def save_vaults(self, vaults: Iterable[VaultTuple], block_key: str = None, block_number: int = None):
+        # the vaults and the block they are synced to are written in one transaction
+        rows = list(map(lambda x: (*x[:5], str(x[5]), str(x[6])), vaults))
+        with self._lock:
+            with self._transaction():
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO vaults (id, address, ilk, owner_proxy, owner, ink, art) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                if block_key is not None and block_number is not None:
+                    self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                             (block_key, str(block_number)))
+
+    def load_vaults(self) -> List[VaultTuple]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, address, ilk, owner_proxy, owner, ink, art FROM vaults ORDER BY id").fetchall()
+        return list(map(lambda x: (*x[:5], int(x[5]), int(x[6])), rows))
+
+    def save_item(self, key: str, stage: str, kind: str, state: dict, replaces: Iterable[str] = ()):
+        with self._lock:
+            with self._transaction():
+                self._connection.executemany("DELETE FROM items WHERE key = ?", map(lambda x: (x,), replaces))
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO items (key, stage, kind, state, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, stage, kind, json.dumps(state), time.time()))
+
+    def delete_item(self, key: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM items WHERE key = ?", (key,))
+
+    def load_items(self) -> List[Tuple[str, str, dict]]:
+        # (stage, kind, state) of the unfinished items, oldest first
+        with self._lock:
+            rows = self._connection.execute("SELECT stage, kind, state FROM items ORDER BY updated_at").fetchall()
+        return list(map(lambda x: (x[0], x[1], json.loads(x[2])), rows))
+
+    def save_dead_letter(self, letter: dict):
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO dead_letters (kind, key, description, error, attempts, state, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (letter["kind"], letter["key"], letter["description"], letter["error"], letter["attempts"],
+                 json.dumps(letter["state"]) if letter["state"] is not None else None, letter["created_at"]))
+
+    def load_dead_letters(self, limit: int = 100) -> List[dict]:
+        # the latest first
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT kind, key, description, error, attempts, state, created_at FROM dead_letters "
+                "ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return list(map(lambda x: {"kind": x[0], "key": x[1], "description": x[2], "error": x[3], "attempts": x[4],
+                                   "state": json.loads(x[5]) if x[5] is not None else None, "created_at": x[6]},
+                        rows))
+
+    def _transaction(self):
+        return _Transaction(self._connection)
+
+
+class _Transaction:
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute("BEGIN")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute("ROLLBACK" if exc_type is not None else "COMMIT")
@@ -0,0 +1,54 @@
+from bisect import bisect_right, insort
+from decimal import Decimal
+from typing import Dict, List, Tuple
+
+from liquidator.vault import Vault
+
+
+# keeps candidates on the boundary, the caller confirms them with an exact Vault check
+THRESHOLD_TOLERANCE = Decimal("1e-12")
+
+
+# Vaults of every ilk sorted by liquidation price. The liquidation price is linear in the debt, so it is stored
+# divided by the ilk rate it was computed with and a rate change (drip) does not require a rebuild.
+class LiquidationThresholdIndex:
+    _keys: Dict[str, List[Tuple[Decimal, int]]]
+    _entries: Dict[int, Tuple[str, Decimal]]
+
+    def __init__(self):
+        self._keys = {}
+        self._entries = {}
+
+    def __contains__(self, cdp_id: int) -> bool:
+        return cdp_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def update(self, vault: Vault, rate: int):
+        self.remove(vault.id)
+        if vault.price_liquidity <= 0 or rate <= 0:
+            return
+
+        key = vault.price_liquidity / Decimal(rate)
+        insort(self._keys.setdefault(vault.ilk, []), (key, vault.id))
+        self._entries[vault.id] = (vault.ilk, key)
+
+    def remove(self, cdp_id: int):
+        entry = self._entries.pop(cdp_id, None)
+        if entry is None:
+            return
+
+        ilk, key = entry
+        keys = self._keys[ilk]
+        i = bisect_right(keys, (key, cdp_id)) - 1
+        if i >= 0 and keys[i] == (key, cdp_id):
+            del keys[i]
+
+    def candidates(self, ilk: str, price: Decimal, rate: int) -> List[int]:
+        keys = self._keys.get(ilk)
+        if not keys or rate <= 0:
+            return []
+
+        threshold = Decimal(price) / Decimal(rate) * (1 - THRESHOLD_TOLERANCE)
+        return [cdp_id for _, cdp_id in keys[bisect_right(keys, (threshold, float("inf"))):]]
@@ -0,0 +1,271 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from eth_account.signers.local import LocalAccount
+from hexbytes import HexBytes
+from velero_bot_sdk import DssContractsConnector
+from web3 import Web3
+from web3.contract import ContractFunction
+
+from liquidator.gas import URGENCY_DEFAULT, GasStrategy
+from liquidator.sharding import NotLeaderError
+
+
+class PendingTransaction:
+    nonce: int
+    tx_hash: HexBytes
+    tx: dict
+    urgency: str
+    sent_at: float
+    capped: bool = False
+
+    def __init__(self, nonce: int, tx_hash: HexBytes, tx: Optional[dict], urgency: str = URGENCY_DEFAULT):
+        self.nonce = nonce
+        self.tx_hash = tx_hash
+        # None for transactions signed outside of the sender that could not be read back, they can not be replaced
+        self.tx = tx
+        self.urgency = urgency
+        self.sent_at = time.monotonic()
+
+
+# Local nonce of the auctioneer account. Every thread takes its nonce from here instead of asking the node, so
+# transactions from several workers do not collide and dependent transactions can be sent back to back.
+class NonceManager:
+    _next: Optional[int] = None
+    _mined: int = 0
+
+    def __init__(self, web3: Web3, address: str):
+        self.web3 = web3
+        self.address = address
+        self.pending: Dict[int, PendingTransaction] = {}
+        # hash of a replaced transaction -> hash of the transaction that replaced it
+        self.replacements: Dict[HexBytes, HexBytes] = {}
+        self.lock = threading.RLock()
+
+    def sync(self):
+        with self.lock:
+            self._mined = self.web3.eth.get_transaction_count(self.address, "latest")
+            pending = self.web3.eth.get_transaction_count(self.address, "pending")
+            self._next = max(self._next or 0, pending, self._mined)
+            for nonce in [x for x in self.pending if x < self._mined]:
+                del self.pending[nonce]
+
+    def allocate(self) -> int:
+        with self.lock:
+            if self._next is None:
+                self.sync()
+            nonce = self._next
+            self._next += 1
+            return nonce
+
+    def release(self, nonce: int):
+        # the transaction was not broadcast, the last nonce can be taken again, any other is left as a gap
+        with self.lock:
+            if nonce == self._next - 1:
+                self._next = nonce
+
+    def adopt(self, allocated: int, nonce: int):
+        # a transaction signed outside of the sender took another nonce than the allocated one
+        with self.lock:
+            self.release(allocated)
+            self._next = max(self._next, nonce + 1)
+
+    def sent(self, nonce: int, tx_hash: HexBytes, tx: dict = None,
+             urgency: str = URGENCY_DEFAULT) -> PendingTransaction:
+        with self.lock:
+            self.pending[nonce] = PendingTransaction(nonce, tx_hash, tx, urgency)
+            return self.pending[nonce]
+
+    def replacement_chain(self, tx_hash: HexBytes) -> List[HexBytes]:
+        # the transaction and the ones that replaced it, any of them can be the one that is mined
+        with self.lock:
+            chain = [HexBytes(tx_hash)]
+            while chain[-1] in self.replacements:
+                chain.append(self.replacements[chain[-1]])
+            return chain
+
+    def gaps(self) -> List[int]:
+        with self.lock:
+            if self._next is None:
+                return []
+            return [x for x in range(self._mined, self._next) if x not in self.pending]
+
+    def stuck(self, timeout: Callable[[PendingTransaction], float]) -> List[PendingTransaction]:
+        # pending transactions older than their timeout, a later nonce can only be mined after the earlier ones
+        with self.lock:
+            now = time.monotonic()
+            return [x for _, x in sorted(self.pending.items())
+                    if x.tx is not None and not x.capped and now - x.sent_at >= timeout(x)]
+
+
+# Signs and broadcasts the transactions of the auctioneer account with nonces from the NonceManager. send_sequence
+# sends dependent transactions with consecutive nonces without waiting for the receipts in between. maintain() runs
+# on every block: it fills nonce gaps left by failed broadcasts with empty transactions and re-sends a stuck
+# transaction at the same nonce with a higher gas price. With a GasStrategy the gas price follows the urgency profile
+# of the transaction: bark and take are re-sent after a few seconds with escalating gas until they are mined or the
+# cap of the profile is reached, the other transactions after stuck_timeout. With can_send, nothing is signed while it
+# is false (an instance that is not the leader). maintain() calls the node with the nonce lock held, it runs on an
+# executor and not on the thread that delivers the blocks.
+class TransactionSender:
+    stuck_timeout: float
+    replacement_multiplier: float
+
+    def __init__(self, web3: Web3, account: LocalAccount, stuck_timeout: float = 60,
+                 replacement_multiplier: float = 1.125, gas: GasStrategy = None,
+                 can_send: Callable[[], bool] = None, **kwargs):
+        self.web3 = web3
+        self.account = account
+        self.nonces = NonceManager(web3, account.address)
+        self.stuck_timeout = stuck_timeout
+        self.replacement_multiplier = replacement_multiplier
+        self.gas = gas
+        self.can_send = can_send or (lambda: True)
+        self._maintaining = threading.Lock()
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def gas_price(self, urgency: str = URGENCY_DEFAULT) -> dict:
+        if self.gas is None:
+            return {"gasPrice": self.web3.eth.gas_price}
+        return self.gas.price(urgency)
+
+    def build(self, func: ContractFunction, nonce: int, gas: int = None, value: int = 0,
+              urgency: str = URGENCY_DEFAULT) -> dict:
+        params = {"from": self.account.address, "nonce": nonce, "value": value, **self.gas_price(urgency)}
+        if gas is not None:
+            # dependent transactions can not be estimated before the previous one is mined
+            params["gas"] = gas
+        return func.buildTransaction(params)
+
+    def send(self, func: ContractFunction, gas: int = None, value: int = 0,
+             urgency: str = URGENCY_DEFAULT) -> HexBytes:
+        return self.send_sequence([(func, gas)], value=value, urgency=urgency)[0]
+
+    def send_sequence(self, funcs: Sequence[Tuple[ContractFunction, Optional[int]]], value: int = 0,
+                      urgency: str = URGENCY_DEFAULT,
+                      on_sent: Callable[[int, HexBytes], None] = None) -> List[HexBytes]:
+        # on_sent(index, hash) is called right after each broadcast, so the caller keeps the hashes of the
+        # transactions that went out when a later one of the sequence fails
+        hashes = []
+        with self.nonces.lock:
+            for index, (func, gas) in enumerate(funcs):
+                nonce = self.nonces.allocate()
+                try:
+                    tx = self.build(func, nonce=nonce, gas=gas, value=value, urgency=urgency)
+                    tx_hash = self.send_raw(tx)
+                except Exception:
+                    self.nonces.release(nonce)
+                    raise
+                self.nonces.sent(nonce, tx_hash, tx, urgency)
+                hashes.append(tx_hash)
+                if on_sent is not None:
+                    on_sent(index, tx_hash)
+        return hashes
+
+    def send_external(self, send: Callable[[], HexBytes]) -> HexBytes:
+        # for transactions the SDK signs itself (the Wagyu swaps): they take the pending nonce from the node, so no
+        # local nonce may be handed out while they are sent. The transaction is read back, it is recorded at the
+        # nonce it was signed with and can be replaced like the transactions of the sender
+        if not self.can_send():
+            raise NotLeaderError(f"transaction is not sent, this instance is not the leader")
+        with self.nonces.lock:
+            nonce = self.nonces.allocate()
+            try:
+                tx_hash = send()
+            except Exception:
+                self.nonces.release(nonce)
+                raise
+            try:
+                tx = self.read_back(tx_hash)
+            except Exception as e:
+                self.logger.warning(f"failed to read back transaction {str(tx_hash.hex())}, it is kept at nonce "
+                                    f"{nonce} and can not be replaced: {e}")
+                self.nonces.sent(nonce, tx_hash)
+                return tx_hash
+            if tx["nonce"] != nonce:
+                # the pending nonce of the node differs from the local one (a lagging node of the pool)
+                self.logger.warning(f"transaction {str(tx_hash.hex())} was signed with nonce {tx['nonce']} "
+                                    f"instead of {nonce}")
+                self.nonces.adopt(nonce, tx["nonce"])
+            self.nonces.sent(tx["nonce"], tx_hash, tx)
+            return tx_hash
+
+    def read_back(self, tx_hash: HexBytes) -> dict:
+        # the fields of a signed transaction that are signed again when it is replaced
+        sent = self.web3.eth.get_transaction(tx_hash)
+        tx = {"from": self.account.address, "to": sent["to"], "value": sent["value"], "gas": sent["gas"],
+              "data": HexBytes(sent["input"]), "nonce": sent["nonce"],
+              "chainId": sent.get("chainId") or self.web3.eth.chain_id}
+        if sent.get("maxFeePerGas") is not None:
+            tx.update(maxFeePerGas=sent["maxFeePerGas"], maxPriorityFeePerGas=sent["maxPriorityFeePerGas"])
+        else:
+            tx["gasPrice"] = sent["gasPrice"]
+        return tx
+
+    def send_raw(self, tx: dict) -> HexBytes:
+        if not self.can_send():
+            raise NotLeaderError(f"transaction with nonce {tx['nonce']} is not sent, this instance is not the leader")
+        signed = self.account.sign_transaction(tx)
+        return self.web3.eth.send_raw_transaction(signed.rawTransaction)
+
+    def maintain(self, block_number: int = None):
+        if not self.nonces.pending and not self.nonces.gaps() or not self.can_send():
+            return
+        # a block is skipped while the maintenance of an earlier one still waits for the node
+        if not self._maintaining.acquire(blocking=False):
+            return
+        try:
+            with self.nonces.lock:
+                self.nonces.sync()
+                for nonce in self.nonces.gaps():
+                    self.fill_gap(nonce)
+                for pending in self.nonces.stuck(self.replace_after):
+                    self.replace(pending)
+        finally:
+            self._maintaining.release()
+
+    def replace_after(self, pending: PendingTransaction) -> float:
+        if self.gas is None:
+            return self.stuck_timeout
+        return self.gas.profile(pending.urgency).replace_after
+
+    def fill_gap(self, nonce: int):
+        tx = {"from": self.account.address, "to": self.account.address, "value": 0, "gas": 21000,
+              "nonce": nonce, "chainId": self.web3.eth.chain_id, **self.gas_price()}
+        tx_hash = self.send_raw(tx)
+        self.nonces.sent(nonce, tx_hash, tx)
+        self.logger.warning(f"filled nonce gap {nonce} ( {str(tx_hash.hex())} )")
+
+    def replace(self, pending: PendingTransaction):
+        if pending.tx is None:
+            return
+        if self.gas is not None:
+            fees = self.gas.escalate(pending.tx, pending.urgency)
+            if fees is None:
+                pending.capped = True
+                self.logger.warning(f"stuck transaction {str(pending.tx_hash.hex())} with nonce {pending.nonce} "
+                                    f"reached the gas price cap of {pending.urgency} transactions")
+                return
+        else:
+            fees = {"gasPrice": max(int(pending.tx["gasPrice"] * self.replacement_multiplier),
+                                    self.web3.eth.gas_price)}
+        tx = dict(pending.tx, **fees)
+        try:
+            tx_hash = self.send_raw(tx)
+        except ValueError as e:
+            # already mined or the node did not accept the new price, it is checked again on the next block
+            self.logger.debug(f"failed to replace transaction {str(pending.tx_hash.hex())}: {e}")
+            return
+        self.nonces.sent(pending.nonce, tx_hash, tx, pending.urgency)
+        self.nonces.replacements[HexBytes(pending.tx_hash)] = HexBytes(tx_hash)
+        self.logger.warning(f"replaced stuck transaction {str(pending.tx_hash.hex())} with nonce {pending.nonce} "
+                            f"( {str(tx_hash.hex())} )")
+
+
+def send_tx(dss: DssContractsConnector, func: ContractFunction, sender: TransactionSender = None,
+            gas: int = None, urgency: str = URGENCY_DEFAULT) -> HexBytes:
+    if sender is None:
+        return dss.call_tx(func)
+    return sender.send(func, gas=gas, urgency=urgency)
@@ -61,3 +61,12 @@ class Vault:
             if key in raw_dict:
                 raw_dict[key] = str(raw_dict[key])
         return raw_dict
+
+    @classmethod
+    def from_serializable_dict(cls, raw_dict: dict) -> "Vault":
+        # the values are taken as they are, the liquidity is not computed again
+        vault = cls.__new__(cls)
+        for key in filter(lambda x: x in raw_dict, cls.fields()):
+            value = raw_dict[key]
+            setattr(vault, key, Decimal(value) if cls.__annotations__[key] is Decimal else value)
+        return vault
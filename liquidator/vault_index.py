@@ -0,0 +1,237 @@
+import logging
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from velero_bot_sdk import DssContractsConnector, Converter
+from web3 import Web3
+
+from liquidator.multicall import Call, Multicall, batches
+from liquidator.state_store import StateStore
+
+
+def event_topic(signature: str) -> str:
+    return Web3.keccak(text=signature).hex()
+
+
+def note_topic(signature: str) -> str:
+    # LibNote stores the function selector left aligned in the first topic
+    return "0x" + bytes(Web3.keccak(text=signature)[:4]).hex() + "00" * 28
+
+
+def topic_to_address(topic) -> str:
+    return Web3.toChecksumAddress("0x" + bytes(topic)[-20:].hex())
+
+
+NEW_CDP_TOPIC = event_topic("NewCdp(address,address,uint256)")
+LOG_SET_OWNER_TOPIC = event_topic("LogSetOwner(address)")
+GIVE_TOPIC = note_topic("give(uint256,address)")
+FROB_TOPIC = note_topic("frob(bytes32,address,address,address,int256,int256)")
+FORK_TOPIC = note_topic("fork(bytes32,address,address,int256,int256)")
+GRAB_TOPIC = note_topic("grab(bytes32,address,address,address,int256,int256)")
+
+# meta key of the block the stored index is synced to
+INDEX_BLOCK_KEY = "index_block"
+
+
+class VaultRecord:
+    id: int
+    address: str
+    ilk: str
+    raw_ilk: bytes
+    owner_proxy: str
+    owner: Optional[str]
+    ink: int = 0
+    art: int = 0
+
+    def __init__(self, cdp_id: int, address: str, raw_ilk: bytes, owner_proxy: str, owner: Optional[str],
+                 ink: int = 0, art: int = 0):
+        self.id = cdp_id
+        self.address = address
+        self.raw_ilk = raw_ilk
+        self.ilk = Converter.bytes32_to_str(raw_ilk)
+        self.owner_proxy = owner_proxy
+        self.owner = owner
+        self.ink = ink
+        self.art = art
+
+
+class VaultIndex:
+    records: Dict[int, VaultRecord]
+    raw_ilks: Set[bytes]
+    last_block: Optional[int] = None
+
+    def __init__(self, dss: DssContractsConnector, multicall: Multicall, batch_size: int = 200,
+                 max_block_range: int = 5000, **kwargs):
+        self.dss = dss
+        self.multicall = multicall
+        self.batch_size = batch_size
+        self.max_block_range = max_block_range
+        self.records = {}
+        self.raw_ilks = set()
+        self._urns: Dict[Tuple[bytes, str], int] = {}
+        self._proxies: Dict[str, Set[int]] = {}
+        self.store: Optional[StateStore] = kwargs.get("store")
+        # restored records are reported as touched by the first sync
+        self._restored: Set[int] = set()
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    @property
+    def is_synced(self) -> bool:
+        return self.last_block is not None
+
+    def restore(self) -> int:
+        if self.store is None:
+            return 0
+        last_block = self.store.get_block(INDEX_BLOCK_KEY)
+        if last_block is None:
+            return 0
+        for cdp_id, address, ilk, owner_proxy, owner, ink, art in self.store.load_vaults():
+            self.add(VaultRecord(cdp_id=cdp_id, address=address, raw_ilk=Converter.str_to_bytes32(ilk),
+                                 owner_proxy=owner_proxy, owner=owner, ink=ink, art=art))
+        self.last_block = last_block
+        self._restored = set(self.records)
+        self.logger.info(f"restored {len(self.records)} vaults synced to block {last_block}")
+        return len(self.records)
+
+    def save(self, ids: Iterable[int]):
+        if self.store is None:
+            return
+        records = list(map(self.records.get, filter(lambda x: x in self.records, ids)))
+        self.store.save_vaults(map(lambda x: (x.id, x.address, x.ilk, x.owner_proxy, x.owner, x.ink, x.art), records),
+                               block_key=INDEX_BLOCK_KEY, block_number=self.last_block)
+
+    def backfill(self) -> Set[int]:
+        block = self.dss.web3.eth.block_number
+        count = self.dss.cdp_manager.caller(block_identifier=block).cdpi()
+        self.logger.info(f"start backfill {count} vaults at block {block}")
+
+        ids = set(range(1, count + 1)) - set(self.records)
+        self.load(ids, block_identifier=block)
+        self.last_block = block
+        self.save(ids)
+
+        self.logger.info(f"finish backfill {count} vaults at block {block}")
+        return ids
+
+    def sync(self) -> Set[int]:
+        if not self.is_synced:
+            return self.backfill()
+
+        restored, self._restored = self._restored, set()
+        latest = self.dss.web3.eth.block_number
+        if latest <= self.last_block:
+            return restored
+
+        new_ids, owner_ids, state_ids = set(), set(), set()
+        for from_block in range(self.last_block + 1, latest + 1, self.max_block_range):
+            to_block = min(from_block + self.max_block_range - 1, latest)
+            _new_ids, _owner_ids, _state_ids = self.read_logs(from_block, to_block)
+            new_ids |= _new_ids
+            owner_ids |= _owner_ids
+            state_ids |= _state_ids
+
+        self.load(new_ids, block_identifier=latest)
+        self.refresh_owners(owner_ids - new_ids, block_identifier=latest)
+        self.refresh_state(state_ids - new_ids, block_identifier=latest)
+        self.last_block = latest
+
+        touched = new_ids | owner_ids | state_ids
+        self.save(touched)
+        if touched:
+            self.logger.debug(f"synced vault index to block {latest}, {len(touched)} vaults changed")
+        return touched | restored
+
+    def read_logs(self, from_block: int, to_block: int) -> Tuple[Set[int], Set[int], Set[int]]:
+        get_logs = self.dss.web3.eth.get_logs
+        new_ids, owner_ids, state_ids = set(), set(), set()
+
+        for log in get_logs({"fromBlock": from_block, "toBlock": to_block, "address": self.dss.cdp_manager.address,
+                             "topics": [[NEW_CDP_TOPIC, GIVE_TOPIC]]}):
+            topics = log["topics"]
+            if topics[0].hex() == NEW_CDP_TOPIC:
+                new_ids.add(int(topics[3].hex(), 16))
+            elif len(topics) > 2:
+                owner_ids.add(int(topics[2].hex(), 16))
+
+        for log in get_logs({"fromBlock": from_block, "toBlock": to_block, "address": self.dss.vat.address,
+                             "topics": [[FROB_TOPIC, FORK_TOPIC, GRAB_TOPIC]]}):
+            topics = log["topics"]
+            raw_ilk = bytes(topics[1])
+            urns = [topics[2]] + ([topics[3]] if topics[0].hex() == FORK_TOPIC else [])
+            for urn in urns:
+                cdp_id = self._urns.get((raw_ilk, topic_to_address(urn)))
+                if cdp_id is not None:
+                    state_ids.add(cdp_id)
+
+        for log in get_logs({"fromBlock": from_block, "toBlock": to_block, "topics": [LOG_SET_OWNER_TOPIC]}):
+            owner_ids |= self._proxies.get(log["address"], set())
+
+        return new_ids, owner_ids, state_ids
+
+    def load(self, ids: Iterable[int], block_identifier="latest"):
+        cdp_manager = self.dss.cdp_manager
+        for batch in batches(sorted(ids), self.batch_size):
+            calls = []
+            for cdp_id in batch:
+                calls.append(Call(cdp_manager.functions.urns(cdp_id)))
+                calls.append(Call(cdp_manager.functions.owns(cdp_id)))
+                calls.append(Call(cdp_manager.functions.ilks(cdp_id)))
+            _, results = self.multicall.aggregate(calls, block_identifier=block_identifier)
+
+            records = []
+            for i, cdp_id in enumerate(batch):
+                urn_address, owner_proxy_address, raw_ilk = results[i * 3:i * 3 + 3]
+                records.append(VaultRecord(cdp_id=cdp_id, address=urn_address, raw_ilk=raw_ilk,
+                                           owner_proxy=owner_proxy_address, owner=None))
+            self._read_owners_and_state(records, block_identifier=block_identifier)
+            list(map(self.add, records))
+
+    def refresh_owners(self, ids: Iterable[int], block_identifier="latest"):
+        cdp_manager = self.dss.cdp_manager
+        for batch in batches(sorted(filter(lambda x: x in self.records, ids)), self.batch_size):
+            _, results = self.multicall.aggregate(
+                list(map(lambda x: Call(cdp_manager.functions.owns(x)), batch)), block_identifier=block_identifier)
+
+            records = list(map(self.records.get, batch))
+            for record, owner_proxy_address in zip(records, results):
+                self._proxies.get(record.owner_proxy, set()).discard(record.id)
+                record.owner_proxy = owner_proxy_address
+                self._proxies.setdefault(record.owner_proxy, set()).add(record.id)
+            self._read_owners_and_state(records, block_identifier=block_identifier, with_state=False)
+
+    def refresh_state(self, ids: Iterable[int], block_identifier="latest"):
+        vat = self.dss.vat
+        for batch in batches(sorted(filter(lambda x: x in self.records, ids)), self.batch_size):
+            records = list(map(self.records.get, batch))
+            _, results = self.multicall.aggregate(
+                list(map(lambda x: Call(vat.functions.urns(x.raw_ilk, x.address)), records)),
+                block_identifier=block_identifier
+            )
+            for record, (ink, art) in zip(records, results):
+                record.ink, record.art = ink, art
+
+    def _read_owners_and_state(self, records: List[VaultRecord], block_identifier="latest", with_state=True):
+        calls = []
+        for record in records:
+            calls.append(Call(self.dss.get_ds_proxy(record.owner_proxy).functions.owner()))
+            if with_state:
+                calls.append(Call(self.dss.vat.functions.urns(record.raw_ilk, record.address)))
+        _, results = self.multicall.aggregate(calls, block_identifier=block_identifier)
+
+        step = 2 if with_state else 1
+        for i, record in enumerate(records):
+            record.owner = results[i * step]
+            if with_state:
+                record.ink, record.art = results[i * step + 1]
+
+    def add(self, record: VaultRecord):
+        self.records[record.id] = record
+        self.raw_ilks.add(record.raw_ilk)
+        self._urns[(record.raw_ilk, record.address)] = record.id
+        self._proxies.setdefault(record.owner_proxy, set()).add(record.id)
+
+    def by_ilk(self) -> Dict[bytes, List[VaultRecord]]:
+        result = {}
+        for record in self.records.values():
+            result.setdefault(record.raw_ilk, []).append(record)
+        return result
@@ -0,0 +1,122 @@
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from liquidator.vault import Vault, MIN_LIQUIDITY
+
+
+# rows closer than this to MIN_LIQUIDITY are confirmed with an exact Vault check
+LIQUIDITY_TOLERANCE = 1e-6
+
+
+class VaultRow:
+    id: int
+    address: str
+    owner_proxy: str
+    owner: Optional[str]
+    ink: int
+    art: int
+    ilk: str
+
+    def __init__(self, cdp_id: int, address: str, owner_proxy: str, owner: Optional[str], ink: int, art: int,
+                 ilk: str):
+        self.id = cdp_id
+        self.address = address
+        self.owner_proxy = owner_proxy
+        self.owner = owner
+        self.ink = ink
+        self.art = art
+        self.ilk = ilk
+
+
+# Columnar store of vaults. Every vault is evaluated in one vectorized pass and only the rows that may be
+# unsafe are turned into Vault objects. ink and art are uint256 values that do not fit into int64 columns, so the
+# columns hold them as float64 and the exact integers stay in the rows for the final Vault check. The store is kept
+# between scans: a row read again replaces the row of its vault in place, the columns grow by doubling.
+class VaultStore:
+    ilks: List[str]
+    rows: List[VaultRow]
+
+    ink: np.ndarray
+    art: np.ndarray
+    ilk_index: np.ndarray
+
+    def __init__(self, capacity: int = 1024):
+        self.ilks = []
+        self.rows = []
+        self._ilk_positions: Dict[str, int] = {}
+        self._positions: Dict[int, int] = {}
+        self.ink = np.zeros(capacity, dtype=np.float64)
+        self.art = np.zeros(capacity, dtype=np.float64)
+        self.ilk_index = np.zeros(capacity, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def update(self, row: VaultRow):
+        if row.ilk not in self._ilk_positions:
+            self._ilk_positions[row.ilk] = len(self.ilks)
+            self.ilks.append(row.ilk)
+        position = self._positions.get(row.id)
+        if position is None:
+            position = self._positions[row.id] = len(self.rows)
+            self.rows.append(row)
+            self._reserve(len(self.rows))
+        else:
+            self.rows[position] = row
+        self.ink[position] = float(row.ink)
+        self.art[position] = float(row.art)
+        self.ilk_index[position] = self._ilk_positions[row.ilk]
+
+    def extend(self, rows: Iterable[VaultRow]):
+        list(map(self.update, rows))
+
+    def _reserve(self, size: int):
+        if size <= len(self.ink):
+            return
+        capacity = max(size, len(self.ink) * 2)
+        self.ink = np.resize(self.ink, capacity)
+        self.art = np.resize(self.art, capacity)
+        self.ilk_index = np.resize(self.ilk_index, capacity)
+
+    def positions(self, ids: Iterable[int]) -> np.ndarray:
+        return np.fromiter((self._positions[x] for x in ids if x in self._positions), dtype=np.int64)
+
+    def unsafe_mask(self, rates: Dict[str, int], prices: Dict[str, Decimal],
+                    positions: np.ndarray = None) -> np.ndarray:
+        # over all rows, or over the rows at `positions`
+        if positions is None:
+            positions = np.arange(len(self.rows))
+        ilk_index = self.ilk_index[positions]
+        rate = np.array([float(rates.get(ilk, 0)) for ilk in self.ilks], dtype=np.float64)[ilk_index]
+        price = np.array([float(prices.get(ilk, 0)) for ilk in self.ilks], dtype=np.float64)[ilk_index]
+
+        # same as VeleroFormuls.get_liquidity: price * collateral / debt * 100 with collateral in wad and debt in rad
+        collateral = self.ink[positions] / 1e18
+        debt = self.art[positions] * rate / 1e45
+        is_active = (collateral > 0) & (debt > 0)
+        liquidity = np.divide(price * collateral * 100, debt, out=np.full_like(debt, np.inf), where=is_active)
+
+        return is_active & (liquidity < float(MIN_LIQUIDITY) * (1 + LIQUIDITY_TOLERANCE))
+
+    def unsafe_vaults(self, rates: Dict[str, int], prices: Dict[str, Decimal],
+                      ids: Iterable[int] = None) -> List[Vault]:
+        # of all vaults, or of the vaults with `ids`; rates and prices are needed for the ilks of these vaults
+        positions = self.positions(ids) if ids is not None else np.arange(len(self.rows))
+        vaults = []
+        for i in positions[self.unsafe_mask(rates=rates, prices=prices, positions=positions)]:
+            row = self.rows[i]
+            vault = Vault(
+                cdp_id=row.id,
+                address=row.address,
+                owner_proxy=row.owner_proxy,
+                owner=row.owner,
+                debt=row.art * rates[row.ilk],
+                collateral=row.ink,
+                ilk=row.ilk,
+                current_price=prices[row.ilk]
+            )
+            if not vault.is_secured:
+                vaults.append(vault)
+        return vaults
@@ -7,114 +7,546 @@ import requests
 
 from decimal import Decimal
 from queue import Queue
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from velero_bot_sdk import DssContractsConnector, Converter
 
+from liquidator.blocks import BlockNotifier
+from liquidator.ilk_cache import IlkCache
+from liquidator.multicall import Call, Multicall, batches
+from liquidator.retry import DeadLetters, RetryPolicy
+from liquidator.rpc import AsyncRpcClient
+from liquidator.runtime import Runtime
+from liquidator.scheduler import ScanTier, TieredScheduler
+from liquidator.sharding import SHARD_BY_ID, Shard
+from liquidator.state_store import StateStore
 from liquidator.vault import Vault
+from liquidator.threshold_index import LiquidationThresholdIndex
+from liquidator.vault_index import VaultIndex, VaultRecord, FROB_TOPIC, FORK_TOPIC, GRAB_TOPIC, topic_to_address
+from liquidator.vault_store import VaultStore, VaultRow
 
 
-def chunks(lst, n):
-    count = len(lst) // n
-    for i in range(0, len(lst), count):
-        yield lst[i:i + count]
+SCAN_MODE_THREADS = "threads"
+SCAN_MODE_MULTICALL = "multicall"
+SCAN_MODE_ASYNC = "async"
+SCAN_MODE_INDEX = "index"
+SCAN_MODE_TIERED = "tiered"
+
+# meta key of the block up to which the Vat logs of the stored tiered schedule are read
+TIERED_BLOCK_KEY = "tiered_block"
 
 
 class Viewer:
     logger: logging.Logger
     alive: bool = False
 
-    def __init__(self, queue: Queue, dss: DssContractsConnector):
+    def __init__(self, queue: Queue, dss: DssContractsConnector, ilk_cache: IlkCache = None,
+                 scan_mode: str = SCAN_MODE_THREADS,
+                 multicall_batch_size: int = 200, rpc_url: str = None, rpc_concurrency: int = 200,
+                 log_block_range: int = 5000, interval: float = 30, scan_tiers: List[ScanTier] = None,
+                 blocks: BlockNotifier = None, store: StateStore = None, retry_policy: RetryPolicy = None,
+                 dead_letters: DeadLetters = None, shard: Shard = None, runtime: Runtime = None,
+                 concurrency: int = 6):
         self.dss = dss
+        # without a shared runtime the viewer runs its own while it is started
+        self.runtime = runtime or Runtime()
+        self._own_runtime = runtime is None
+        self.store = store
+        self.shard = shard or Shard()
+        self._cdp_ilks: Dict[int, str] = {}
+        # unsafe vaults that were notified, a vault is notified again once it was seen secured in between
+        self._notified: Set[int] = set()
+        self._notified_lock = threading.Lock()
+        self.blocks = blocks
         self.liquidation_queue = queue
+        self.ilk_cache = ilk_cache or IlkCache(dss)
+        self.scan_mode = scan_mode
+        self.multicall = Multicall(dss.multicall)
+        self.multicall_batch_size = multicall_batch_size
+        self.log_block_range = log_block_range
+        self.interval = interval
+        self.concurrency = concurrency
+        # rows of the multicall scans, kept between the passes and evaluated again when a rate or price changes
+        self.vault_store = VaultStore()
+        self._evaluated_market = None
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letters = dead_letters or DeadLetters(store=store, logger=self.logger)
+
+        if self.scan_mode == SCAN_MODE_ASYNC:
+            self.rpc = AsyncRpcClient(rpc_url=rpc_url, concurrency=rpc_concurrency)
+        if self.scan_mode == SCAN_MODE_INDEX:
+            self.vault_index = VaultIndex(dss=dss, multicall=self.multicall, batch_size=multicall_batch_size,
+                                          max_block_range=log_block_range, store=store)
+            self.vault_index.restore()
+            self.thresholds = LiquidationThresholdIndex()
+        if self.scan_mode == SCAN_MODE_TIERED:
+            self.scheduler = TieredScheduler(scan_tiers or [ScanTier("all", None, 1)])
+            self._last_log_block = None
+            self._last_cdp_id = 0
+            self._restored = set()
+            self.restore_scheduler()
 
     def start(self):
         self.logger.notification(f"Start Viewer")
         self.alive = True
+        runtime_thread = self.runtime.start_thread(name="viewer_runtime_thread") if self._own_runtime else None
+        last_block = -1
         while self.alive:
+            started_at = time.monotonic()
             try:
                 self.logger.debug("running a check of all vaults")
                 self.check_cdps()
                 self.logger.debug("finish a check of all vaults")
             finally:
-                time.sleep(30)
+                last_block = self.wait_next_pass(started_at, last_block)
+        if self.scan_mode == SCAN_MODE_ASYNC:
+            self.runtime.run(self.rpc.close())
+        if runtime_thread is not None:
+            self.runtime.stop()
+            runtime_thread.join()
         self.logger.notification(f"Stop Viewer")
 
     def stop(self):
         self.alive = False
 
-    async def async_check(self, ids):
-        coroutines = list(map(self.check_cdp, ids))
-        return await asyncio.gather(*coroutines, return_exceptions=True)
+    def wait_next_pass(self, started_at: float, last_block: int) -> int:
+        # at least `interval` seconds between two passes, then the next pass starts with the next block
+        time.sleep(max(self.interval - (time.monotonic() - started_at), 0))
+        if self.blocks is None or not self.alive:
+            return last_block
+        return self.blocks.wait_for_block(after=last_block, timeout=max(self.interval, 30))
 
-    def check_cdps(self, numbers: List[int] = None, n: int = 6):
-        def run_async(*args):
-            _st = time.time_ns()
-            self.logger.debug(f"start batch check")
-            asyncio.run(self.async_check(*args))
-            self.logger.debug(f"finish batch check ({time.time_ns() - _st})")
-
-        count = self.dss.cdp_manager.caller.cdpi() if numbers is None else len(numbers)
-        self.logger.info(f"start check {count} vaults in {n} threads")
-        threads = list(map(lambda x: threading.Thread(target=run_async, args=[x]), chunks(range(1, count + 1), n)))
-        list(map(lambda x: x.start(), threads))
-        list(map(lambda x: x.join(), threads))
+    async def async_check(self, ids, n: int = 6):
+        # up to n vaults are read at once on the executor of the runtime
+        slots = asyncio.Semaphore(n)
+
+        async def check(cdp_number: int):
+            async with slots:
+                return await self.check_cdp(cdp_number)
+
+        return await asyncio.gather(*map(check, ids), return_exceptions=True)
+
+    def check_cdps(self, numbers: List[int] = None, n: int = None):
+        n = n or self.concurrency
+        if self.scan_mode == SCAN_MODE_INDEX and numbers is None:
+            self.check_cdps_index()
+            return
+
+        if self.scan_mode == SCAN_MODE_TIERED and numbers is None:
+            self.check_cdps_tiered()
+            return
+
+        if numbers is None:
+            numbers = range(1, self.dss.cdp_manager.caller.cdpi() + 1)
+        numbers = self.shard_numbers(numbers)
+        count = len(numbers)
+
+        if self.scan_mode == SCAN_MODE_MULTICALL:
+            self.logger.info(f"start check {count} vaults in batches of {self.multicall_batch_size}")
+            self.check_cdps_multicall(numbers)
+            self.logger.info(f"finish check {count} vaults")
+            return
+
+        if self.scan_mode == SCAN_MODE_ASYNC:
+            self.logger.info(f"start check {count} vaults with {self.rpc.concurrency} requests in flight")
+            self.runtime.run(self.check_cdps_async(numbers))
+            self.logger.info(f"finish check {count} vaults")
+            return
+
+        self.logger.info(f"start check {count} vaults, {n} at once")
+        self.runtime.run(self.async_check(numbers, n))
         self.logger.info(f"finish check {count} vaults")
 
-    async def get_urn_address(self, cdp_number: int) -> str:
+    def check_cdps_multicall(self, numbers: List[int]) -> List[Vault]:
+        vaults = []
+        for batch in batches(numbers, self.multicall_batch_size):
+            _st = time.time_ns()
+            rates, prices = self.store_market()
+            if (rates, prices) != self._evaluated_market:
+                # a new rate or price moves every vault, the rows read before are evaluated again right away
+                vaults += self.evaluate_store(rates, prices)
+                self._evaluated_market = (rates, prices)
+                self.logger.debug(f"evaluated {len(self.vault_store)} vaults ({time.time_ns() - _st})")
+
+            self.logger.debug(f"start multicall batch check #{batch[0]}-#{batch[-1]}")
+            try:
+                self.vault_store.extend(self.read_cdps_batch(batch))
+            except requests.exceptions.ReadTimeout:
+                self.logger.warning(f"multicall batch #{batch[0]}-#{batch[-1]} timed out, check vaults one by one")
+                self.runtime.run(self.async_check(batch, self.concurrency))
+                continue
+            except Exception as e:
+                self.logger.error(f"failed multicall batch #{batch[0]}-#{batch[-1]}, check vaults one by one",
+                                  exc_info=e)
+                self.runtime.run(self.async_check(batch, self.concurrency))
+                continue
+            # the unsafe vaults of a batch are reported before the next batch is read
+            rates, prices = self.store_market()
+            vaults += self.evaluate_store(rates, prices, ids=batch)
+            self.logger.debug(f"finish multicall batch check ({time.time_ns() - _st})")
+        return vaults
+
+    def store_market(self) -> Tuple[Dict[str, int], Dict[str, Decimal]]:
+        # rates and prices of the ilks in the store, read once per block by the ilk cache
+        ilks = self.vault_store.ilks
+        return {ilk: self.ilk_cache.get_ilk(ilk).rate for ilk in ilks}, \
+            {ilk: self.ilk_cache.get_price(ilk) for ilk in ilks}
+
+    def evaluate_store(self, rates: Dict[str, int], prices: Dict[str, Decimal], ids: List[int] = None) -> List[Vault]:
+        vaults = self.vault_store.unsafe_vaults(rates=rates, prices=prices, ids=ids)
+        unsafe = set(map(lambda x: x.id, vaults))
+        self.forget_notified(filter(lambda x: x not in unsafe,
+                                    ids if ids is not None else map(lambda x: x.id, self.vault_store.rows)))
+        list(map(self.report_vault, vaults))
+        return vaults
+
+    def read_cdps_batch(self, numbers: List[int]) -> List[VaultRow]:
+        cdp_manager = self.dss.cdp_manager
+        vat = self.dss.vat
+
+        calls = []
+        for cdp_number in numbers:
+            calls.append(Call(cdp_manager.functions.urns(cdp_number)))
+            calls.append(Call(cdp_manager.functions.owns(cdp_number)))
+            calls.append(Call(cdp_manager.functions.ilks(cdp_number)))
+        _, results = self.multicall.aggregate(calls)
+        cdps = [results[i:i + 3] for i in range(0, len(results), 3)]
+
+        calls = []
+        for urn_address, owner_proxy_address, raw_ilk in cdps:
+            calls.append(Call(vat.functions.urns(raw_ilk, urn_address)))
+            calls.append(Call(self.dss.get_ds_proxy(owner_proxy_address).functions.owner()))
+        _, results = self.multicall.aggregate(calls)
+
+        rows = []
+        for i, (cdp_number, (urn_address, owner_proxy_address, raw_ilk)) in enumerate(zip(numbers, cdps)):
+            ink, art = results[i * 2]
+            rows.append(VaultRow(
+                cdp_id=cdp_number,
+                address=urn_address,
+                owner_proxy=owner_proxy_address,
+                owner=results[i * 2 + 1],
+                ink=ink,
+                art=art,
+                ilk=Converter.bytes32_to_str(raw_ilk)
+            ))
+        return rows
+
+    async def check_cdps_async(self, numbers: List[int]):
+        futures = {}
+
+        def from_cache(method, ilk: str):
+            # one executor call per ilk and scan, the cache itself is shared with the other threads
+            key = (method.__name__, ilk)
+            if key not in futures or futures[key].done() and futures[key].exception() is not None:
+                # a failed read is not shared with the retries
+                futures[key] = asyncio.ensure_future(self.runtime.run_blocking(method, ilk))
+            return futures[key]
+
+        coroutines = list(map(lambda x: self.check_cdp_async(x, from_cache), numbers))
+        return await asyncio.gather(*coroutines, return_exceptions=True)
+
+    async def check_cdp_async(self, cdp_number: int, from_cache) -> Optional[Vault]:
+        def on_error(attempt: int, e: Exception):
+            self.logger.error(f"failed check vault #{cdp_number} (attempt {attempt})", exc_info=e)
+
+        try:
+            return await self.retry_policy.call_async(lambda: self.read_cdp_async(cdp_number, from_cache),
+                                                      on_error=on_error)
+        except Exception as e:
+            self.dead_letters.add(kind="vault", key=str(cdp_number), description=f"check of vault #{cdp_number}",
+                                  error=e, attempts=self.retry_policy.max_attempts)
+            return None
+
+    async def read_cdp_async(self, cdp_number: int, from_cache) -> Vault:
+        cdp_manager = self.dss.cdp_manager
+        urn_address, owner_proxy_address, raw_ilk = await asyncio.gather(
+            self.rpc.eth_call(Call(cdp_manager.functions.urns(cdp_number))),
+            self.rpc.eth_call(Call(cdp_manager.functions.owns(cdp_number))),
+            self.rpc.eth_call(Call(cdp_manager.functions.ilks(cdp_number))),
+        )
+        ilk = Converter.bytes32_to_str(raw_ilk)
+        (collateral, art), ilk_params, cdp_owner, current_price = await asyncio.gather(
+            self.rpc.eth_call(Call(self.dss.vat.functions.urns(raw_ilk, urn_address))),
+            from_cache(self.ilk_cache.get_ilk, ilk),
+            self.rpc.eth_call(Call(self.dss.get_ds_proxy(owner_proxy_address).functions.owner())),
+            from_cache(self.ilk_cache.get_price, ilk),
+        )
+
+        vault = Vault(
+            cdp_id=cdp_number,
+            address=urn_address,
+            owner_proxy=owner_proxy_address,
+            owner=cdp_owner,
+            debt=art * ilk_params.rate,
+            collateral=collateral,
+            ilk=ilk,
+            current_price=current_price
+        )
+        self.report_vault(vault)
+        return vault
+
+    def retry(self, func, description: str):
+        def on_error(attempt: int, e: Exception):
+            self.logger.warning(f"failed {description} (attempt {attempt} of {self.retry_policy.max_attempts})",
+                                exc_info=e)
+
+        return self.retry_policy.call(func, on_error=on_error)
+
+    def check_cdps_index(self) -> List[Vault]:
+        _st = time.time_ns()
+        try:
+            touched = self.retry(self.vault_index.sync, "vault index sync")
+        except Exception as e:
+            # the index keeps its last block, the next pass reads the logs from there
+            self.logger.error(f"failed to sync the vault index, the vaults are checked again on the next pass",
+                              exc_info=e)
+            return []
+        self.logger.debug(f"vault index synced to block {self.vault_index.last_block}, {len(touched)} vaults changed "
+                          f"({time.time_ns() - _st})")
+
+        raw_ilks = list(self.vault_index.raw_ilks)
+        rates = {raw_ilk: self.ilk_cache.get_ilk(Converter.bytes32_to_str(raw_ilk)).rate for raw_ilk in raw_ilks}
+        prices = {raw_ilk: self.ilk_cache.get_price(Converter.bytes32_to_str(raw_ilk)) for raw_ilk in raw_ilks}
+
+        for cdp_id in touched:
+            record = self.vault_index.records[cdp_id]
+            if not self.shard.owns(cdp_id, record.ilk):
+                continue
+            vault = self.record_to_vault(record, rate=rates[record.raw_ilk], current_price=prices[record.raw_ilk])
+            self.thresholds.update(vault, rate=rates[record.raw_ilk])
+            if vault.is_secured:
+                self.forget_notified([cdp_id])
+
+        vaults = []
+        for raw_ilk in raw_ilks:
+            ilk = Converter.bytes32_to_str(raw_ilk)
+            for cdp_id in self.thresholds.candidates(ilk, price=prices[raw_ilk], rate=rates[raw_ilk]):
+                vault = self.record_to_vault(self.vault_index.records[cdp_id], rate=rates[raw_ilk],
+                                             current_price=prices[raw_ilk])
+                self.report_vault(vault)
+                vaults.append(vault)
+        self.logger.info(f"finish check {len(self.vault_index.records)} indexed vaults, "
+                         f"{len(vaults)} near liquidation ({time.time_ns() - _st})")
+        return vaults
+
+    def check_cdps_tiered(self) -> List[Vault]:
+        _st = time.time_ns()
+        block_number = self.ilk_cache.block_number
+        if self._restored:
+            self.seed_restored()
+
+        try:
+            self.retry(lambda: self.load_new_cdps(self.dss.cdp_manager.caller.cdpi()), "load of new vaults")
+            self.scheduler.mark_changed(self.retry(lambda: self.read_changed_cdps(block_number),
+                                                   "read of changed vaults"))
+        except Exception as e:
+            self.logger.error(f"failed to refresh the scan schedule at block {block_number}", exc_info=e)
+
+        ilks = set(map(lambda x: x.row.ilk, self.scheduler.vaults.values()))
+        rates = {ilk: self.ilk_cache.get_ilk(ilk).rate for ilk in ilks}
+        prices = {ilk: self.ilk_cache.get_price(ilk) for ilk in ilks}
+
+        due = self.scheduler.due(block_number, prices=prices, rates=rates)
+        vaults, failed = [], False
+        for batch in batches(due, self.multicall_batch_size):
+            try:
+                vaults += self.retry(lambda: self.check_scheduled_batch(batch, block_number=block_number,
+                                                                        prices=prices, rates=rates),
+                                     f"scheduled batch check of {len(batch)} vaults")
+            except Exception as e:
+                failed = True
+                self.logger.error(f"failed scheduled batch check of {len(batch)} vaults", exc_info=e)
+        if self.store is not None:
+            # the log block is only stored once every changed vault is read again
+            self.save_rows(due, block_number=None if failed else self._last_log_block)
+
+        self.logger.debug(f"tiers at block {block_number}: {self.scheduler.tier_sizes(prices=prices, rates=rates)}")
+        self.logger.info(f"finish check {len(due)} of {len(self.scheduler)} scheduled vaults "
+                         f"({time.time_ns() - _st})")
+        return vaults
+
+    def load_new_cdps(self, cdpi: int):
+        for batch in batches(self.shard_numbers(range(self._last_cdp_id + 1, cdpi + 1)), self.multicall_batch_size):
+            rows = self.read_cdps_batch(batch)
+            list(map(self.scheduler.add, rows))
+            if self.store is not None:
+                self.save_rows(map(lambda x: x.id, rows))
+        self._last_cdp_id = max(self._last_cdp_id, cdpi)
+
+    def shard_numbers(self, numbers) -> List[int]:
+        # ids of the vaults of this shard, by ilk the ilks of new ids are read once (the ilk of a vault never changes)
+        if self.shard.is_whole:
+            return numbers
+        if self.shard.by == SHARD_BY_ID:
+            return list(filter(self.shard.owns, numbers))
+
+        for batch in batches(filter(lambda x: x not in self._cdp_ilks, numbers), self.multicall_batch_size):
+            _, results = self.multicall.aggregate(list(map(
+                lambda x: Call(self.dss.cdp_manager.functions.ilks(x)), batch)))
+            self._cdp_ilks.update(zip(batch, map(Converter.bytes32_to_str, results)))
+        return list(filter(lambda x: self.shard.owns(x, self._cdp_ilks[x]), numbers))
+
+    def restore_scheduler(self):
+        if self.store is None:
+            return
+        last_block = self.store.get_block(TIERED_BLOCK_KEY)
+        if last_block is None:
+            return
+        for cdp_id, address, ilk, owner_proxy, owner, ink, art in self.store.load_vaults():
+            self.scheduler.add(VaultRow(cdp_id=cdp_id, address=address, owner_proxy=owner_proxy, owner=owner,
+                                        ink=ink, art=art, ilk=ilk))
+        self._last_log_block = last_block
+        self._last_cdp_id = self.scheduler.last_id
+        self._restored = set(self.scheduler.vaults)
+        self.logger.info(f"restored {len(self.scheduler)} scheduled vaults synced to block {last_block}")
+
+    def seed_restored(self):
+        # the stored ink and art are current up to the stored block, vaults changed since are marked by the logs
+        rows = list(map(lambda x: self.scheduler.vaults[x].row, self._restored))
+        rates = {ilk: self.ilk_cache.get_ilk(ilk).rate for ilk in set(map(lambda x: x.ilk, rows))}
+        prices = {ilk: self.ilk_cache.get_price(ilk) for ilk in rates}
+        for row in rows:
+            vault = Vault(cdp_id=row.id, address=row.address, owner_proxy=row.owner_proxy, owner=row.owner,
+                          debt=row.art * rates[row.ilk], collateral=row.ink, ilk=row.ilk, current_price=prices[row.ilk])
+            self.scheduler.update(row.id, liquidity=vault.current_liquidity, price=prices[row.ilk],
+                                  rate=rates[row.ilk], block_number=self._last_log_block)
+        self._restored = set()
+
+    def save_rows(self, ids, block_number: int = None):
+        rows = list(map(lambda x: self.scheduler.vaults[x].row, ids))
+        self.store.save_vaults(map(lambda x: (x.id, x.address, x.ilk, x.owner_proxy, x.owner, x.ink, x.art), rows),
+                               block_key=TIERED_BLOCK_KEY, block_number=block_number)
+
+    def read_changed_cdps(self, block_number: int) -> List[int]:
+        if self._last_log_block is None or block_number <= self._last_log_block:
+            self._last_log_block = max(self._last_log_block or 0, block_number)
+            return []
+
+        ids = []
+        for from_block in range(self._last_log_block + 1, block_number + 1, self.log_block_range):
+            to_block = min(from_block + self.log_block_range - 1, block_number)
+            for log in self.dss.web3.eth.get_logs({"fromBlock": from_block, "toBlock": to_block,
+                                                   "address": self.dss.vat.address,
+                                                   "topics": [[FROB_TOPIC, FORK_TOPIC, GRAB_TOPIC]]}):
+                topics = log["topics"]
+                ilk = Converter.bytes32_to_str(bytes(topics[1]))
+                urns = [topics[2]] + ([topics[3]] if topics[0].hex() == FORK_TOPIC else [])
+                ids += filter(lambda x: x is not None,
+                              map(lambda x: self.scheduler.get_id(ilk, topic_to_address(x)), urns))
+        self._last_log_block = block_number
+        return ids
+
+    def check_scheduled_batch(self, numbers: List[int], block_number: int, prices: dict, rates: dict) -> List[Vault]:
+        # static fields were read when the vault was added, only ink and art are re-read
+        rows = list(map(lambda x: self.scheduler.vaults[x].row, numbers))
+        _, results = self.multicall.aggregate(list(map(
+            lambda x: Call(self.dss.vat.functions.urns(Converter.str_to_bytes32(x.ilk), x.address)), rows)))
+
+        vaults = []
+        for row, (ink, art) in zip(rows, results):
+            row.ink, row.art = ink, art
+            vault = Vault(
+                cdp_id=row.id,
+                address=row.address,
+                owner_proxy=row.owner_proxy,
+                owner=row.owner,
+                debt=art * rates[row.ilk],
+                collateral=ink,
+                ilk=row.ilk,
+                current_price=prices[row.ilk]
+            )
+            self.scheduler.update(row.id, liquidity=vault.current_liquidity, price=prices[row.ilk],
+                                  rate=rates[row.ilk], block_number=block_number)
+            self.report_vault(vault)
+            vaults.append(vault)
+        return vaults
+
+    @staticmethod
+    def record_to_vault(record: VaultRecord, rate: int, current_price: Decimal) -> Vault:
+        return Vault(
+            cdp_id=record.id,
+            address=record.address,
+            owner_proxy=record.owner_proxy,
+            owner=record.owner,
+            debt=record.art * rate,
+            collateral=record.ink,
+            ilk=record.ilk,
+            current_price=current_price
+        )
+
+    def report_vault(self, vault: Vault):
+        # the queue keeps one entry per vault, the hot tier reports an unsafe vault on every block until it is barked
+        if vault.is_secured:
+            self.forget_notified([vault.id])
+            return
+        with self._notified_lock:
+            notify = vault.id not in self._notified
+            self._notified.add(vault.id)
+        if notify:
+            self.logger.notification(f"vault #{vault.id} is not secured. \n{vault.to_dict()}", extra=vault.to_dict())
+        self.liquidation_queue.put(vault)
+
+    def forget_notified(self, ids: Iterable[int]):
+        with self._notified_lock:
+            self._notified.difference_update(ids)
+
+    def get_urn_address(self, cdp_number: int) -> str:
         return self.dss.cdp_manager.caller.urns(cdp_number)
 
-    async def get_cdp_owner_proxy_address(self, cdp_number: int) -> str:
+    def get_cdp_owner_proxy_address(self, cdp_number: int) -> str:
         return self.dss.cdp_manager.caller.owns(cdp_number)
 
-    async def get_cdp_ilk(self, cdp_number: int) -> str:
+    def get_cdp_ilk(self, cdp_number: int) -> str:
         return Converter.bytes32_to_str(self.dss.cdp_manager.caller.ilks(cdp_number))
 
-    async def get_locked_collateral_and_debt(self, urn_address: str, ilk: str) -> Tuple[Decimal, Decimal]:
-        ilk = Converter.str_to_bytes32(ilk)
-        collateral, art = self.dss.vat.caller.urns(ilk, urn_address)
-        _, rate, _, _, _ = self.dss.vat.caller.ilks(ilk)
-        debt = art * rate
+    def get_locked_collateral_and_debt(self, urn_address: str, ilk: str) -> Tuple[Decimal, Decimal]:
+        collateral, art = self.dss.vat.caller.urns(Converter.str_to_bytes32(ilk), urn_address)
+        debt = art * self.ilk_cache.get_ilk(ilk).rate
 
         return collateral, debt
 
-    async def get_cdp_owner(self, proxy_address: str) -> str:
+    def get_cdp_owner(self, proxy_address: str) -> str:
         return self.dss.get_ds_proxy(proxy_address).caller.owner()
 
     async def check_cdp(self, cdp_number: int):
+        def on_error(attempt: int, e: Exception):
+            if isinstance(e, requests.exceptions.ReadTimeout):
+                self.logger.info(f"read timeout in check of vault #{cdp_number} (attempt {attempt})")
+            else:
+                self.logger.error(f"failed check vault #{cdp_number} (attempt {attempt})", exc_info=e)
+
         try:
-            self.logger.debug(f"start check cdp #{cdp_number}")
-            urn_address = self.get_urn_address(cdp_number=cdp_number)
-            owner_proxy_address = self.get_cdp_owner_proxy_address(cdp_number=cdp_number)
-            ilk = self.get_cdp_ilk(cdp_number=cdp_number)
+            # the SDK calls block, the backoff between the attempts does not hold an executor thread
+            return await self.retry_policy.call_async(lambda: self.runtime.run_blocking(self.read_cdp, cdp_number),
+                                                      on_error=on_error)
+        except Exception as e:
+            self.dead_letters.add(kind="vault", key=str(cdp_number), description=f"check of vault #{cdp_number}",
+                                  error=e, attempts=self.retry_policy.max_attempts)
+            return None
 
-            urn_address = await urn_address
-            ilk = await ilk
-            owner_proxy_address = await owner_proxy_address
-            collateral_and_debt = await self.get_locked_collateral_and_debt(urn_address=urn_address, ilk=ilk)
-            cdp_owner = self.get_cdp_owner(proxy_address=owner_proxy_address)
+    def read_cdp(self, cdp_number: int) -> Vault:
+        self.logger.debug(f"start check cdp #{cdp_number}")
+        urn_address = self.get_urn_address(cdp_number=cdp_number)
+        owner_proxy_address = self.get_cdp_owner_proxy_address(cdp_number=cdp_number)
+        ilk = self.get_cdp_ilk(cdp_number=cdp_number)
+        collateral_and_debt = self.get_locked_collateral_and_debt(urn_address=urn_address, ilk=ilk)
+        cdp_owner = self.get_cdp_owner(proxy_address=owner_proxy_address)
 
-            current_price = self.dss.get_current_price(ilk)
+        current_price = self.ilk_cache.get_price(ilk)
 
-            vault = Vault(
-                cdp_id=cdp_number,
-                address=urn_address,
-                owner_proxy=owner_proxy_address,
-                owner=await cdp_owner,
-                debt=collateral_and_debt[1],
-                collateral=collateral_and_debt[0],
-                ilk=ilk,
-                current_price=current_price
-            )
+        vault = Vault(
+            cdp_id=cdp_number,
+            address=urn_address,
+            owner_proxy=owner_proxy_address,
+            owner=cdp_owner,
+            debt=collateral_and_debt[1],
+            collateral=collateral_and_debt[0],
+            ilk=ilk,
+            current_price=current_price
+        )
 
-            if not vault.is_secured:
-                self.logger.notification(f"vault #{cdp_number} is not secured. \n{vault.to_dict()}", extra=vault.to_dict())
-                self.liquidation_queue.put(vault)
-            self.logger.debug(f"finish check cdp #{cdp_number}", extra=vault.to_dict())
-            return vault  #
-        except requests.exceptions.ReadTimeout:
-            return await self.check_cdp(cdp_number)
-        except Exception as e:
-            self.logger.error(f"failed check vault #{cdp_number}", exc_info=e)
-            return await self.check_cdp(cdp_number)
+        self.report_vault(vault)
+        self.logger.debug(f"finish check cdp #{cdp_number}", extra=vault.to_dict())
+        return vault
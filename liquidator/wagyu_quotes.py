@@ -0,0 +1,160 @@
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from velero_bot_sdk import WagyuContractConnector
+from web3 import Web3
+
+from liquidator.multicall import Call, Multicall, batches
+from liquidator.retry import RetryPolicy
+
+FACTORY_ABI = [
+    {"inputs": [{"type": "address"}, {"type": "address"}], "name": "getPair", "outputs": [{"type": "address"}],
+     "stateMutability": "view", "type": "function"},
+    {"inputs": [], "name": "allPairsLength", "outputs": [{"type": "uint256"}], "stateMutability": "view",
+     "type": "function"},
+    {"inputs": [{"type": "uint256"}], "name": "allPairs", "outputs": [{"type": "address"}],
+     "stateMutability": "view", "type": "function"},
+]
+PAIR_ABI = [
+    {"inputs": [], "name": "getReserves",
+     "outputs": [{"type": "uint112"}, {"type": "uint112"}, {"type": "uint32"}],
+     "stateMutability": "view", "type": "function"},
+    {"inputs": [], "name": "token0", "outputs": [{"type": "address"}], "stateMutability": "view", "type": "function"},
+    {"inputs": [], "name": "token1", "outputs": [{"type": "address"}], "stateMutability": "view", "type": "function"},
+]
+ROUTER_ABI = [
+    {"inputs": [], "name": "factory", "outputs": [{"type": "address"}], "stateMutability": "view", "type": "function"},
+]
+
+ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+
+class Pair:
+    address: str
+    token0: str
+    token1: str
+    reserve0: int = 0
+    reserve1: int = 0
+
+    def __init__(self, address: str, token0: str, token1: str):
+        self.address = address
+        self.token0 = token0
+        self.token1 = token1
+
+    def reserves(self, token_in: str) -> Tuple[int, int]:
+        if Web3.toChecksumAddress(token_in) == self.token0:
+            return self.reserve0, self.reserve1
+        return self.reserve1, self.reserve0
+
+
+# Constant product quotes of the Wagyu router computed in-process. The reserves of the watched pairs, the ones that
+# were quoted or are on a route that was searched in the last watch_blocks blocks, are read again with one Multicall
+# request when a new block is seen, so the quotes of all active auctions in a block cost at most one RPC call. The
+# other pairs the RouteFinder knows are not read until a route goes over them.
+class WagyuQuotes:
+    fee_numerator: int
+    fee_denominator: int
+    watch_blocks: int
+
+    _block_number: int = -1
+
+    def __init__(self, wagyu: WagyuContractConnector, router_address: str, multicall: Multicall,
+                 block_number: Callable[[], int], fee_numerator: int = 997, fee_denominator: int = 1000,
+                 batch_size: int = 200, watch_blocks: int = 100, retry_policy: RetryPolicy = None):
+        self.web3 = wagyu.web3
+        self.multicall = multicall
+        self.block_number = block_number
+        self.fee_numerator = fee_numerator
+        self.fee_denominator = fee_denominator
+        self.batch_size = batch_size
+        self.watch_blocks = watch_blocks
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        router = self.web3.eth.contract(address=router_address, abi=ROUTER_ABI)
+        self.factory = self.web3.eth.contract(address=router.caller.factory(), abi=FACTORY_ABI)
+        self.pairs: Dict[Tuple[str, str], Optional[Pair]] = {}
+        # pair key -> block in which the pair was last quoted
+        self.watched: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pair_key(token_a: str, token_b: str) -> Tuple[str, str]:
+        token_a, token_b = Web3.toChecksumAddress(token_a), Web3.toChecksumAddress(token_b)
+        return (token_a, token_b) if token_a.lower() < token_b.lower() else (token_b, token_a)
+
+    def get_pair(self, token_a: str, token_b: str) -> Pair:
+        key = self.pair_key(token_a, token_b)
+        with self._lock:
+            if key not in self.pairs:
+                address = self.retry_policy.call(lambda: self.factory.caller.getPair(*key))
+                self.pairs[key] = Pair(address, *key) if address != ZERO_ADDRESS else None
+                self._block_number = -1
+            self._watch([key])
+            self.refresh()
+            pair = self.pairs[key]
+        if pair is None:
+            raise ValueError(f"Wagyu pair {key[0]}/{key[1]} does not exist")
+        return pair
+
+    def add_pair(self, pair: Pair):
+        with self._lock:
+            self.pairs[self.pair_key(pair.token0, pair.token1)] = pair
+            self._block_number = -1
+
+    def reserves(self, keys: Iterable[Tuple[str, str]] = None) -> Dict[Tuple[str, str], Tuple[int, int]]:
+        # reserves in the current block of the given known pairs, of all watched pairs without keys
+        with self._lock:
+            if keys is not None:
+                keys = list(keys)
+                self._watch(keys)
+            self.refresh()
+            pairs = map(lambda x: (x, self.pairs.get(x)), self.watched if keys is None else keys)
+            return {key: (pair.reserve0, pair.reserve1) for key, pair in pairs if pair is not None}
+
+    def _watch(self, keys: Iterable[Tuple[str, str]]):
+        block_number = self.block_number()
+        for key in keys:
+            if key not in self.watched:
+                # its reserves are read with the next refresh, even in the same block
+                self._block_number = -1
+            self.watched[key] = block_number
+
+    def refresh(self):
+        block_number = self.block_number()
+        if block_number <= self._block_number:
+            return
+
+        for key in [x for x, watched_at in self.watched.items() if block_number - watched_at > self.watch_blocks]:
+            del self.watched[key]
+        pair_contract = self.web3.eth.contract(abi=PAIR_ABI)
+        for pairs in batches(filter(None, map(self.pairs.get, self.watched)), self.batch_size):
+            calls = list(map(lambda x: Call(pair_contract(address=x.address).functions.getReserves()), pairs))
+            _, results = self.retry_policy.call(lambda: self.multicall.aggregate(calls))
+            for pair, (reserve0, reserve1, _) in zip(pairs, results):
+                pair.reserve0, pair.reserve1 = reserve0, reserve1
+        self._block_number = block_number
+
+    def get_amount_out(self, amount_in: int, reserve_in: int, reserve_out: int) -> int:
+        if amount_in <= 0 or reserve_in <= 0 or reserve_out <= 0:
+            return 0
+        amount_in_with_fee = amount_in * self.fee_numerator
+        return amount_in_with_fee * reserve_out // (reserve_in * self.fee_denominator + amount_in_with_fee)
+
+    def get_amount_in(self, amount_out: int, reserve_in: int, reserve_out: int) -> int:
+        if amount_out >= reserve_out:
+            raise ValueError("insufficient Wagyu liquidity")
+        numerator = reserve_in * amount_out * self.fee_denominator
+        denominator = (reserve_out - amount_out) * self.fee_numerator
+        return numerator // denominator + 1
+
+    def get_amounts_out(self, amount_in: int, path: List[str]) -> List[int]:
+        amounts = [int(amount_in)]
+        for token_in, token_out in zip(path, path[1:]):
+            amounts.append(self.get_amount_out(amounts[-1], *self.get_pair(token_in, token_out).reserves(token_in)))
+        return amounts
+
+    def get_amounts_in(self, amount_out: int, path: List[str]) -> List[int]:
+        amounts = [int(amount_out)]
+        for token_in, token_out in reversed(list(zip(path, path[1:]))):
+            amounts.insert(0, self.get_amount_in(amounts[0], *self.get_pair(token_in, token_out).reserves(token_in)))
+        return amounts
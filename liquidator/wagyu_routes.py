@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+from web3 import Web3
+
+from liquidator.multicall import Call, Multicall, batches
+from liquidator.retry import RetryPolicy
+from liquidator.wagyu_quotes import PAIR_ABI, Pair, WagyuQuotes
+
+
+class Route:
+    path: List[str]
+    amount_in: int
+    amount_out: int
+
+    def __init__(self, path: List[str], amount_in: int, amount_out: int):
+        self.path = path
+        self.amount_in = amount_in
+        self.amount_out = amount_out
+
+    def __repr__(self):
+        return f"Route({' -> '.join(self.path)}, in={self.amount_in}, out={self.amount_out})"
+
+
+# Best swap routes over the graph of all Wagyu pairs. The pairs are listed from the factory and their reserves come
+# from the shared WagyuQuotes cache, so a route search costs no RPC calls once the reserves of the block are read.
+# Only the max_paths shortest paths are searched, a path is only extended over tokens from which token_out can still
+# be reached within max_hops, and only the pairs on these paths are watched by the cache.
+# A large lot can be split over several routes: it is cut into equal parts and every part goes to the route that
+# gives the most for it, with the reserves moved by the parts placed before.
+class RouteFinder:
+    max_hops: int
+    max_splits: int
+    max_paths: int
+    split_parts: int
+    pairs_ttl: float
+
+    _pairs_count: int = 0
+    _pairs_checked_at: float = 0
+
+    def __init__(self, quotes: WagyuQuotes, multicall: Multicall, max_hops: int = 3, max_splits: int = 1,
+                 max_paths: int = 20, split_parts: int = 10, pairs_ttl: float = 600, batch_size: int = 200,
+                 retry_policy: RetryPolicy = None, **kwargs):
+        self.quotes = quotes
+        self.multicall = multicall
+        self.max_hops = max_hops
+        self.max_splits = max_splits
+        self.max_paths = max_paths
+        self.split_parts = split_parts
+        self.pairs_ttl = pairs_ttl
+        self.batch_size = batch_size
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.graph: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+        self.logger = kwargs.get("logger", logging.getLogger(self.__class__.__name__))
+
+    def load_pairs(self):
+        with self._lock:
+            if time.monotonic() - self._pairs_checked_at < self.pairs_ttl:
+                return
+            factory = self.quotes.factory
+            count = self.retry_policy.call(factory.caller.allPairsLength)
+
+            pair_contract = self.quotes.web3.eth.contract(abi=PAIR_ABI)
+            for indexes in batches(range(self._pairs_count, count), self.batch_size):
+                calls = list(map(lambda x: Call(factory.functions.allPairs(x)), indexes))
+                _, addresses = self.retry_policy.call(lambda: self.multicall.aggregate(calls))
+                calls = []
+                for address in addresses:
+                    calls.append(Call(pair_contract(address=address).functions.token0()))
+                    calls.append(Call(pair_contract(address=address).functions.token1()))
+                _, tokens = self.retry_policy.call(lambda: self.multicall.aggregate(calls))
+
+                for i, address in enumerate(addresses):
+                    token0, token1 = tokens[i * 2], tokens[i * 2 + 1]
+                    self.quotes.add_pair(Pair(address, token0, token1))
+                    self.graph.setdefault(token0, set()).add(token1)
+                    self.graph.setdefault(token1, set()).add(token0)
+
+            if count > self._pairs_count:
+                self.logger.info(f"loaded {count - self._pairs_count} Wagyu pairs, {count} in total")
+            self._pairs_count = count
+            self._pairs_checked_at = time.monotonic()
+
+    def paths(self, token_in: str, token_out: str) -> List[List[str]]:
+        self.load_pairs()
+        token_in, token_out = Web3.toChecksumAddress(token_in), Web3.toChecksumAddress(token_out)
+
+        # breadth first, so the paths with the fewest swaps are found first
+        distances = self.distances(token_out)
+        result = []
+        queue = deque([[token_in]])
+        while queue and len(result) < self.max_paths:
+            path = queue.popleft()
+            for token in self.graph.get(path[-1], ()):
+                if token == token_out:
+                    result.append(path + [token])
+                elif token not in path and len(path) + distances.get(token, self.max_hops) <= self.max_hops:
+                    queue.append(path + [token])
+        return result[:self.max_paths]
+
+    def distances(self, token: str) -> Dict[str, int]:
+        # number of swaps to token from the tokens that are less than max_hops swaps away
+        distances = {token: 0}
+        frontier = [token]
+        for hops in range(1, self.max_hops):
+            reached = []
+            for neighbour in (x for t in frontier for x in self.graph.get(t, ())):
+                if neighbour not in distances:
+                    distances[neighbour] = hops
+                    reached.append(neighbour)
+            frontier = reached
+        return distances
+
+    @staticmethod
+    def pair_keys(paths: List[List[str]]) -> Set[Tuple[str, str]]:
+        return {WagyuQuotes.pair_key(x, y) for path in paths for x, y in zip(path, path[1:])}
+
+    def amounts_out(self, amount_in: int, path: List[str], reserves: Dict[Tuple[str, str], Tuple[int, int]]) -> int:
+        amount = int(amount_in)
+        for token_in, token_out in zip(path, path[1:]):
+            amount = self.quotes.get_amount_out(amount, *self._reserves(reserves, token_in, token_out))
+        return amount
+
+    def amounts_in(self, amount_out: int, path: List[str], reserves: Dict[Tuple[str, str], Tuple[int, int]]) -> int:
+        amount = int(amount_out)
+        for token_in, token_out in reversed(list(zip(path, path[1:]))):
+            amount = self.quotes.get_amount_in(amount, *self._reserves(reserves, token_in, token_out))
+        return amount
+
+    def best_route_out(self, token_in: str, token_out: str, amount_in: int) -> Optional[Route]:
+        # the route that gives the most token_out for an exact amount_in
+        paths = self.paths(token_in, token_out)
+        reserves = self.quotes.reserves(self.pair_keys(paths))
+        routes = [Route(path, int(amount_in), self.amounts_out(amount_in, path, reserves)) for path in paths]
+        return max(routes, key=lambda x: x.amount_out, default=None)
+
+    def best_route_in(self, token_in: str, token_out: str, amount_out: int) -> Optional[Route]:
+        # the route that needs the least token_in for an exact amount_out
+        paths = self.paths(token_in, token_out)
+        reserves = self.quotes.reserves(self.pair_keys(paths))
+        routes = []
+        for path in paths:
+            try:
+                routes.append(Route(path, self.amounts_in(amount_out, path, reserves), int(amount_out)))
+            except ValueError:
+                # not enough liquidity on this path
+                continue
+        return min(routes, key=lambda x: x.amount_in, default=None)
+
+    def split_routes(self, token_in: str, token_out: str, amount_in: int) -> List[Route]:
+        paths = self.paths(token_in, token_out)
+        reserves = self.quotes.reserves(self.pair_keys(paths))
+        candidates = sorted(paths, key=lambda x: self.amounts_out(amount_in, x, reserves),
+                            reverse=True)[:self.max_splits]
+        if len(candidates) <= 1:
+            route = self.best_route_out(token_in, token_out, amount_in)
+            return [route] if route is not None else []
+
+        parts = [int(amount_in) // self.split_parts] * self.split_parts
+        parts[-1] += int(amount_in) - sum(parts)
+
+        reserves = dict(reserves)
+        allocated = [0] * len(candidates)
+        for part in filter(None, parts):
+            outs = [self.amounts_out(part, path, reserves) for path in candidates]
+            best = max(range(len(candidates)), key=lambda x: outs[x])
+            allocated[best] += part
+            self._apply_swap(reserves, part, candidates[best])
+
+        reserves = self.quotes.reserves(self.pair_keys(candidates))
+        return [Route(path, amount, self.amounts_out(amount, path, reserves))
+                for path, amount in zip(candidates, allocated) if amount > 0]
+
+    def _apply_swap(self, reserves: Dict[Tuple[str, str], Tuple[int, int]], amount_in: int, path: List[str]):
+        amount = amount_in
+        for token_in, token_out in zip(path, path[1:]):
+            reserve_in, reserve_out = self._reserves(reserves, token_in, token_out)
+            amount_out = self.quotes.get_amount_out(amount, reserve_in, reserve_out)
+            key = WagyuQuotes.pair_key(token_in, token_out)
+            if key[0] == Web3.toChecksumAddress(token_in):
+                reserves[key] = (reserve_in + amount, reserve_out - amount_out)
+            else:
+                reserves[key] = (reserve_out - amount_out, reserve_in + amount)
+            amount = amount_out
+
+    @staticmethod
+    def _reserves(reserves: Dict[Tuple[str, str], Tuple[int, int]], token_in: str, token_out: str) -> Tuple[int, int]:
+        key = WagyuQuotes.pair_key(token_in, token_out)
+        reserve0, reserve1 = reserves.get(key, (0, 0))
+        return (reserve0, reserve1) if key[0] == Web3.toChecksumAddress(token_in) else (reserve1, reserve0)
@@ -1,42 +1,186 @@
 import logging
+import multiprocessing
+import os
+import signal
 import threading
-from queue import Queue
+from typing import List, Optional
 
 import web3
 
 from velero_bot_sdk import DssContractsConnector, WagyuContractConnector, VELERO_DEFAULT_ABI_DIR
 
 import config
+from liquidator.blocks import BlockNotifier
+from liquidator.gas import URGENCY_BARK, URGENCY_DEFAULT, URGENCY_TAKE, GasStrategy, UrgencyProfile
+from liquidator.ilk_cache import IlkCache
+from liquidator.multicall import Multicall
+from liquidator.receipts import ReceiptWatcher
+from liquidator.retry import DeadLetters, RetryPolicy
+from liquidator.rpc import BatchingHTTPProvider, PooledHTTPProvider
+from liquidator.runtime import Runtime
+from liquidator.scheduler import ScanTier
+from liquidator.sharding import LeaderLease, Shard, ShardRouter, VaultInbox
+from liquidator.state_store import StateStore
+from liquidator.transactions import TransactionSender
 from liquidator.utils import setup_logging
 from liquidator.viewer import Viewer
+from liquidator.wagyu_quotes import WagyuQuotes
+from liquidator.wagyu_routes import RouteFinder
 from liquidator.liquidations.Liquidator import Liquidator
+from liquidator.liquidations.unsafe_vaults import UnsafeVaultQueue
+
+
+def create_dss(account) -> DssContractsConnector:
+    dss = DssContractsConnector(http_rpc_url=config.RPC_URL, abi_dir=VELERO_DEFAULT_ABI_DIR,
+                                chain_log_addr=config.CHAIN_LOG_ADDRESS,
+                                external_block_explorer_url=config.EXTERNAL_BLOCK_EXPLORER_URL,
+                                account=account, rpc_timeout=10)
+    BotLiquidator.setup_providers(dss.web3)
+    return dss
+
+
+def create_viewer(queue, dss: DssContractsConnector, ilk_cache: IlkCache, blocks: BlockNotifier, store: StateStore,
+                  retry_policy: RetryPolicy, dead_letters: DeadLetters, shard: Shard, runtime: Runtime) -> Viewer:
+    return Viewer(queue=queue, dss=dss, ilk_cache=ilk_cache,
+                  scan_mode=config.VIEWER_SCAN_MODE,
+                  multicall_batch_size=config.MULTICALL_BATCH_SIZE, rpc_url=config.RPC_URL,
+                  rpc_concurrency=config.RPC_CONCURRENCY, log_block_range=config.LOG_BLOCK_RANGE,
+                  interval=config.VIEWER_INTERVAL, scan_tiers=[
+                      ScanTier("hot", config.HOT_TIER_MARGIN, config.HOT_TIER_INTERVAL),
+                      ScanTier("warm", config.WARM_TIER_MARGIN, config.WARM_TIER_INTERVAL),
+                      ScanTier("cold", None, config.COLD_TIER_INTERVAL),
+                  ], blocks=blocks, store=store, retry_policy=retry_policy, dead_letters=dead_letters, shard=shard,
+                  runtime=runtime, concurrency=config.VIEWER_CONCURRENCY)
+
+
+def shared_path(path: str, lease_path: str) -> str:
+    # a relative path of a file that all instances use is taken from the directory of the lease, the shared volume
+    if not path or not lease_path or os.path.isabs(path):
+        return path
+    return os.path.join(os.path.dirname(os.path.abspath(lease_path)), path)
+
+
+def create_retry_policy() -> RetryPolicy:
+    return RetryPolicy(max_attempts=config.RETRY_MAX_ATTEMPTS, base_delay=config.RETRY_BASE_DELAY,
+                       max_delay=config.RETRY_MAX_DELAY)
+
+
+def run_viewer_process(shard: Shard, queue: multiprocessing.Queue):
+    # one of the SHARD_PROCESSES scan processes, the unsafe vaults of its shard go to the main process
+    setup_logging(
+        tg_bot_key=config.TG_BOT_KEY,
+        tg_chat_id=config.TG_CHAT_ID,
+        is_debug=config.IS_DEBUG,
+        is_only_notificator=config.IS_ONLY_NOTIFICATOR
+    )
+    dss = create_dss(web3.Web3().eth.account.from_key(config.AUCTIONEER_PK))
+    store = StateStore(shard.store_path(config.STATE_DB_PATH)) if config.STATE_DB_PATH else None
+    ilk_cache = IlkCache(dss=dss, block_ttl=config.BLOCK_CACHE_TTL)
+    blocks = BlockNotifier(web3=dss.web3, ws_url=config.WS_RPC_URL, poll_interval=config.BLOCK_POLL_INTERVAL)
+    blocks.subscribe(ilk_cache.set_block_number)
+    runtime = Runtime(executor_workers=config.RUNTIME_EXECUTOR_WORKERS)
+    viewer = create_viewer(queue=queue, dss=dss, ilk_cache=ilk_cache, blocks=blocks, store=store,
+                           retry_policy=create_retry_policy(), dead_letters=DeadLetters(store=store), shard=shard,
+                           runtime=runtime)
+
+    def stop(*_):
+        viewer.stop()
+        blocks.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    runtime_thread = runtime.start_thread()
+    blocks_thread = threading.Thread(target=blocks.start, name="blocks_thread")
+    blocks_thread.start()
+    logging.getLogger("BotLiquidator").info(f"Start scan of {shard}")
+    try:
+        viewer.start()
+    finally:
+        stop()
+        blocks_thread.join()
+        runtime.stop()
+        runtime_thread.join()
+        if store is not None:
+            store.close()
 
 
 class BotLiquidator:
-    viewer: Viewer
-    liquidator: Liquidator
+    viewer: Optional[Viewer]
+    liquidator: Optional[Liquidator] = None
+    alive: bool = False
 
     _viewer_thread: threading.Thread
+    _blocks_thread: threading.Thread
+    _runtime_thread: threading.Thread
     _liquidator_thread: threading.Thread
+    _receipts_thread: threading.Thread
+    _router_thread: threading.Thread
+    _lease_thread: threading.Thread
+    _viewer_processes: List[multiprocessing.Process]
 
-    unsafe_vaults_queue: Queue
+    unsafe_vaults_queue: UnsafeVaultQueue
 
     dss: DssContractsConnector
     wagyu: WagyuContractConnector
+    quotes: WagyuQuotes
+    routes: RouteFinder
+    sender: TransactionSender
+    receipts: ReceiptWatcher
+    ilk_cache: IlkCache
+    blocks: BlockNotifier
+    store: StateStore
+    runtime: Runtime
+    retry_policy: RetryPolicy
+    dead_letters: DeadLetters
+    shard: Shard
+    lease: Optional[LeaderLease]
+    router: ShardRouter
 
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
 
-        self.unsafe_vaults_queue = Queue()
+        self.unsafe_vaults_queue = UnsafeVaultQueue()
+        self._stopped = threading.Event()
+        self._viewer_processes = []
 
         account = web3.Web3().eth.account.from_key(config.AUCTIONEER_PK)
         self.is_only_notificator = config.IS_ONLY_NOTIFICATOR
         self.logger.info(f"Initialization DSS")
-        self.dss = DssContractsConnector(http_rpc_url=config.RPC_URL, abi_dir=VELERO_DEFAULT_ABI_DIR,
-                                         chain_log_addr=config.CHAIN_LOG_ADDRESS,
-                                         external_block_explorer_url=config.EXTERNAL_BLOCK_EXPLORER_URL,
-                                         account=account, rpc_timeout=10)
-        self.viewer = Viewer(queue=self.unsafe_vaults_queue, dss=self.dss)
+        self.dss = create_dss(account)
+        lease_path = config.LEADER_LEASE_PATH if self.is_only_notificator is False else ""
+        if lease_path and not config.STATE_DB_PATH:
+            raise ValueError(f"STATE_DB_PATH is required with LEADER_LEASE_PATH, a new leader finishes the "
+                             f"liquidations of the previous one from it")
+        # with a leader lease the liquidation steps are kept in a file on the shared volume, so the instance that
+        # takes over the lease resumes the takes, exits, paybacks and joins the previous leader has not finished
+        self.store = StateStore(shared_path(config.STATE_DB_PATH, lease_path)) if config.STATE_DB_PATH else None
+        self.retry_policy = create_retry_policy()
+        # hosts the pipeline stages, the auction checker and the vault scans
+        self.runtime = Runtime(executor_workers=config.RUNTIME_EXECUTOR_WORKERS)
+        self.dead_letters = DeadLetters(store=self.store)
+
+        # only the leader sends transactions, the other instances hand their unsafe vaults to it
+        self.shard = Shard(config.SHARD_INDEX, config.SHARD_COUNT, by=config.SHARD_BY,
+                           range_size=config.SHARD_RANGE_SIZE)
+        self.lease = LeaderLease(lease_path, ttl=config.LEADER_LEASE_TTL) if lease_path else None
+        self._processes_queue = multiprocessing.get_context("spawn").Queue() if config.SHARD_PROCESSES > 1 else None
+        self.router = ShardRouter(queue=self.unsafe_vaults_queue, lease=self.lease,
+                                  inbox=VaultInbox(shared_path(config.SHARD_INBOX_PATH, lease_path))
+                                  if self.lease is not None else None,
+                                  processes_queue=self._processes_queue)
+
+        self.ilk_cache = IlkCache(dss=self.dss, block_ttl=config.BLOCK_CACHE_TTL)
+        self.blocks = BlockNotifier(web3=self.dss.web3, ws_url=config.WS_RPC_URL,
+                                    poll_interval=config.BLOCK_POLL_INTERVAL)
+        self.blocks.subscribe(self.ilk_cache.set_block_number)
+        self.viewer = None
+        if config.SHARD_PROCESSES <= 1:
+            viewer_store = self.store
+            # the vault index is synced by every instance on its own, it is not shared with the other instances
+            if config.STATE_DB_PATH and (self.shard.count > 1 or self.lease is not None):
+                viewer_store = StateStore(self.shard.store_path(config.STATE_DB_PATH))
+            self.viewer = create_viewer(queue=self.router, dss=self.dss, ilk_cache=self.ilk_cache, blocks=self.blocks,
+                                        store=viewer_store, retry_policy=self.retry_policy,
+                                        dead_letters=self.dead_letters, shard=self.shard, runtime=self.runtime)
         self.logger.info(f"Initialization Wagyu")
 
         if self.is_only_notificator is False:
@@ -46,25 +190,174 @@ class BotLiquidator:
                                                 slippage=config.WAGYU_SLIPPAGE,
                                                 external_block_explorer_url=config.EXTERNAL_BLOCK_EXPLORER_URL,
                                                 account=account, rpc_timeout=10)
+            self.setup_providers(self.wagyu.web3)
+            self.quotes, self.routes = None, None
+            if config.WAGYU_LOCAL_QUOTES is True:
+                self.quotes = WagyuQuotes(wagyu=self.wagyu, router_address=config.WAGYU_ROUTER_ADDRESS,
+                                          multicall=Multicall(self.dss.multicall),
+                                          block_number=lambda: self.ilk_cache.block_number,
+                                          fee_numerator=config.WAGYU_FEE_NUMERATOR, retry_policy=self.retry_policy)
+                if config.WAGYU_MAX_HOPS > 0:
+                    self.routes = RouteFinder(quotes=self.quotes, multicall=Multicall(self.dss.multicall),
+                                              max_hops=config.WAGYU_MAX_HOPS, max_splits=config.WAGYU_MAX_SPLITS,
+                                              max_paths=config.WAGYU_MAX_PATHS,
+                                              retry_policy=self.retry_policy)
 
-            self.liquidator = Liquidator(queue=self.unsafe_vaults_queue, dss=self.dss, wagyu=self.wagyu,
-                                         percent_price_delta=config.PERCENT_PRICE_DELTA, make_payback=config.MAKE_PAYBACK)
+            self.sender = None
+            if config.LOCAL_NONCES is True:
+                max_gas_price = int(config.MAX_GAS_PRICE_GWEI * 10 ** 9) or None
+                urgent_replace_after, urgent_escalation = config.URGENT_TX_REPLACE_AFTER, config.URGENT_GAS_ESCALATION
+                if max_gas_price is None:
+                    # escalating every few seconds without a cap has no upper bound on the price
+                    self.logger.warning(f"MAX_GAS_PRICE_GWEI is not set, bark and take transactions are re-sent "
+                                        f"after {config.STUCK_TX_TIMEOUT} seconds like the others")
+                    urgent_replace_after, urgent_escalation = config.STUCK_TX_TIMEOUT, 1.125
+                gas = GasStrategy(web3=self.dss.web3, block_number=lambda: self.ilk_cache.block_number,
+                                  history_blocks=config.GAS_HISTORY_BLOCKS, profiles=[
+                                      UrgencyProfile(URGENCY_DEFAULT, reward_percentile=50,
+                                                     replace_after=config.STUCK_TX_TIMEOUT,
+                                                     max_gas_price=max_gas_price),
+                                      *[UrgencyProfile(x, reward_percentile=config.URGENT_GAS_PERCENTILE,
+                                                       replace_after=urgent_replace_after,
+                                                       escalation=urgent_escalation,
+                                                       max_gas_price=max_gas_price)
+                                        for x in (URGENCY_BARK, URGENCY_TAKE)]])
+                self.sender = TransactionSender(web3=self.dss.web3, account=account,
+                                                stuck_timeout=config.STUCK_TX_TIMEOUT, gas=gas,
+                                                can_send=lambda: self.lease is None or self.lease.is_leader)
+                self.blocks.subscribe(lambda x: self.runtime.spawn(self.maintain_sender(x)))
+            self.receipts = ReceiptWatcher(web3=self.dss.web3, blocks=self.blocks,
+                                           confirmations=config.RECEIPT_CONFIRMATIONS,
+                                           timeout_blocks=config.RECEIPT_TIMEOUT_BLOCKS,
+                                           replacement_chain=self.sender.nonces.replacement_chain
+                                           if self.sender else None)
+
+    async def maintain_sender(self, block_number: int):
+        # on the runtime executor, a slow node does not hold up the delivery of the block to the other subscribers
+        try:
+            await self.runtime.run_blocking(self.sender.maintain, block_number)
+        except Exception as e:
+            self.logger.error(f"failed to maintain the pending transactions at block {block_number}", exc_info=e)
+
+    def create_liquidator(self) -> Liquidator:
+        # a new one on every election, it resumes the unfinished liquidations from the store
+        return Liquidator(queue=self.unsafe_vaults_queue, dss=self.dss, wagyu=self.wagyu,
+                          percent_price_delta=config.PERCENT_PRICE_DELTA, make_payback=config.MAKE_PAYBACK,
+                          ilk_cache=self.ilk_cache, blocks=self.blocks, quotes=self.quotes,
+                          routes=self.routes, sender=self.sender,
+                          receipts=self.receipts,
+                          simulation_block=config.SIMULATION_BLOCK if config.SIMULATE_TXS else None,
+                          batch_window=config.EXIT_BATCH_WINDOW, batch_size=config.EXIT_BATCH_SIZE,
+                          store=self.store, retry_policy=self.retry_policy,
+                          dead_letters=self.dead_letters, runtime=self.runtime,
+                          setup_concurrency=config.SETUP_CONCURRENCY, liquidation_concurrency=config.TAKE_CONCURRENCY,
+                          exit_concurrency=config.EXIT_CONCURRENCY, payback_concurrency=config.PAYBACK_CONCURRENCY,
+                          join_concurrency=config.JOIN_CONCURRENCY)
+
+    @staticmethod
+    def setup_providers(w3: web3.Web3):
+        providers = []
+        for rpc_url in config.RPC_URLS:
+            if config.RPC_BATCH_WINDOW > 0:
+                providers.append(BatchingHTTPProvider(endpoint_uri=rpc_url, request_kwargs={"timeout": 10},
+                                                      batch_window=config.RPC_BATCH_WINDOW / 1000,
+                                                      max_batch_size=config.RPC_BATCH_MAX_SIZE))
+            else:
+                providers.append(web3.HTTPProvider(endpoint_uri=rpc_url, request_kwargs={"timeout": 10}))
+        if len(providers) == 1:
+            # a breaker in front of the only node would only turn its slow answers into errors
+            w3.provider = providers[0]
+            return
+        w3.provider = PooledHTTPProvider(providers, hedge=config.RPC_HEDGE,
+                                         min_hedge_delay=config.RPC_HEDGE_MIN_DELAY / 1000,
+                                         breaker_threshold=config.RPC_BREAKER_THRESHOLD,
+                                         breaker_timeout=config.RPC_BREAKER_TIMEOUT,
+                                         max_block_lag=config.RPC_MAX_BLOCK_LAG,
+                                         health_max_age=config.RPC_HEALTH_MAX_AGE,
+                                         probe_interval=config.RPC_PROBE_INTERVAL)
 
     def start(self):
-        self._viewer_thread = threading.Thread(target=self.viewer.start, name="viewer_thread")
-        self._viewer_thread.start()
+        self.alive = True
+        self.dead_letters.load()
+        self._runtime_thread = self.runtime.start_thread()
+        self._blocks_thread = threading.Thread(target=self.blocks.start, name="blocks_thread")
+        self._blocks_thread.start()
+        if self.viewer is not None:
+            self._viewer_thread = threading.Thread(target=self.viewer.start, name="viewer_thread")
+            self._viewer_thread.start()
+        if self._processes_queue is not None:
+            context = multiprocessing.get_context("spawn")
+            for shard in self.shard.split(config.SHARD_PROCESSES):
+                process = context.Process(target=run_viewer_process, args=(shard, self._processes_queue),
+                                          name=f"viewer_{shard.index}")
+                process.start()
+                self._viewer_processes.append(process)
+        self._router_thread = threading.Thread(target=self.router.start, name="router_thread")
+        self._router_thread.start()
+        if self.lease is not None:
+            self._lease_thread = threading.Thread(target=self.lease.start, name="lease_thread")
+            self._lease_thread.start()
         if self.is_only_notificator is False:
-            self._liquidator_thread = threading.Thread(target=self.liquidator.start, name="liquidator_thread")
+            self._receipts_thread = threading.Thread(target=self.receipts.start, name="receipts_thread")
+            self._receipts_thread.start()
+            if self.lease is None:
+                self.liquidator = self.create_liquidator()
+                self._liquidator_thread = threading.Thread(target=self.liquidator.start, name="liquidator_thread")
+            else:
+                self._liquidator_thread = threading.Thread(target=self.lead, name="leader_thread")
             self._liquidator_thread.start()
 
+    def lead(self):
+        # the liquidator runs while this instance holds the lease, a demoted leader stops it before the lease can
+        # pass to another instance
+        while self.alive:
+            if not self.lease.wait(leader=True, timeout=self.lease.ttl):
+                continue
+            self.liquidator = self.create_liquidator()
+            thread = threading.Thread(target=self.liquidator.start, name="liquidator_thread")
+            thread.start()
+            # a lease that is not renewed runs out without a notification, so it is checked every second
+            while self.alive and not self.lease.wait(leader=False, timeout=1):
+                pass
+            self.liquidator.stop()
+            thread.join()
+
+    def wait(self):
+        while self.alive:
+            self._stopped.wait(1)
+
     def stop(self):
-        self.viewer.stop()
+        self.alive = False
+        self._stopped.set()
+        if self.viewer is not None:
+            self.viewer.stop()
+        list(map(lambda x: x.terminate(), self._viewer_processes))
+        self.router.stop()
         if self.is_only_notificator is False:
-            self.liquidator.stop()
+            if self.liquidator is not None:
+                self.liquidator.stop()
+            self.receipts.stop()
+        if self.lease is not None:
+            self.lease.stop()
+        self.blocks.stop()
 
-        self._viewer_thread.join()
+        if self.viewer is not None:
+            self._viewer_thread.join()
+        list(map(lambda x: x.join(), self._viewer_processes))
+        self._router_thread.join()
         if self.is_only_notificator is False:
             self._liquidator_thread.join()
+            self._receipts_thread.join()
+        if self.lease is not None:
+            self._lease_thread.join()
+        self._blocks_thread.join()
+        # the last one, the viewer and the liquidator finish their tasks before they stop
+        self.runtime.stop()
+        self._runtime_thread.join()
+        if self.viewer is not None and self.viewer.store is not None and self.viewer.store is not self.store:
+            self.viewer.store.close()
+        if self.store is not None:
+            self.store.close()
 
 
 if __name__ == '__main__':
@@ -74,9 +367,12 @@ if __name__ == '__main__':
         is_debug=config.IS_DEBUG,
         is_only_notificator=config.IS_ONLY_NOTIFICATOR
     )
+    # docker stop sends SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     bot = BotLiquidator()
     try:
         bot.start()
+        bot.wait()
     except KeyboardInterrupt:
         pass
     finally:
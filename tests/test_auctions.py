@@ -0,0 +1,76 @@
+from decimal import Decimal
+
+from liquidator.liquidations.auctions import AuctionRegistry
+
+
+class Auction:
+    take_tx = None
+    is_completed = False
+
+    def __init__(self, ilk: str, liquidation_id: int, priority: tuple):
+        self.key = (ilk, liquidation_id)
+        self.priority = priority
+
+    def seconds_to_take(self) -> float:
+        return 0
+
+
+def test_auctions_are_handed_out_by_priority():
+    registry = AuctionRegistry()
+    auctions = {1: Auction("ETH-A", 1, (2, 100)), 2: Auction("ETH-A", 2, (1, Decimal("-5"))),
+                3: Auction("ETH-A", 3, (0, Decimal("0")))}
+    registry.sync("ETH-A", [1, 2, 3], lambda x: auctions[x])
+
+    assert [registry.get().key[1] for _ in range(3)] == [3, 2, 1]
+
+
+def test_sync_moves_a_queued_auction_whose_priority_changed():
+    registry = AuctionRegistry()
+    auctions = {1: Auction("ETH-A", 1, (1, Decimal("-5"))), 2: Auction("ETH-A", 2, (1, Decimal("-3")))}
+    registry.sync("ETH-A", [1, 2], lambda x: auctions[x])
+
+    # the price of the second auction decayed, it is worth more now
+    auctions[2].priority = (1, Decimal("-8"))
+    registry.sync("ETH-A", [1, 2], lambda x: auctions[x])
+
+    assert registry.qsize() == 2
+    assert registry.get().key == ("ETH-A", 2)
+    assert registry.get().key == ("ETH-A", 1)
+    assert registry.empty()
+
+
+def test_auction_in_flight_is_queued_again_only_after_release():
+    registry = AuctionRegistry()
+    auction = Auction("ETH-A", 1, (0, Decimal("0")))
+    registry.sync("ETH-A", [1], lambda x: auction)
+    item = registry.get()
+
+    registry.sync("ETH-A", [1], lambda x: auction)
+    assert registry.empty()
+
+    registry.release(item)
+    registry.put(item)
+    assert registry.get() is auction
+
+
+def test_repeated_reprioritization_does_not_grow_the_heap():
+    registry = AuctionRegistry()
+    auctions = {x: Auction("ETH-A", x, (1, Decimal(-x))) for x in range(10)}
+    for step in range(100):
+        for auction in auctions.values():
+            auction.priority = (1, Decimal(-step))
+        registry.sync("ETH-A", list(auctions), lambda x: auctions[x])
+
+    assert registry.qsize() == 10
+    assert len(registry._heap) <= 2 * 10 + 64
+
+
+def test_ended_auction_is_dropped():
+    registry = AuctionRegistry()
+    auctions = {1: Auction("ETH-A", 1, (0, Decimal("0"))), 2: Auction("ETH-A", 2, (0, Decimal("0")))}
+    registry.sync("ETH-A", [1, 2], lambda x: auctions[x])
+    registry.sync("ETH-A", [2], lambda x: auctions[x])
+
+    assert ("ETH-A", 1) not in registry
+    assert registry.qsize() == 1
+    assert registry.get().key == ("ETH-A", 2)
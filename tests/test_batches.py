@@ -0,0 +1,80 @@
+import time
+
+from liquidator.liquidations.batches import CollateralBatcher
+from liquidator.liquidations.ExitCollateralItem import ExitCollateralItem
+from liquidator.liquidations.pipeline import STOP
+
+WAD = 10 ** 18
+RAY = 10 ** 27
+
+
+def exit_item(liquidation_id: int, amount: int, price: int, ilk: str = "WAG-A") -> ExitCollateralItem:
+    return ExitCollateralItem(liquidation_id=liquidation_id, ilk=ilk, amount=amount, price=price,
+                              swap_path=["0xWAG", "0xUSDV"], take_id=f"0xtake{liquidation_id}")
+
+
+def test_merge_of_one_item_is_the_item():
+    item = exit_item(1, 10 * WAD, 2 * RAY)
+
+    assert ExitCollateralItem.merge([item]) is item
+
+
+def test_merge_keeps_the_minimal_swap_output_of_the_takes():
+    items = [exit_item(1, 10 * WAD, 2 * RAY), exit_item(2, 30 * WAD, 4 * RAY)]
+
+    merged = ExitCollateralItem.merge(items)
+    assert merged.amount == 40 * WAD
+    # weighted by amount: (10 * 2 + 30 * 4) / 40
+    assert merged.price == 35 * RAY // 10
+    assert merged.amount * merged.price == sum(map(lambda x: x.amount * x.price, items))
+    assert merged.liquidation_id == "1,2"
+
+
+def test_merged_state_key_is_derived_from_the_members():
+    first, second = exit_item(1, WAD, RAY), exit_item(2, WAD, RAY)
+
+    merged = ExitCollateralItem.merge([first, second])
+    assert merged.replaces == [first.state_key, second.state_key]
+    assert merged.state_key not in merged.replaces
+    assert ExitCollateralItem.merge([exit_item(2, WAD, RAY), exit_item(1, WAD, RAY)]).take_id == merged.take_id
+
+
+def test_partial_takes_of_one_auction_have_different_state_keys():
+    assert exit_item(1, WAD, RAY).state_key != ExitCollateralItem(
+        liquidation_id=1, ilk="WAG-A", amount=WAD, price=RAY, swap_path=[], take_id="0xother").state_key
+
+
+def test_batcher_merges_a_full_bucket_of_one_ilk():
+    batcher = CollateralBatcher(window=60, max_size=2)
+    batcher.put(exit_item(1, WAD, RAY))
+    batcher.put(exit_item(2, WAD, RAY, ilk="WBTC-A"))
+    batcher.put(exit_item(3, WAD, RAY))
+
+    merged = batcher.get()
+    assert merged.liquidation_id == "1,3"
+    assert merged.amount == 2 * WAD
+    assert batcher.qsize() == 1
+
+
+def test_batcher_hands_out_a_bucket_after_the_window():
+    batcher = CollateralBatcher(window=0.05, max_size=20)
+    batcher.put(exit_item(1, WAD, RAY))
+
+    started_at = time.monotonic()
+    item = batcher.get()
+    assert item.liquidation_id == 1
+    assert time.monotonic() - started_at >= 0.04
+    assert batcher.empty()
+
+
+def test_batcher_hands_out_sent_items_and_stop_at_once():
+    batcher = CollateralBatcher(window=60, max_size=20)
+    batcher.put(exit_item(1, WAD, RAY))
+    sent = exit_item(2, WAD, RAY)
+    sent.exit_tx = b"\x01" * 32
+    batcher.put(sent)
+    batcher.put(STOP)
+
+    assert batcher.get() is sent
+    assert batcher.get() is STOP
+    assert batcher.qsize() == 1
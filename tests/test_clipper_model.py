@@ -0,0 +1,89 @@
+from decimal import Decimal
+
+import pytest
+
+from liquidator.liquidations.clipper_model import (RAY, Abacus, AuctionModel, ExponentialDecrease, LinearDecrease,
+                                                   StairstepExponentialDecrease, take_slice)
+
+WAD = 10 ** 18
+RAD = 10 ** 45
+
+
+def test_abacus_is_abstract():
+    with pytest.raises(TypeError):
+        Abacus()
+
+
+@pytest.mark.parametrize("abacus", [
+    LinearDecrease(tau=3600),
+    StairstepExponentialDecrease(step=90, cut=int(Decimal("0.99") * RAY)),
+    ExponentialDecrease(cut=int(Decimal("0.9999") * RAY)),
+])
+def test_duration_to_is_the_first_duration_at_the_price(abacus):
+    top, price = Decimal("100"), Decimal("80")
+
+    duration = abacus.duration_to(top, price)
+    assert abacus.price(top, duration) <= price
+    assert abacus.price(top, duration - 1) > price
+    assert abacus.duration_to(top, top) == 0
+
+
+def test_linear_decrease_reaches_zero_at_tau():
+    abacus = LinearDecrease(tau=100)
+
+    assert abacus.price(Decimal("10"), 50) == Decimal("5")
+    assert abacus.price(Decimal("10"), 100) == 0
+    assert abacus.duration_to(Decimal("10"), Decimal("0")) == 100
+
+
+def test_exponential_decrease_without_a_cut_never_reaches_a_lower_price():
+    assert ExponentialDecrease(cut=int(RAY)).duration_to(Decimal("10"), Decimal("9")) is None
+    assert StairstepExponentialDecrease(step=60, cut=int(RAY)).duration_to(Decimal("10"), Decimal("9")) is None
+
+
+def test_auction_model_follows_tail_and_cusp():
+    model = AuctionModel(top=100 * 10 ** 27, tic=1000, tail=1800, cusp=int(Decimal("0.4") * RAY),
+                         abacus=LinearDecrease(tau=3600))
+
+    assert model.price_at(1000 + 360) == Decimal("90")
+    assert model.time_to_price(Decimal("90")) == 1000 + 360
+    # reached only after the tail
+    assert model.time_to_price(Decimal("40")) is None
+    # below the cusp the auction has to be restarted
+    assert model.time_to_price(Decimal("30")) is None
+    assert model.needs_redo(1000 + 1801)
+    assert not model.needs_redo(1000 + 1800)
+
+
+def test_take_slice_takes_the_lot_at_the_price():
+    # lot 10, tab 1000, price 50: the whole lot owes 500
+    assert take_slice(amt=10 * WAD, lot=10 * WAD, tab=1000 * RAD, price=50 * 10 ** 27, chost=0) == \
+        (10 * WAD, 500 * RAD)
+
+
+def test_take_slice_owes_no_more_than_the_tab():
+    # lot 10 at price 50 would owe 500, the tab is 300
+    slice_, owe = take_slice(amt=10 * WAD, lot=10 * WAD, tab=300 * RAD, price=50 * 10 ** 27, chost=0)
+
+    assert owe == 300 * RAD
+    assert slice_ == 6 * WAD
+
+
+def test_take_slice_of_a_partial_take():
+    # amt 2 of lot 10, the rest of the tab (900) is above chost
+    assert take_slice(amt=2 * WAD, lot=10 * WAD, tab=1000 * RAD, price=50 * 10 ** 27, chost=100 * RAD) == \
+        (2 * WAD, 100 * RAD)
+
+
+def test_take_slice_leaves_no_dusty_tab():
+    # amt 19 of lot 20 would owe 950 and leave 50 of the tab, below chost 100: Clipper takes tab - chost instead
+    slice_, owe = take_slice(amt=19 * WAD, lot=20 * WAD, tab=1000 * RAD, price=50 * 10 ** 27, chost=100 * RAD)
+
+    assert owe == 900 * RAD
+    assert slice_ == 18 * WAD
+
+
+def test_take_slice_of_the_whole_lot_may_leave_a_dusty_tab():
+    # the whole lot is taken, the rest of the tab is not checked against chost
+    assert take_slice(amt=20 * WAD, lot=10 * WAD, tab=520 * RAD, price=50 * 10 ** 27, chost=100 * RAD) == \
+        (10 * WAD, 500 * RAD)
@@ -0,0 +1,118 @@
+from liquidator.gas import URGENCY_DEFAULT, URGENCY_TAKE, GasStrategy, UrgencyProfile, is_method_not_found
+
+GWEI = 10 ** 9
+
+
+class Eth:
+    def __init__(self, history=None, error: Exception = None):
+        self.gas_price = 20 * GWEI
+        self.history = history
+        self.error = error
+        self.history_reads = 0
+
+    def fee_history(self, block_count: int, newest_block: str, percentiles):
+        self.history_reads += 1
+        if self.error is not None:
+            raise self.error
+        return self.history
+
+
+class Web3:
+    def __init__(self, eth: Eth):
+        self.eth = eth
+
+
+class Block:
+    def __init__(self):
+        self.number = 100
+
+    def __call__(self) -> int:
+        return self.number
+
+
+def history(base_fee: int, tips):
+    # one reward row per block, the columns are the percentiles 50 and 90
+    return {"baseFeePerGas": [base_fee] * 3, "reward": tips}
+
+
+def strategy(eth: Eth, block: Block, max_gas_price: int = None) -> GasStrategy:
+    return GasStrategy(Web3(eth), block_number=block, profiles=[
+        UrgencyProfile(URGENCY_DEFAULT, reward_percentile=50, max_gas_price=max_gas_price),
+        UrgencyProfile(URGENCY_TAKE, reward_percentile=90, escalation=1.5, max_gas_price=max_gas_price),
+    ])
+
+
+def test_price_follows_the_base_fee_and_the_tips_of_the_profile():
+    eth = Eth(history(10 * GWEI, [[1 * GWEI, 5 * GWEI], [2 * GWEI, 6 * GWEI], [3 * GWEI, 7 * GWEI]]))
+    gas = strategy(eth, Block())
+
+    assert gas.price(URGENCY_DEFAULT) == {"maxFeePerGas": 22 * GWEI, "maxPriorityFeePerGas": 2 * GWEI}
+    assert gas.price(URGENCY_TAKE) == {"maxFeePerGas": 26 * GWEI, "maxPriorityFeePerGas": 6 * GWEI}
+    # the history is read once per block
+    assert eth.history_reads == 1
+
+
+def test_price_is_capped():
+    gas = strategy(Eth(history(10 * GWEI, [[1 * GWEI, 5 * GWEI]])), Block(), max_gas_price=15 * GWEI)
+
+    assert gas.price(URGENCY_TAKE) == {"maxFeePerGas": 15 * GWEI, "maxPriorityFeePerGas": 5 * GWEI}
+
+
+def test_chain_without_base_fee_uses_the_legacy_gas_price():
+    gas = strategy(Eth({"baseFeePerGas": [0, 0], "reward": []}), Block())
+
+    assert gas.price(URGENCY_DEFAULT) == {"gasPrice": 20 * GWEI}
+
+
+def test_missing_fee_history_method_disables_it():
+    block = Block()
+    eth = Eth(error=ValueError({"code": -32601, "message": "the method eth_feeHistory does not exist"}))
+    gas = strategy(eth, block)
+
+    assert gas.price(URGENCY_DEFAULT) == {"gasPrice": 20 * GWEI}
+    block.number += 1
+    gas.price(URGENCY_DEFAULT)
+    assert eth.history_reads == 1
+
+
+def test_failed_fee_history_read_is_tried_again_on_the_next_block():
+    block = Block()
+    eth = Eth(error=TimeoutError("read timed out"))
+    gas = strategy(eth, block)
+
+    assert gas.price(URGENCY_DEFAULT) == {"gasPrice": 20 * GWEI}
+    eth.error, eth.history = None, history(10 * GWEI, [[1 * GWEI, 5 * GWEI]])
+    block.number += 1
+    assert gas.price(URGENCY_DEFAULT) == {"maxFeePerGas": 21 * GWEI, "maxPriorityFeePerGas": 1 * GWEI}
+
+
+def test_is_method_not_found():
+    assert is_method_not_found(ValueError({"code": -32601, "message": "method not found"}))
+    assert not is_method_not_found(ValueError({"code": -32000, "message": "header not found"}))
+    assert not is_method_not_found(TimeoutError())
+
+
+def test_escalate_bumps_by_the_profile_and_at_least_to_the_current_price():
+    gas = strategy(Eth(history(10 * GWEI, [[1 * GWEI, 5 * GWEI]])), Block())
+
+    fees = gas.escalate({"maxFeePerGas": 20 * GWEI, "maxPriorityFeePerGas": 2 * GWEI}, URGENCY_TAKE)
+    assert fees == {"maxFeePerGas": 30 * GWEI, "maxPriorityFeePerGas": 5 * GWEI}
+
+    fees = gas.escalate({"gasPrice": 10 * GWEI}, URGENCY_DEFAULT)
+    assert fees == {"gasPrice": 21 * GWEI}
+
+
+def test_escalate_stops_when_the_cap_leaves_no_valid_replacement():
+    gas = strategy(Eth(history(10 * GWEI, [[1 * GWEI, 5 * GWEI]])), Block(), max_gas_price=30 * GWEI)
+
+    assert gas.escalate({"maxFeePerGas": 28 * GWEI, "maxPriorityFeePerGas": 2 * GWEI}, URGENCY_TAKE) is None
+    # 10% over 27 gwei is still below the cap, 10% over 28 gwei is not
+    assert gas.escalate({"gasPrice": 27 * GWEI}, URGENCY_DEFAULT) == {"gasPrice": 30 * GWEI}
+    assert gas.escalate({"gasPrice": 28 * GWEI}, URGENCY_DEFAULT) is None
+
+
+def test_escalate_of_a_dynamic_fee_transaction_without_fee_history():
+    gas = strategy(Eth(error=TimeoutError()), Block())
+
+    fees = gas.escalate({"maxFeePerGas": 10 * GWEI, "maxPriorityFeePerGas": 2 * GWEI}, URGENCY_TAKE)
+    assert fees == {"maxFeePerGas": 20 * GWEI, "maxPriorityFeePerGas": 3 * GWEI}
@@ -0,0 +1,87 @@
+from liquidator.liquidations.ledger import UsdvLedger
+
+
+class Chain:
+    def __init__(self, balance: int, block_number: int = 1):
+        self.balance = balance
+        self.block_number = block_number
+
+    def ledger(self, credit_pending: bool = False) -> UsdvLedger:
+        return UsdvLedger(read_balance=lambda: self.balance, block_number=lambda: self.block_number,
+                          credit_pending=credit_pending)
+
+
+def test_reserve_is_limited_to_the_available_balance():
+    ledger = Chain(100).ledger()
+
+    assert ledger.reserve("a", 60) == 60
+    assert ledger.reserve("b", 60) == 40
+    assert ledger.reserve("c", 1) == 0
+    assert "c" not in ledger.reserved
+    assert ledger.available() == 0
+
+
+def test_reserve_again_replaces_the_reservation_of_the_key():
+    ledger = Chain(100).ledger()
+
+    ledger.reserve("a", 60)
+    assert ledger.reserve("a", 30) == 30
+    assert ledger.available() == 70
+
+
+def test_release_frees_the_reservation():
+    ledger = Chain(100).ledger()
+    ledger.reserve("a", 60)
+
+    ledger.release("a")
+    ledger.release("unknown")
+    assert ledger.available() == 100
+
+
+def test_settled_take_counts_until_the_balance_is_read_in_its_block():
+    chain = Chain(100, block_number=10)
+    ledger = chain.ledger()
+    ledger.reserve("a", 60)
+
+    ledger.settle("a", 50, block_number=11)
+    assert ledger.reserved == {}
+    assert ledger.available() == 50
+
+    # the balance read in the block of the receipt has the take
+    chain.balance, chain.block_number = 50, 11
+    assert ledger.available() == 50
+    assert ledger.settled == []
+
+
+def test_settle_in_a_block_the_balance_already_has_is_not_applied_twice():
+    chain = Chain(40, block_number=12)
+    ledger = chain.ledger()
+    ledger.available()
+
+    ledger.settle("a", 60, block_number=12)
+    assert ledger.available() == 40
+
+
+def test_pending_credits_count_only_with_credit_pending():
+    chain = Chain(100, block_number=10)
+    with_credit, without_credit = chain.ledger(credit_pending=True), chain.ledger()
+    for ledger in (with_credit, without_credit):
+        ledger.credit("join", 30)
+
+    assert with_credit.available() == 130
+    assert without_credit.available() == 100
+
+
+def test_confirmed_credit_is_settled_and_dropped_credit_is_gone():
+    chain = Chain(100, block_number=10)
+    ledger = chain.ledger(credit_pending=True)
+    ledger.credit("confirmed", 30)
+    ledger.credit("dropped", 20)
+
+    ledger.confirm_credit("confirmed", block_number=11)
+    ledger.drop_credit("dropped")
+    assert ledger.pending_credits == {}
+    assert ledger.available() == 130
+
+    chain.balance, chain.block_number = 130, 11
+    assert ledger.available() == 130
@@ -0,0 +1,109 @@
+import pytest
+from hexbytes import HexBytes
+from web3.exceptions import TimeExhausted, TransactionNotFound
+
+from liquidator.receipts import AwaitingReceipt, ReceiptWatcher, TransactionReverted, wait_for_receipt
+
+FIRST = HexBytes(b"\x01" * 32)
+SECOND = HexBytes(b"\x02" * 32)
+
+
+class Eth:
+    def __init__(self):
+        self.receipts = {}
+        self.lookups = []
+
+    def get_transaction_receipt(self, tx_hash: HexBytes) -> dict:
+        self.lookups.append(tx_hash)
+        if tx_hash not in self.receipts:
+            raise TransactionNotFound(f"{tx_hash.hex()} not found")
+        return self.receipts[tx_hash]
+
+    def wait_for_transaction_receipt(self, transaction_hash: HexBytes, timeout: int) -> dict:
+        return self.receipts[transaction_hash]
+
+
+class Web3:
+    def __init__(self, eth: Eth):
+        self.eth = eth
+
+
+class Blocks:
+    block_number = 100
+
+
+def receipt(tx_hash: HexBytes, block_number: int, status: int = 1) -> dict:
+    return {"transactionHash": tx_hash, "blockNumber": block_number, "status": status}
+
+
+@pytest.fixture
+def eth() -> Eth:
+    return Eth()
+
+
+def test_receipt_is_returned_after_the_confirmations(eth):
+    watcher = ReceiptWatcher(Web3(eth), Blocks(), confirmations=2)
+    with pytest.raises(AwaitingReceipt) as awaiting:
+        watcher.wait(FIRST)
+
+    eth.receipts[FIRST] = receipt(FIRST, 101)
+    watcher.poll(101)
+    assert not awaiting.value.future.done()
+
+    watcher.poll(102)
+    assert watcher.wait(FIRST) == eth.receipts[FIRST]
+    assert watcher.watched == {}
+
+
+def test_replacement_that_was_mined_resolves_the_replaced_transaction(eth):
+    watcher = ReceiptWatcher(Web3(eth), Blocks(), replacement_chain=lambda x: [x, SECOND] if x == FIRST else [x])
+    future = watcher.watch(FIRST)
+
+    eth.receipts[SECOND] = receipt(SECOND, 101)
+    watcher.poll(101)
+
+    assert future.result() == eth.receipts[SECOND]
+    assert sorted(eth.lookups) == [FIRST, SECOND]
+
+
+def test_reverted_transaction_fails_the_wait(eth):
+    watcher = ReceiptWatcher(Web3(eth), Blocks())
+    future = watcher.watch(FIRST)
+
+    eth.receipts[FIRST] = receipt(FIRST, 101, status=0)
+    watcher.poll(101)
+
+    with pytest.raises(TransactionReverted):
+        future.result()
+    with pytest.raises(TransactionReverted):
+        watcher.wait(FIRST)
+
+
+def test_transaction_not_mined_in_time_is_timed_out_and_watched_again_on_the_next_wait(eth):
+    watcher = ReceiptWatcher(Web3(eth), Blocks(), timeout_blocks=5)
+    future = watcher.watch(FIRST)
+
+    watcher.poll(105)
+    assert not future.done()
+    watcher.poll(106)
+    with pytest.raises(TimeExhausted):
+        future.result()
+
+    assert not watcher.watch(FIRST).done()
+
+
+def test_lookups_of_a_block_are_made_once_per_hash(eth):
+    watcher = ReceiptWatcher(Web3(eth), Blocks(), replacement_chain=lambda x: [FIRST, SECOND])
+    watcher.watch(FIRST)
+    watcher.watch(SECOND)
+
+    watcher.poll(101)
+
+    assert sorted(eth.lookups) == [FIRST, SECOND]
+
+
+def test_wait_without_a_watcher_fails_a_reverted_transaction(eth):
+    eth.receipts[FIRST] = receipt(FIRST, 101, status=0)
+
+    with pytest.raises(TransactionReverted):
+        wait_for_receipt(Web3(eth), FIRST)
@@ -0,0 +1,128 @@
+import pytest
+
+from liquidator import retry
+from liquidator.retry import CircuitBreaker, DeadLetters, RetryPolicy
+from liquidator.state_store import StateStore
+
+
+class Logger:
+    def __init__(self):
+        self.notifications = []
+
+    def notification(self, message: str, **kwargs):
+        self.notifications.append(message)
+
+    def debug(self, message: str, **kwargs):
+        pass
+
+    def warning(self, message: str, **kwargs):
+        pass
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(retry.time, "monotonic", clock)
+    return clock
+
+
+def test_breaker_opens_after_the_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_trial_through_after_the_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    clock.now += 30
+    assert breaker.allow()
+    # only one trial at a time
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_again(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_retry_delay_is_capped():
+    policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=10)
+
+    assert all(0 <= policy.delay(attempt) <= min(10, 2 ** (attempt - 1)) for attempt in range(1, 2000))
+
+
+def test_call_retries_until_max_attempts(monkeypatch):
+    monkeypatch.setattr(retry.time, "sleep", lambda _: None)
+    policy = RetryPolicy(max_attempts=3)
+    errors = []
+
+    def fail():
+        raise ValueError("node is down")
+
+    with pytest.raises(ValueError):
+        policy.call(fail, on_error=lambda attempt, e: errors.append(attempt))
+    assert errors == [1, 2, 3]
+
+
+def test_call_returns_after_a_failed_attempt(monkeypatch):
+    monkeypatch.setattr(retry.time, "sleep", lambda _: None)
+    results = iter([ValueError("timeout"), 42])
+
+    def read():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert RetryPolicy(max_attempts=3).call(read) == 42
+
+
+def test_dead_letters_are_reported_once_per_key():
+    logger = Logger()
+    dead_letters = DeadLetters(logger=logger)
+
+    for _ in range(2):
+        dead_letters.add(kind="vault", key="1", description="check of vault #1", error=ValueError(), attempts=5)
+    dead_letters.add(kind="vault", key="2", description="check of vault #2", error=ValueError(), attempts=5)
+    assert len(dead_letters) == 2
+    assert len(logger.notifications) == 2
+
+
+def test_dead_letters_of_a_previous_run_are_loaded_and_not_reported_again(tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"))
+    DeadLetters(store=store, logger=Logger()).add(kind="vault", key="7", description="check of vault #7",
+                                                   error=ValueError("boom"), attempts=5)
+
+    logger = Logger()
+    dead_letters = DeadLetters(store=store, logger=logger)
+    loaded = dead_letters.load()
+    dead_letters.add(kind="vault", key="7", description="check of vault #7", error=ValueError("boom"), attempts=5)
+
+    assert [(x.kind, x.key, x.error) for x in loaded] == [("vault", "7", "ValueError('boom')")]
+    assert logger.notifications == []
+    store.close()
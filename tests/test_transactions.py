@@ -0,0 +1,168 @@
+import pytest
+from hexbytes import HexBytes
+
+from liquidator import transactions
+from liquidator.transactions import NonceManager, TransactionSender
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class Eth:
+    def __init__(self, mined: int = 0, pending: int = 0):
+        self.mined = mined
+        self.pending = pending
+        self.gas_price = 100
+        self.chain_id = 106
+        self.raw = []
+        self.transactions = {}
+
+    def get_transaction_count(self, address: str, block_identifier: str) -> int:
+        return self.mined if block_identifier == "latest" else self.pending
+
+    def send_raw_transaction(self, raw: dict) -> HexBytes:
+        self.raw.append(raw)
+        return HexBytes(bytes([len(self.raw)]) * 32)
+
+    def get_transaction(self, tx_hash: HexBytes) -> dict:
+        return self.transactions[tx_hash]
+
+
+class Web3:
+    def __init__(self, eth: Eth):
+        self.eth = eth
+
+
+class Signed:
+    def __init__(self, tx: dict):
+        self.rawTransaction = tx
+
+
+class Account:
+    address = "0x00000000000000000000000000000000000000aa"
+
+    @staticmethod
+    def sign_transaction(tx: dict) -> Signed:
+        return Signed(dict(tx))
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(transactions.time, "monotonic", clock)
+    return clock
+
+
+def test_nonces_start_at_the_pending_count_and_a_released_last_nonce_is_taken_again():
+    nonces = NonceManager(Web3(Eth(mined=3, pending=5)), Account.address)
+
+    assert nonces.allocate() == 5
+    assert nonces.allocate() == 6
+    nonces.release(6)
+    assert nonces.allocate() == 6
+
+
+def test_released_earlier_nonce_is_a_gap():
+    nonces = NonceManager(Web3(Eth(mined=5, pending=5)), Account.address)
+    for nonce in (nonces.allocate(), nonces.allocate(), nonces.allocate()):
+        nonces.sent(nonce, HexBytes(bytes([nonce]) * 32), {"nonce": nonce})
+    del nonces.pending[6]
+    nonces.release(6)
+
+    assert nonces.gaps() == [6]
+    assert nonces.allocate() == 8
+
+
+def test_sync_drops_mined_transactions():
+    eth = Eth(mined=0, pending=0)
+    nonces = NonceManager(Web3(eth), Account.address)
+    for nonce in (nonces.allocate(), nonces.allocate()):
+        nonces.sent(nonce, HexBytes(bytes([nonce + 1]) * 32), {"nonce": nonce})
+
+    eth.mined = eth.pending = 1
+    nonces.sync()
+
+    assert list(nonces.pending) == [1]
+    assert nonces.allocate() == 2
+
+
+def test_stuck_lists_replaceable_transactions_past_their_timeout_in_nonce_order(clock):
+    nonces = NonceManager(Web3(Eth()), Account.address)
+    nonces.sent(2, HexBytes(b"\x02" * 32), {"nonce": 2})
+    nonces.sent(0, HexBytes(b"\x01" * 32), {"nonce": 0})
+    nonces.sent(1, HexBytes(b"\x03" * 32))
+    nonces.sent(3, HexBytes(b"\x04" * 32), {"nonce": 3}).capped = True
+    clock.now += 30
+    nonces.sent(4, HexBytes(b"\x05" * 32), {"nonce": 4})
+
+    stuck = nonces.stuck(lambda x: 30)
+
+    # without a body (signed elsewhere), capped and too recent are not re-sent
+    assert [x.nonce for x in stuck] == [0, 2]
+
+
+def test_replacement_chain_follows_every_replacement():
+    nonces = NonceManager(Web3(Eth()), Account.address)
+    first, second, third = HexBytes(b"\x01" * 32), HexBytes(b"\x02" * 32), HexBytes(b"\x03" * 32)
+    nonces.replacements[first] = second
+    nonces.replacements[second] = third
+
+    assert nonces.replacement_chain(first) == [first, second, third]
+    assert nonces.replacement_chain(third) == [third]
+
+
+def test_maintain_fills_gaps_and_replaces_stuck_transactions(clock):
+    eth = Eth(mined=0, pending=0)
+    sender = TransactionSender(Web3(eth), Account(), stuck_timeout=60, replacement_multiplier=1.125)
+    stuck = sender.nonces.sent(sender.nonces.allocate(), HexBytes(b"\x09" * 32), {"nonce": 0, "gasPrice": 1000})
+    # nonce 1 was not broadcast, nonce 2 was
+    sender.nonces.allocate()
+    sender.nonces.sent(sender.nonces.allocate(), HexBytes(b"\x08" * 32))
+    eth.pending = 3
+
+    clock.now += 60
+    sender.maintain()
+
+    gap, replacement = eth.raw
+    assert gap["nonce"] == 1 and gap["to"] == Account.address and gap["value"] == 0
+    assert replacement["nonce"] == 0 and replacement["gasPrice"] == 1125
+    assert sender.nonces.replacement_chain(stuck.tx_hash)[-1] == sender.nonces.pending[0].tx_hash
+
+
+def test_external_transaction_is_recorded_at_the_nonce_it_was_signed_with():
+    eth = Eth(mined=4, pending=4)
+    sender = TransactionSender(Web3(eth), Account())
+    tx_hash = HexBytes(b"\x0a" * 32)
+    # the SDK took the pending nonce of another node than the local nonces
+    eth.transactions[tx_hash] = {"to": "0x00000000000000000000000000000000000000bb", "value": 0, "gas": 200000,
+                                 "input": "0x38ed1739", "nonce": 6, "gasPrice": 300}
+
+    assert sender.send_external(lambda: tx_hash) == tx_hash
+
+    pending = sender.nonces.pending[6]
+    assert list(sender.nonces.pending) == [6]
+    assert pending.tx_hash == tx_hash
+    assert pending.tx["gasPrice"] == 300 and pending.tx["chainId"] == 106 and pending.tx["nonce"] == 6
+    # the nonces below it are filled, the next one follows it
+    assert sender.nonces.gaps() == [4, 5]
+    assert sender.nonces.allocate() == 7
+
+
+def test_maintain_skips_the_block_while_an_earlier_maintenance_runs(clock):
+    eth = Eth(mined=0, pending=0)
+    sender = TransactionSender(Web3(eth), Account(), stuck_timeout=60)
+    sender.nonces.sent(sender.nonces.allocate(), HexBytes(b"\x09" * 32), {"nonce": 0, "gasPrice": 1000})
+    eth.pending = 1
+    clock.now += 60
+
+    with sender._maintaining:
+        sender.maintain()
+    assert eth.raw == []
+
+    sender.maintain()
+    assert len(eth.raw) == 1
@@ -0,0 +1,53 @@
+from liquidator.liquidations.pipeline import STOP
+from liquidator.liquidations.unsafe_vaults import UnsafeVaultQueue
+
+
+class Vault:
+    def __init__(self, cdp_id: int):
+        self.id = cdp_id
+
+
+def test_vault_reported_again_while_queued_is_queued_once():
+    queue = UnsafeVaultQueue()
+    first, again = Vault(1), Vault(1)
+    queue.put(first)
+    queue.put(Vault(2))
+    queue.put(again)
+
+    assert queue.qsize() == 2
+    # the newer report in the place of the first one
+    assert queue.get() is again
+    assert queue.get().id == 2
+
+
+def test_vault_being_barked_is_not_queued_until_released():
+    queue = UnsafeVaultQueue()
+    queue.put(Vault(1))
+    vault = queue.get()
+
+    queue.put(Vault(1))
+    assert queue.empty()
+    assert 1 in queue
+
+    queue.release(vault)
+    assert 1 not in queue
+    queue.put(Vault(1))
+    assert queue.qsize() == 1
+
+
+def test_item_handed_out_can_be_put_back():
+    queue = UnsafeVaultQueue()
+    queue.put(Vault(1))
+    vault = queue.get()
+
+    queue.put(vault)
+    assert queue.get() is vault
+
+
+def test_stop_is_handed_out_in_order():
+    queue = UnsafeVaultQueue()
+    queue.put(Vault(1))
+    queue.put(STOP)
+
+    assert queue.get().id == 1
+    assert queue.get() is STOP
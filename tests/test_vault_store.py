@@ -0,0 +1,66 @@
+from decimal import Decimal
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from liquidator.vault_store import VaultRow, VaultStore  # noqa: E402
+
+WAD = 10 ** 18
+RAY = 10 ** 27
+
+
+def row(cdp_id: int, ink: int, art: int, ilk: str = "ETH-A") -> VaultRow:
+    return VaultRow(cdp_id, f"0x{cdp_id:040x}", f"0x{cdp_id + 1:040x}", None, ink, art, ilk)
+
+
+def unsafe_ids(store: VaultStore, rates: dict, prices: dict, positions=None) -> list:
+    mask = store.unsafe_mask(rates=rates, prices=prices, positions=positions)
+    rows = np.arange(len(store)) if positions is None else positions
+    return [store.rows[x].id for x in rows[mask]]
+
+
+def test_mask_flags_vaults_below_the_minimum_liquidity_and_at_it_within_the_tolerance():
+    store = VaultStore()
+    # one ETH of collateral against one USDV of debt, the liquidity is 100 times the price
+    store.extend([row(1, WAD, WAD), row(2, 2 * WAD, WAD), row(3, 3 * WAD, 2 * WAD), row(4, 0, WAD), row(5, WAD, 0)])
+
+    # the third vault is exactly at 150%, it is left to the exact check of the Vault
+    assert unsafe_ids(store, {"ETH-A": RAY}, {"ETH-A": Decimal("1")}) == [1, 3]
+    assert unsafe_ids(store, {"ETH-A": RAY}, {"ETH-A": Decimal("1.5")}) == [1]
+    assert unsafe_ids(store, {"ETH-A": RAY}, {"ETH-A": Decimal("1.51")}) == []
+
+
+def test_mask_takes_the_rate_and_price_of_the_ilk_of_each_row():
+    store = VaultStore()
+    store.extend([row(1, WAD, WAD, "ETH-A"), row(2, WAD, WAD, "VLX-A")])
+
+    rates = {"ETH-A": RAY, "VLX-A": 2 * RAY}
+    assert unsafe_ids(store, rates, {"ETH-A": Decimal("2"), "VLX-A": Decimal("2")}) == [2]
+
+
+def test_uint256_amounts_beyond_int64_are_evaluated():
+    store = VaultStore()
+    store.update(row(1, 10 ** 30, 10 ** 30))
+
+    assert unsafe_ids(store, {"ETH-A": RAY}, {"ETH-A": Decimal("1")}) == [1]
+    assert store.rows[0].ink == 10 ** 30
+
+
+def test_row_read_again_replaces_its_vault_in_place():
+    store = VaultStore(capacity=2)
+    store.extend([row(1, WAD, WAD), row(2, 2 * WAD, WAD), row(3, 2 * WAD, WAD)])
+    store.update(row(2, WAD, WAD))
+
+    assert len(store) == 3
+    assert len(store.ink) >= 3
+    assert unsafe_ids(store, {"ETH-A": RAY}, {"ETH-A": Decimal("1")}) == [1, 2]
+
+
+def test_mask_over_the_positions_of_some_vaults():
+    store = VaultStore()
+    store.extend([row(1, WAD, WAD), row(2, 2 * WAD, WAD), row(3, WAD, WAD)])
+
+    positions = store.positions([2, 3, 4])
+    assert positions.tolist() == [1, 2]
+    assert unsafe_ids(store, {"ETH-A": RAY}, {"ETH-A": Decimal("1")}, positions=positions) == [3]
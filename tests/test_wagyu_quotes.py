@@ -0,0 +1,136 @@
+import pytest
+
+from liquidator import wagyu_quotes
+from liquidator.wagyu_quotes import ZERO_ADDRESS, WagyuQuotes
+
+# only digits, so the addresses are their own checksum
+TOKEN_A = "0x" + "1" * 40
+TOKEN_B = "0x" + "2" * 40
+TOKEN_C = "0x" + "3" * 40
+PAIR_AB = "0x" + "4" * 40
+PAIR_BC = "0x" + "5" * 40
+
+
+class Caller:
+    def __init__(self, pairs: dict):
+        self.pairs = pairs
+
+    def factory(self) -> str:
+        return "0x" + "6" * 40
+
+    def getPair(self, token_a: str, token_b: str) -> str:
+        return self.pairs.get((token_a, token_b), ZERO_ADDRESS)
+
+
+class Functions:
+    def __init__(self, address: str):
+        self.address = address
+
+    def getReserves(self) -> str:
+        # stands for the call, the Multicall fake answers by address
+        return self.address
+
+
+class Contract:
+    def __init__(self, address: str, pairs: dict):
+        self.address = address
+        self.caller = Caller(pairs)
+        self.functions = Functions(address)
+
+
+class Eth:
+    def __init__(self, pairs: dict):
+        self.pairs = pairs
+
+    def contract(self, address: str = None, abi: list = None):
+        if address is None:
+            return lambda address: Contract(address, self.pairs)
+        return Contract(address, self.pairs)
+
+
+class Web3:
+    def __init__(self, pairs: dict):
+        self.eth = Eth(pairs)
+
+
+class Wagyu:
+    def __init__(self, pairs: dict):
+        self.web3 = Web3(pairs)
+
+
+class Multicall:
+    def __init__(self, reserves: dict):
+        self.reserves = reserves
+        self.requests = []
+
+    def aggregate(self, calls: list):
+        self.requests.append(list(calls))
+        return 1, [self.reserves[x] + (0,) for x in calls]
+
+
+class Block:
+    def __init__(self):
+        self.number = 100
+
+    def __call__(self) -> int:
+        return self.number
+
+
+@pytest.fixture(autouse=True)
+def plain_calls(monkeypatch):
+    monkeypatch.setattr(wagyu_quotes, "Call", lambda x: x)
+
+
+def quotes(multicall: Multicall, block: Block, **kwargs) -> WagyuQuotes:
+    pairs = {(TOKEN_A, TOKEN_B): PAIR_AB, (TOKEN_B, TOKEN_C): PAIR_BC}
+    return WagyuQuotes(Wagyu(pairs), "0x" + "7" * 40, multicall, block, **kwargs)
+
+
+def test_amounts_follow_the_constant_product_with_the_fee():
+    q = quotes(Multicall({}), Block())
+
+    assert q.get_amount_out(1000, 100000, 200000) == 1974
+    assert q.get_amount_in(1974, 100000, 200000) == 1000
+    assert q.get_amount_out(0, 100000, 200000) == 0
+    with pytest.raises(ValueError):
+        q.get_amount_in(200000, 100000, 200000)
+
+
+def test_amounts_over_a_path_read_the_reserves_of_a_block_once():
+    multicall = Multicall({PAIR_AB: (100000, 200000), PAIR_BC: (400000, 100000)})
+    block = Block()
+    q = quotes(multicall, block)
+
+    amounts = q.get_amounts_out(1000, [TOKEN_A, TOKEN_B, TOKEN_C])
+    assert amounts == [1000, 1974, q.get_amount_out(1974, 400000, 100000)]
+    # the amounts are rounded down on the way out and up on the way in
+    assert q.get_amounts_in(amounts[-1], [TOKEN_A, TOKEN_B, TOKEN_C])[0] <= 1000
+
+    requests = len(multicall.requests)
+    q.get_amounts_out(2000, [TOKEN_A, TOKEN_B, TOKEN_C])
+    assert len(multicall.requests) == requests
+
+    block.number += 1
+    q.get_amounts_out(2000, [TOKEN_A, TOKEN_B, TOKEN_C])
+    assert multicall.requests[-1] == [PAIR_AB, PAIR_BC]
+
+
+def test_pairs_not_quoted_for_watch_blocks_are_not_read():
+    multicall = Multicall({PAIR_AB: (100000, 200000), PAIR_BC: (400000, 100000)})
+    block = Block()
+    q = quotes(multicall, block, watch_blocks=2)
+    q.get_pair(TOKEN_A, TOKEN_B)
+    q.get_pair(TOKEN_B, TOKEN_C)
+
+    block.number += 2
+    q.get_pair(TOKEN_A, TOKEN_B)
+    block.number += 1
+    assert q.reserves() == {(TOKEN_A, TOKEN_B): (100000, 200000)}
+    assert multicall.requests[-1] == [PAIR_AB]
+
+
+def test_missing_pair_is_an_error():
+    q = quotes(Multicall({}), Block())
+
+    with pytest.raises(ValueError):
+        q.get_pair(TOKEN_A, TOKEN_C)
@@ -0,0 +1,90 @@
+from liquidator.wagyu_quotes import WagyuQuotes
+from liquidator.wagyu_routes import RouteFinder
+
+# only digits, so the addresses are their own checksum
+GEM = "0x" + "1" * 40
+USDV = "0x" + "2" * 40
+WVLX = "0x" + "3" * 40
+USDT = "0x" + "4" * 40
+
+
+class Quotes(WagyuQuotes):
+    # the reserves of the pairs without RPC
+    def __init__(self, pools: dict):
+        self.fee_numerator = 997
+        self.fee_denominator = 1000
+        self.pools = {}
+        self.read = []
+        for (token_a, token_b), (reserve_a, reserve_b) in pools.items():
+            key = self.pair_key(token_a, token_b)
+            self.pools[key] = (reserve_a, reserve_b) if key[0] == token_a else (reserve_b, reserve_a)
+
+    def reserves(self, keys=None) -> dict:
+        keys = list(keys)
+        self.read.append(set(keys))
+        return {key: self.pools[key] for key in keys if key in self.pools}
+
+
+def finder(pools: dict, **kwargs) -> RouteFinder:
+    routes = RouteFinder(Quotes(pools), multicall=None, pairs_ttl=float("inf"), **kwargs)
+    for token_a, token_b in pools:
+        routes.graph.setdefault(token_a, set()).add(token_b)
+        routes.graph.setdefault(token_b, set()).add(token_a)
+    return routes
+
+
+def test_paths_are_found_shortest_first_within_max_hops():
+    routes = finder({(GEM, USDV): (10 ** 6, 10 ** 6), (GEM, WVLX): (10 ** 6, 10 ** 6),
+                     (WVLX, USDV): (10 ** 6, 10 ** 6), (WVLX, USDT): (10 ** 6, 10 ** 6),
+                     (USDT, USDV): (10 ** 6, 10 ** 6)}, max_hops=2)
+
+    assert routes.paths(GEM, USDV) == [[GEM, USDV], [GEM, WVLX, USDV]]
+
+    routes.max_hops = 3
+    assert routes.paths(GEM, USDV)[-1] == [GEM, WVLX, USDT, USDV]
+
+    routes.max_paths = 1
+    assert routes.paths(GEM, USDV) == [[GEM, USDV]]
+
+
+def test_best_route_goes_over_the_deeper_pairs():
+    routes = finder({(GEM, USDV): (10 ** 6, 10 ** 6), (GEM, WVLX): (10 ** 9, 10 ** 9),
+                     (WVLX, USDV): (10 ** 9, 10 ** 9)})
+
+    route = routes.best_route_out(GEM, USDV, 10 ** 5)
+    assert route.path == [GEM, WVLX, USDV]
+    assert route.amount_out == routes.amounts_out(10 ** 5, [GEM, WVLX, USDV], routes.quotes.pools)
+    # only the pairs of the searched paths are read
+    assert routes.quotes.read[-1] == routes.pair_keys([[GEM, USDV], [GEM, WVLX, USDV]])
+
+    route = routes.best_route_in(GEM, USDV, 10 ** 5)
+    assert route.path == [GEM, WVLX, USDV] and route.amount_out == 10 ** 5
+
+
+def test_best_route_in_skips_paths_without_the_liquidity():
+    routes = finder({(GEM, USDV): (10 ** 6, 10 ** 3), (GEM, WVLX): (10 ** 6, 10 ** 6),
+                     (WVLX, USDV): (10 ** 6, 10 ** 6)})
+
+    assert routes.best_route_in(GEM, USDV, 10 ** 4).path == [GEM, WVLX, USDV]
+    assert routes.best_route_in(GEM, USDV, 10 ** 7) is None
+
+
+def test_large_lot_is_split_over_routes_and_gives_more_than_one_route():
+    pools = {(GEM, USDV): (10 ** 6, 10 ** 6), (GEM, WVLX): (10 ** 6, 10 ** 6), (WVLX, USDV): (10 ** 6, 10 ** 6)}
+    routes = finder(pools, max_splits=2)
+
+    split = routes.split_routes(GEM, USDV, 10 ** 6)
+
+    assert len(split) == 2
+    assert sum(x.amount_in for x in split) == 10 ** 6
+    assert sum(x.amount_out for x in split) > finder(pools).best_route_out(GEM, USDV, 10 ** 6).amount_out
+
+
+def test_small_lot_takes_a_single_route():
+    routes = finder({(GEM, USDV): (10 ** 9, 10 ** 9), (GEM, WVLX): (10 ** 6, 10 ** 6),
+                     (WVLX, USDV): (10 ** 6, 10 ** 6)}, max_splits=2, split_parts=4)
+
+    split = routes.split_routes(GEM, USDV, 100)
+
+    assert [x.path for x in split] == [[GEM, USDV]]
+    assert split[0].amount_in == 100